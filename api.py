@@ -158,6 +158,25 @@ def get_eyepi_capture_service():
     return "spc-eyepi_capture.service"
 
 
+@app.route('/profile')
+@app.route('/profile/<int:seconds>')
+@requires_auth
+def profile(seconds: int = 60):
+    """
+    starts the sampling profiler in the capture service, see :class:`libs.Profiler.SamplingProfiler`.
+    the profile is written next to the logs once the window ends.
+
+    :param seconds: seconds to profile for
+    """
+    # mirrors SamplingProfiler.request_path, the capture service reads it when it gets the signal.
+    with open("/dev/shm/spc-eyepi-profile", 'w') as f:
+        f.write(str(seconds))
+    # only the main process, SIGUSR1 would kill the gphoto2 shells and any dslr capture in progress.
+    if systemctl("kill --kill-who=main --signal=SIGUSR1 {}".format(get_eyepi_capture_service())):
+        return "Profiling for {}s".format(seconds), 200
+    return "Couldnt signal the capture service", 500
+
+
 @app.route('/restart')
 @app.route('/reboot')
 @requires_auth
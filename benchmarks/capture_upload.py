@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""
+Capture-to-upload benchmark, with simulated cameras and a local stand-in for the sftp server.
+
+Runs the real capture path (:class:`libs.Camera.Camera` capture, :class:`libs.Encoder.ImageEncoder` and the
+post-capture :class:`libs.Pipeline.Pipeline`) for N synthetic cameras as fast as it will go, then uploads everything
+they wrote with the real :class:`libs.Uploader.Uploader` to a directory standing in for the server.
+Everything happens under a scratch directory, nothing is sent off the machine.
+
+Results are written as json: frames/sec, encode latency percentiles from :class:`libs.Tracing.Tracer`, bytes written,
+peak rss and upload throughput. Pass a previous result with --baseline to exit non-zero if capture or upload
+throughput regressed by more than --tolerance, before an image is flashed with flash_card.py.
+
+Run from the repository root:
+    python3 benchmarks/capture_upload.py --cameras 4 --resolution 1920x1080 --frames 20 -o result.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.Camera import Camera
+from libs.MQTTSession import MQTTSession
+from libs.Telemetry import Telemetry
+from libs.Tracing import Tracer
+from libs.UploadJournal import UploadJournal
+from libs.UploadScheduler import UploadScheduler
+from libs.Uploader import Uploader, SFTPConnectionPool
+
+
+class NullMQTTSession(object):
+    """
+    Broker stand-in, so that the workers dont connect anywhere. Messages are counted and dropped.
+    """
+
+    def __init__(self):
+        self.published = 0
+
+    def subscribe(self, topic: str, callback):
+        pass
+
+    def unsubscribe(self, topic: str, callback):
+        pass
+
+    def publish(self, topic: str, payload: bytes, qos: int = 1):
+        self.published += 1
+
+
+class SyntheticCamera(Camera):
+    """
+    Camera that captures synthetic frames instead of reading a device.
+
+    Frames are a gradient with seeded noise, so that they compress about as well as a real scene rather than to
+    nothing. Each capture shifts the noise, so consecutive frames arent identical.
+    """
+
+    def __init__(self, identifier: str, resolution: tuple, seed: int = 0, **kwargs):
+        """
+        :param identifier: identifier for the camera
+        :param resolution: (width, height) of the frames
+        :param seed: seed for the frame noise
+        :param kwargs: passed to :class:`libs.Camera.Camera`
+        """
+        width, height = resolution
+        random = numpy.random.RandomState(seed)
+        gradient = numpy.linspace(0, 200, width, dtype=numpy.float32)[numpy.newaxis, :, numpy.newaxis]
+        noise = random.randint(0, 48, size=(height, width, 3))
+        self._base = (gradient + noise).astype(numpy.uint8)
+        self._count = 0
+        super(SyntheticCamera, self).__init__(identifier, **kwargs)
+
+    def capture_image(self, filename: str = None):
+        """
+        captures a synthetic frame, into a pooled buffer like the real cameras.
+
+        :param filename: filename to output without extension
+        :return: list of image filenames if filename was specified, otherwise a numpy array.
+        :rtype: numpy.array or list
+        """
+        self._count += 1
+        self._image = numpy.add(self._base, self._count % 8, out=self.buffers.get(self._base.shape))
+        if filename:
+            return self.encode_write_np_array(self._image, filename)
+        return self._image
+
+
+class LocalSFTPConnection(object):
+    """
+    Stand-in for :class:`pysftp.Connection` backed by a local directory, implementing the parts the uploader uses.
+
+    Remote paths are relative to `root`. `latency` seconds are slept for every round trip, to model the link.
+    """
+    chunk_bytes = 32 * 1024
+
+    def __init__(self, root: str, latency: float = 0.0):
+        """
+        :param root: local directory standing in for the server
+        :param latency: seconds per round trip
+        """
+        self.root = root
+        self.latency = latency
+        self.sftp_client = self
+        self.round_trips = 0
+
+    def _local(self, remote_path: str) -> str:
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return os.path.join(self.root, remote_path.lstrip("/"))
+
+    @property
+    def pwd(self) -> str:
+        self._local("/")
+        return "/"
+
+    def normalize(self, remote_path: str) -> str:
+        self._local(remote_path)
+        return "/" + remote_path.lstrip("/")
+
+    def isdir(self, remote_path: str) -> bool:
+        return os.path.isdir(self._local(remote_path))
+
+    def makedirs(self, remote_path: str):
+        os.makedirs(self._local(remote_path), exist_ok=True)
+
+    def exists(self, remote_path: str) -> bool:
+        return os.path.exists(self._local(remote_path))
+
+    def stat(self, remote_path: str) -> os.stat_result:
+        return os.stat(self._local(remote_path))
+
+    def chmod(self, remote_path: str, mode: int = 777):
+        self._local(remote_path)
+
+    def remove(self, remote_path: str):
+        os.remove(self._local(remote_path))
+
+    def rename(self, remote_src: str, remote_dest: str):
+        os.rename(self._local(remote_src), self._local(remote_dest))
+
+    def posix_rename(self, remote_src: str, remote_dest: str):
+        os.replace(self._local(remote_src), self._local(remote_dest))
+
+    def truncate(self, remote_path: str, size: int):
+        os.truncate(self._local(remote_path), size)
+
+    def open(self, remote_path: str, mode: str = 'r'):
+        return _LocalRemoteFile(self._local(remote_path), mode)
+
+    def putfo(self, flo, remote_path: str, file_size: int = 0, callback=None):
+        transferred = 0
+        with open(self._local(remote_path), 'wb') as f:
+            while True:
+                chunk = flo.read(self.chunk_bytes)
+                if not chunk:
+                    break
+                f.write(chunk)
+                transferred += len(chunk)
+                if callback is not None:
+                    callback(transferred, file_size)
+
+    def put(self, localpath: str, remotepath: str, callback=None):
+        with open(localpath, 'rb') as flo:
+            self.putfo(flo, remotepath, file_size=os.path.getsize(localpath), callback=callback)
+
+    def close(self):
+        pass
+
+
+class _LocalRemoteFile(object):
+    """
+    file returned by :func:`LocalSFTPConnection.open`, with the paramiko SFTPFile extras the uploader calls.
+    """
+
+    def __init__(self, path: str, mode: str):
+        self._f = open(path, mode)
+
+    def set_pipelined(self, pipelined: bool = True):
+        pass
+
+    def __getattr__(self, item):
+        return getattr(self._f, item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._f.close()
+
+
+class LocalSFTPPool(SFTPConnectionPool):
+    """
+    Connection pool of :class:`LocalSFTPConnection`, kept apart from the real pools.
+    """
+    _pools = dict()
+
+    def _connect(self) -> LocalSFTPConnection:
+        return LocalSFTPConnection(self.params['root'], latency=self.params.get('latency', 0.0))
+
+
+class LocalUploader(Uploader):
+    """
+    Uploader that uploads to a :class:`LocalSFTPPool` instead of the configured host.
+    """
+
+    def __init__(self, identifier: str, server_root: str, latency: float = 0.0, **kwargs):
+        self.server_root = server_root
+        self.latency = latency
+        super(LocalUploader, self).__init__(identifier, **kwargs)
+
+    def connection_pool(self) -> SFTPConnectionPool:
+        return LocalSFTPPool.get_pool(dict(host=self.identifier, root=self.server_root, latency=self.latency),
+                                      size=self.upload_channels)
+
+    def upload_all(self) -> list:
+        """
+        uploads everything in the journal for this uploaders directory, in batches like :func:`Uploader.run`.
+
+        :return: files that failed to upload
+        :rtype: list(str)
+        """
+        failed = []
+        while True:
+            upload_list = self.journal.claim(self.source_dir, limit=self.batch_size)
+            if not upload_list:
+                return failed
+            try:
+                failed.extend(self.upload(upload_list))
+            finally:
+                self.journal.release(upload_list)
+            if len(upload_list) < self.batch_size:
+                return failed
+
+
+def peak_rss_mb() -> float:
+    """
+    peak resident set size of this process, in MB.
+    """
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def directory_size(path: str) -> tuple:
+    """
+    total bytes and number of files under a directory.
+    """
+    total = files = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            total += os.path.getsize(os.path.join(dirpath, fn))
+            files += 1
+    return total, files
+
+
+def capture_frames(camera: SyntheticCamera, frames: int, results: dict):
+    """
+    captures frames back to back through the cameras post-capture pipeline, the same way :func:`Camera.run` does
+    but without waiting for the schedule.
+    Submitting blocks when the pipeline is full, so the rate is the rate the whole pipeline sustains.
+    """
+    camera.pipeline = camera._make_pipeline()
+    start = datetime.datetime(2000, 1, 1)
+    failed = 0
+    st = time.time()
+    for i in range(frames):
+        # one capture a second, so that every frame gets its own timestamped name.
+        camera.current_capture_time = start + datetime.timedelta(seconds=i)
+        spool = tempfile.mkdtemp(prefix=camera.name)
+        start_capture_time = time.time()
+        name = camera.timestamped_imagename
+        with Tracer.get_tracer().span(camera.identifier, "capture"):
+            files = camera.capture(filename=os.path.join(spool, name))
+        if not files:
+            failed += 1
+            shutil.rmtree(spool, ignore_errors=True)
+            continue
+        camera.pipeline.stages[0].put(dict(capture_time=camera.current_capture_time,
+                                           name=name,
+                                           image=camera.image,
+                                           files=files,
+                                           spool=spool,
+                                           start_time=start_capture_time,
+                                           telemetry=dict()))
+    camera.pipeline.stop()
+    elapsed = time.time() - st
+    results[camera.identifier] = dict(frames=frames - failed,
+                                      failed=failed,
+                                      seconds=elapsed,
+                                      fps=(frames - failed) / max(elapsed, 1e-6))
+
+
+def upload_files(uploader: LocalUploader, results: dict):
+    """
+    uploads everything one uploader has waiting, timing it.
+    """
+    st = time.time()
+    failed = uploader.upload_all()
+    results[uploader.identifier] = dict(failed=len(failed), seconds=time.time() - st)
+
+
+def run_threads(target, workers: list, *args) -> tuple:
+    """
+    runs target(worker, *args, results) for every worker concurrently.
+
+    :return: seconds taken for all of them, and the dict of results by identifier
+    :rtype: tuple(float, dict)
+    """
+    results = dict()
+    threads = [Thread(target=target, args=(worker,) + args + (results,)) for worker in workers]
+    st = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - st, results
+
+
+def parse_resolution(value: str) -> tuple:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def benchmark(args, workdir: str) -> dict:
+    """
+    runs the capture phase then the upload phase, under workdir.
+
+    :return: results
+    :rtype: dict
+    """
+    # keep all of the process wide state in the scratch directory.
+    UploadJournal.default_path = os.path.join(workdir, "upload_journal.sqlite")
+    Telemetry.spool_path = os.path.join(workdir, "telemetry.spool")
+    Tracer.snapshot_path = os.path.join(workdir, "spans.json")
+    MQTTSession._instance = NullMQTTSession()
+    Camera.output_types = args.formats
+    UploadScheduler.get_scheduler().configure(slots=args.slots, bandwidth_kbps=args.bandwidth_kbps)
+
+    images = os.path.join(workdir, "images")
+    server = os.path.join(workdir, "server")
+    os.makedirs(server)
+    cameras = []
+    for idx in range(args.cameras):
+        identifier = "bench-{}".format(idx)
+        resolution = args.resolution[idx % len(args.resolution)]
+        cameras.append(SyntheticCamera(identifier, resolution, seed=args.seed + idx,
+                                       config=dict(name=identifier,
+                                                   output_dir=os.path.join(images, identifier),
+                                                   capture_timelapse=True,
+                                                   pipeline_queue_size=args.queue_size,
+                                                   master_only=args.master_only)))
+
+    capture_s, capture_results = run_threads(capture_frames, cameras, args.frames)
+    for camera in cameras:
+        # previews are written to /dev/shm for the web interface, dont leave them behind.
+        try:
+            os.remove(os.path.join("/dev/shm", camera.identifier + ".jpg"))
+        except OSError:
+            pass
+    bytes_written, files_written = directory_size(images)
+    spans = Tracer.get_tracer().snapshot()
+    for camera in cameras:
+        capture_results[camera.identifier].update(resolution="{}x{}".format(*camera._base.shape[1::-1]),
+                                                  spans=spans.get(camera.identifier, dict()))
+    rss_after_capture = peak_rss_mb()
+
+    uploaders = [LocalUploader(camera.identifier, server, latency=args.latency,
+                               config=dict(name=camera.identifier,
+                                           output_dir=camera.upload_directory,
+                                           upload=dict(host="localhost", channels=args.channels, dedup=False)))
+                 for camera in cameras]
+    upload_s, upload_results = run_threads(upload_files, uploaders)
+    bytes_uploaded, files_uploaded = directory_size(server)
+
+    frames = sum(r['frames'] for r in capture_results.values())
+    return dict(
+        version=1,
+        time=datetime.datetime.now().isoformat(),
+        platform=dict(python=platform.python_version(),
+                      machine=platform.machine(),
+                      node=platform.node(),
+                      cpu_count=os.cpu_count(),
+                      numpy=numpy.__version__),
+        config=dict(cameras=args.cameras,
+                    resolution=["{}x{}".format(*r) for r in args.resolution],
+                    frames=args.frames,
+                    formats=args.formats,
+                    master_only=args.master_only,
+                    queue_size=args.queue_size,
+                    channels=args.channels,
+                    slots=args.slots,
+                    bandwidth_kbps=args.bandwidth_kbps,
+                    latency=args.latency,
+                    seed=args.seed),
+        capture=dict(frames=frames,
+                     seconds=capture_s,
+                     fps=frames / max(capture_s, 1e-6),
+                     bytes_written=bytes_written,
+                     files_written=files_written,
+                     peak_rss_mb=rss_after_capture,
+                     cameras=capture_results),
+        upload=dict(bytes=bytes_uploaded,
+                    files=files_uploaded,
+                    failed=sum(r['failed'] for r in upload_results.values()),
+                    seconds=upload_s,
+                    mbps=bytes_uploaded / max(upload_s, 1e-6) / 1024 / 1024,
+                    uploaders=upload_results),
+        peak_rss_mb=peak_rss_mb())
+
+
+def regressions(result: dict, baseline: dict, tolerance: float) -> list:
+    """
+    compares the headline numbers against a baseline result.
+
+    :param tolerance: allowed fractional drop, 0.1 for 10%
+    :return: descriptions of the numbers that dropped by more than the tolerance.
+    :rtype: list(str)
+    """
+    failed = []
+    for section, key in (("capture", "fps"), ("upload", "mbps")):
+        now, before = result[section][key], baseline.get(section, dict()).get(key)
+        if before and now < before * (1 - tolerance):
+            failed.append("{0} {1} dropped from {2:.2f} to {3:.2f}".format(section, key, before, now))
+    if baseline.get("peak_rss_mb") and result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        failed.append("peak rss grew from {0:.1f}MB to {1:.1f}MB".format(baseline["peak_rss_mb"],
+                                                                        result["peak_rss_mb"]))
+    return failed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the capture to upload path with simulated cameras")
+    arg_parser.add_argument("--cameras", type=int, default=1, help="number of simulated cameras")
+    arg_parser.add_argument("--resolution", type=parse_resolution, action="append",
+                            help="frame resolution as WIDTHxHEIGHT, repeat to give cameras different resolutions "
+                                 "(default 1920x1080)")
+    arg_parser.add_argument("--frames", type=int, default=10, help="frames to capture per camera")
+    arg_parser.add_argument("--formats", nargs="+", default=list(Camera.output_types),
+                            help="output formats to encode")
+    arg_parser.add_argument("--master-only", default=False, action="store_true",
+                            help="only write the lossless master format")
+    arg_parser.add_argument("--queue-size", type=int, default=2, help="post-capture pipeline queue size")
+    arg_parser.add_argument("--channels", type=int, default=Uploader.upload_channels,
+                            help="sftp connections per uploader")
+    arg_parser.add_argument("--slots", type=int, default=2, help="concurrent transfers for the whole device")
+    arg_parser.add_argument("--bandwidth-kbps", type=float, default=0, help="upload bandwidth cap in KB/s, 0 for none")
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="simulated sftp round trip time in seconds")
+    arg_parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic frames")
+    arg_parser.add_argument("--workdir", type=str, help="scratch directory, a temporary one is used by default")
+    arg_parser.add_argument("-o", "--output", type=str, help="file to write the json result to, default stdout")
+    arg_parser.add_argument("--baseline", type=argparse.FileType('r'),
+                            help="previous json result to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=0.1,
+                            help="fractional drop from the baseline that counts as a regression")
+    args = arg_parser.parse_args()
+    args.resolution = args.resolution or [(1920, 1080)]
+
+    workdir = tempfile.mkdtemp(prefix="spc-eyepi-bench", dir=args.workdir)
+    try:
+        result = benchmark(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        failed = regressions(result, json.load(args.baseline), args.tolerance)
+        for message in failed:
+            print("REGRESSION: {}".format(message), file=sys.stderr)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,16 @@
 
 import logging.config
 import os
+import signal
 import subprocess
 import sys
 import pyudev
 from libs.Camera import *
 from libs.Updater import Updater
 from libs.Uploader import Uploader, GenericUploader
+from libs.UploadScheduler import UploadScheduler
+from libs.DSLRDiscovery import DSLRDiscovery
+from libs.Profiler import SamplingProfiler
 from libs.Chamber import Chamber
 from libs.Sensor import SenseHatMonitor, DHTMonitor
 from threading import Lock
@@ -104,64 +108,16 @@ def detect_gphoto_info():
 
     this can potentially cause long wait times if a camera is attempting to capture for the split second that it tries
     to gphoto2, however it is the preferred method because it is the most robust and comparmentalised.
+    Only ports that havent been seen before are probed for serial numbers,
+    see :class:`libs.DSLRDiscovery.DSLRDiscovery`.
 
-    :param type:
-    :return: a dict of port:serialnumber values corresponding to the currently connected gphoto2 cameras.
+    :return: a dict of identifier:(bus, addr) values corresponding to the currently connected gphoto2 cameras.
     """
     try:
-        cams = {}
-        # check output of the --auto-detect gphoto2 command.
-        detect_ret = subprocess.check_output(["/usr/bin/gphoto2",
-                                              "--auto-detect"],
-                                             universal_newlines=True)
-        # iterate over the results, should be in the format of [(bus, addr), (bus, addr) ...] for usb connected dslrs
-        # this regex matches occurrences of "usb:" followed by 2 comma separated digits.
-        for bus, addr in re.findall(r'usb:(\d+),(\d+)', detect_ret):
-            try:
-                # findall returns strings...
-                bus, addr = int(bus), int(addr)
-                # this is the format that gphoto2 expects the port to be in.
-                port = "usb:{0:03d},{1:03d}".format(bus, addr)
-
-                # gphoto2 command to get the serial number for the DSLR
-                # WARNING: when the port here needs to be correct, because otherwise gphoto2 will return values from
-                # an arbitrary camera
-                sn_detect_ret = subprocess.check_output(['/usr/bin/gphoto2',
-                                                         '--port={}'.format(port),
-                                                         '--get-config=serialnumber'],
-                                                        universal_newlines=True)
-
-                # Match the serial number.
-                # this regex can also be used to parse the values from --get-config as all results are returned like this:
-                # Label: Serial Number
-                # Type: TEXT
-                # Current: 4fffa81fed8f40d286a63fce62598ef0
-                sn_match = re.search(r'Current: (\w+)', sn_detect_ret)
-
-                if not sn_match:
-                    # we didnt match any output from the command
-                    logger.error("Couldnt match serial number from gphoto2 output. {}".format(port))
-                    continue
-                sn = sn_match.group(1)
-
-                if sn.lower() == 'none':
-                    # there is a bug in a specific version of gphoto2 that causes it to return 'None' for the camera serial
-                    # number. If we cant get a unique serial number, we are screwed for multicamera
-                    # todo: allow this if there is only one camera.
-                    logger.error("serial number matched with value of 'none' {}".format(port))
-                    continue
-
-                # pad the serialnumber to 32
-                identifier = SysUtil.default_identifier(prefix=sn)
-                cams[identifier] = (bus, addr)
-            except:
-                traceback.print_exc()
-                logger.error("Exception detecting gphoto2 camera")
-                logger.error(traceback.format_exc())
-        return cams
-    except subprocess.CalledProcessError as e:
+        return DSLRDiscovery.get_discovery().cameras()
+    except:
         traceback.print_exc()
-        logger.error("Subprocess error detecting gphoto2 cameras")
+        logger.error("Exception detecting gphoto2 cameras")
         logger.error(traceback.format_exc())
     return dict()
 
@@ -382,79 +338,68 @@ def load_config(data: dict = dict()):
     return yaml.load(open(config_path)) or dict()
 
 
-def run_from_global_config(updater: Updater) -> tuple:
+def desired_workers(updater: Updater) -> dict:
     """
-    Runs the startup from a yaml file defining the devices connected to the raspberry pi.
+    Works out which workers should be running from a yaml file defining the devices connected to the raspberry pi,
+    and the devices that are currently detected. Nothing is created here, each entry has a factory for its worker.
 
     :param updater:
-    :return:
+    :return: dict of worker key: (device, config section, factory) for every worker that should be running.
+    :rtype: dict
     """
-    workers = []
-    hostname = SysUtil.get_hostname()
-    config_path = "/home/spc-eyepi/{}.yml".format(hostname)
+    desired = dict()
 
     config_data = load_config()
     camera_confs = config_data.get("cameras", dict())
+    # device wide upload slots and bandwidth cap, shared by every uploader.
+    UploadScheduler.get_scheduler().configure(**config_data.get("upload_scheduler", dict()))
+    new_sections = dict()
+
+    def add_uploader(identifier: str, section: dict, remove_source_files: bool = True):
+        def factory():
+            ul = Uploader(identifier, config=section, queue=updater.communication_queue)
+            ul.remove_source_files = remove_source_files
+            return ul
+        desired["uploader|{}".format(identifier)] = (None, section, factory)
 
     """
     PiCamera detect
     """
     logger.info("Detecting picamera")
     picamera_info = detect_picam_info()
-    if picamera_info:
-        try:
-            ident = list(picamera_info.keys())[0]
-            section = camera_confs.get(ident, get_default_camera_conf(ident))
+    for ident in picamera_info.keys():
+        section = camera_confs.get(ident, get_default_camera_conf(ident))
 
+        def factory(ident=ident, section=section):
             camera = PiCamera(identifier=ident,
                               config=section,
                               queue=updater.communication_queue)
-
             updater.add_to_identifiers(camera.identifier)
-            uploader = Uploader(identifier=camera.identifier,
-                                config=section,
-                                queue=updater.communication_queue)
-            workers.append(camera)
-            workers.append(uploader)
-            if not config_data.get("cameras"):
-                config_data['cameras'] = dict()
-            config_data['cameras'][ident] = section
-            config_data = load_config(config_data)
-
-        except Exception as e:
-            logger.error("General Exception in picamera detection. {}".format(str(e)))
-            logger.error(traceback.format_exc())
+            return camera
+        desired["camera|{}".format(ident)] = ("picamera", section, factory)
+        add_uploader(ident, section)
+        new_sections[ident] = section
 
     """
     DSLR detect
     """
     logger.info("Detecting DSLRs")
-
     dslr_info = detect_gphoto_info()
-
     for ident, (bus, addr) in dslr_info.items():
-        try:
-            section = camera_confs.get(ident, get_default_camera_conf(ident))
+        section = camera_confs.get(ident, get_default_camera_conf(ident))
 
+        def factory(ident=ident, section=section, bus=bus, addr=addr):
             camera = GPCamera(ident,
                               usb_address=(bus, addr),
                               config=section,
                               queue=updater.communication_queue)
             updater.add_to_temp_identifiers(camera.identifier)
-            workers.append(camera)
-            if section.get("upload", None) is not None:
-                uploader = Uploader(camera.identifier,
-                                    config=section,
-                                    queue=updater.communication_queue)
-                workers.append(uploader)
-            if not config_data.get("cameras"):
-                config_data['cameras'] = dict()
-            config_data['cameras'][ident] = section
-            config_data = load_config(config_data)
-            logger.debug("Sucessfully detected {} @ {}:{}".format(ident, bus, addr))
-        except Exception as e:
-            logger.error("Couldnt detect DSLR from global yaml {}".format(str(e)))
-            logger.error(traceback.format_exc())
+            return camera
+        desired["camera|{}".format(ident)] = ((bus, addr), section, factory)
+        if section.get("upload", None) is not None:
+            add_uploader(ident, section)
+        new_sections[ident] = section
+        logger.debug("Sucessfully detected {} @ {}:{}".format(ident, bus, addr))
 
     """
     WebCamera detect
@@ -474,25 +419,18 @@ def run_from_global_config(updater: Updater) -> tuple:
             identifier = SysUtil.default_identifier(prefix="USB-{}".format(serial))
             sys_number = device.sys_number
             section = camera_confs.get(identifier, get_default_camera_conf(identifier))
-            try:
-                # logger.warning("adding {} on {}".format(identifier, sys_number))
+
+            def factory(identifier=identifier, section=section, sys_number=sys_number):
                 camera = USBCamera(identifier,
                                    config=section,
                                    sys_number=sys_number,
                                    queue=updater.communication_queue)
                 updater.add_to_temp_identifiers(camera.identifier)
-                workers.append(camera)
-                if section.get("upload", None) is not None:
-                    workers.append(Uploader(identifier,
-                                            config=section,
-                                            queue=updater.communication_queue))
-                if not config_data.get("cameras"):
-                    config_data['cameras'] = dict()
-                config_data['cameras'][ident] = section
-                config_data = load_config(config_data)
-            except Exception as e:
-                logger.error("Unable to start usb webcamera {} on {}".format(identifier, sys_number))
-                logger.error("{}".format(str(e)))
+                return camera
+            desired["camera|{}".format(identifier)] = (sys_number, section, factory)
+            if section.get("upload", None) is not None:
+                add_uploader(identifier, section)
+            new_sections[identifier] = section
     except Exception as e:
         logger.error("couldnt detect usb cameras {}".format(str(e)))
         logger.error(traceback.format_exc())
@@ -500,34 +438,17 @@ def run_from_global_config(updater: Updater) -> tuple:
     """
     Sensor detect
     """
-
     for sensor_type, section in config_data.get("sensors", dict()).items():
-        try:
-            if sensor_type.lower() == "SenseHatMonitor":
-                sensor = SenseHatMonitor("{}-{}".format(SysUtil.get_hostname(), sensor_type),
-                                         config=section,
-                                         queue=updater.communication_queue)
-                workers.append(sensor)
-                if section.get("upload", None) is not None:
-                    ul = Uploader(sensor.identifier,
-                                  config=section,
-                                  queue=updater.communication_queue)
-                    ul.remove_source_files = False
-                    workers.append(ul)
-            else:
-                sensor = DHTMonitor("{}-{}".format(SysUtil.get_hostname(), sensor_type),
-                                    config=section,
-                                    queue=updater.communication_queue)
-                workers.append(sensor)
-                if section.get("upload", None) is not None:
-                    ul = Uploader(sensor.identifier,
-                                  config=section,
-                                  queue=updater.communication_queue)
-                    ul.remove_source_files = False
-                    workers.append(ul)
-        except Exception as e:
-            logger.error("Couldnt create sensor from global yaml {}".format(str(e)))
-            logger.error(traceback.format_exc())
+        identifier = "{}-{}".format(SysUtil.get_hostname(), sensor_type)
+        sensor_class = SenseHatMonitor if sensor_type.lower() == "SenseHatMonitor" else DHTMonitor
+
+        def factory(sensor_class=sensor_class, identifier=identifier, section=section):
+            return sensor_class(identifier,
+                                config=section,
+                                queue=updater.communication_queue)
+        desired["sensor|{}".format(identifier)] = (None, section, factory)
+        if section.get("upload", None) is not None:
+            add_uploader(identifier, section, remove_source_files=False)
 
     """
     Chamber detect
@@ -535,10 +456,84 @@ def run_from_global_config(updater: Updater) -> tuple:
     chamber_conf = config_data.get("chamber", None)
     if chamber_conf:
         if chamber_conf.get("datafile", None):
-            chamber = Chamber(identifier=chamber_conf.get("name"),
-                              config=chamber_conf)
-            workers.append(chamber)
-    return start_workers(workers)
+            def factory(chamber_conf=chamber_conf):
+                return Chamber(identifier=chamber_conf.get("name"),
+                               config=chamber_conf)
+            desired["chamber|{}".format(chamber_conf.get("name"))] = (None, chamber_conf, factory)
+
+    # write default sections for newly detected cameras back to the config, once.
+    if any(camera_confs.get(ident) != section for ident, section in new_sections.items()):
+        config_data.setdefault("cameras", dict()).update(new_sections)
+        load_config(config_data)
+    return desired
+
+
+def reconcile_workers(running: dict, updater: Updater) -> dict:
+    """
+    Brings the running workers in line with :func:`desired_workers`.
+
+    Workers that are no longer wanted are stopped, new ones are started, and workers whose config section changed are
+    reconfigured in place if they can be (see :func:`libs.Camera.Camera.reconfigure`) or restarted if they cant.
+    Workers that havent changed are left running, so plugging in a usb stick doesnt interrupt a timelapse.
+
+    :param running: dict of worker key: (device, config section, worker) from the last reconcile.
+    :param updater:
+    :return: the new dict of worker key: (device, config section, worker)
+    :rtype: dict
+    """
+    st = time.time()
+    desired = desired_workers(updater)
+    result = dict()
+    to_stop = []
+    to_start = []
+    for key, (device, section, worker) in running.items():
+        if key not in desired:
+            logger.info("Stopping {}, no longer wanted".format(key))
+            to_stop.append(worker)
+            continue
+        new_device, new_section, factory = desired[key]
+        if new_device != device:
+            logger.info("Restarting {}, device changed".format(key))
+            to_stop.append(worker)
+            continue
+        if new_section != section:
+            reconfigure = getattr(worker, "reconfigure", None)
+            if reconfigure is None or not reconfigure(new_section):
+                logger.info("Restarting {}, config changed".format(key))
+                to_stop.append(worker)
+                continue
+            logger.info("Reconfigured {}".format(key))
+        result[key] = (new_device, new_section, worker)
+
+    kill_workers(to_stop)
+
+    for key, (device, section, factory) in desired.items():
+        if key in result:
+            continue
+        try:
+            worker = factory()
+            to_start.append(worker)
+            result[key] = (device, section, worker)
+        except Exception as e:
+            logger.error("Couldnt create {} {}".format(key, str(e)))
+            logger.error(traceback.format_exc())
+    start_workers(to_start)
+    logger.info("Reconciled workers in {0:.2f}s: {1} stopped, {2} started, {3} running".format(time.time() - st,
+                                                                                              len(to_stop),
+                                                                                              len(to_start),
+                                                                                              len(result)))
+    return result
+
+
+def run_from_global_config(updater: Updater) -> dict:
+    """
+    Runs the startup from a yaml file defining the devices connected to the raspberry pi.
+
+    :param updater:
+    :return: dict of worker key: (device, config section, worker) to pass to :func:`reconcile_workers` later.
+    :rtype: dict
+    """
+    return reconcile_workers(dict(), updater)
 
 
 def enumerate_usb_devices() -> set:
@@ -570,28 +565,48 @@ def start_workers(worker_objects: tuple or list) -> tuple:
     return worker_objects
 
 
-def kill_workers(worker_objects: tuple):
+def kill_workers(worker_objects: tuple, timeout: float = 30) -> float:
     """
-    stops all workers
+    stops all workers, and waits for them to finish.
 
-    calls the stop method of the workers (they should all implement this as they are threads).
+    calls the stop method of every worker first (they should all implement this as they are threads), so that they all
+    drain their in flight captures and uploads at the same time, then joins them until a shared deadline.
 
     :param worker_objects:
     :type worker_objects: tuple(threading.Thread)
+    :param timeout: seconds to wait for all of the workers to finish.
+    :return: seconds it took to stop the workers.
+    :rtype: float
     """
+    st = time.time()
     logger.debug("Killing {} worker threads".format(str(len(worker_objects))))
     for thread in worker_objects:
         thread.stop()
+    stuck = []
+    for thread in worker_objects:
+        if thread.is_alive():
+            thread.join(max(st + timeout - time.time(), 0))
+        if thread.is_alive():
+            stuck.append(thread.name)
+    elapsed = time.time() - st
+    if stuck:
+        logger.error("{} workers didnt stop within {}s: {}".format(len(stuck), timeout, ", ".join(stuck)))
+    logger.info("Stopped {0} workers in {1:.2f}s".format(len(worker_objects) - len(stuck), elapsed))
+    return elapsed
 
 
 if __name__ == "__main__":
 
     logger.info("Program startup...")
+    # SIGUSR1 (from the api) profiles the capture process, for the duration written to the request file.
+    # registered before any workers start, starting them can take a while and SIGUSR1 kills the process by default.
+    signal.signal(signal.SIGUSR1,
+                  lambda *args: SamplingProfiler.get_profiler().start(SamplingProfiler.requested_duration()))
     # The main loop for capture
 
     # these should be all detected at some point.
     updater = None
-    workers = tuple()
+    workers = dict()
     try:
         # start the updater. this is the first thing that should happen.
         logger.debug("Starting up the updater")
@@ -618,13 +633,14 @@ if __name__ == "__main__":
             global hostname
             global recent
             try:
+                # keep the dslr map current from the event itself, so recreating doesnt have to probe every camera.
+                DSLRDiscovery.get_discovery().handle_event(action, event)
                 # use manual global lock.
                 # this callback is from the observer thread, so we need to lock shared resources.
                 if time.time() - 10 > recent:
                     with glock:
-                        logger.warning("Recreating workers, {}".format(action))
-                        kill_workers(workers)
-                        workers = run_from_global_config(updater)
+                        logger.warning("Reconciling workers, {}".format(action))
+                        workers = reconcile_workers(workers, updater)
                         checksum = SysUtil.get_checksum("{}.yml".format(hostname))
             except Exception as e:
                 logger.fatal(e)
@@ -643,7 +659,7 @@ if __name__ == "__main__":
                     checksum = SysUtil.get_checksum("{}.yml".format(hostname))
                 time.sleep(60 * 60 * 12)
             except (KeyboardInterrupt, SystemExit) as e:
-                kill_workers(workers)
+                kill_workers([worker for _, _, worker in workers.values()])
                 raise e
             except Exception as e:
                 logger.fatal(traceback.format_exc())
@@ -651,7 +667,7 @@ if __name__ == "__main__":
 
     except (KeyboardInterrupt, SystemExit):
         print("exiting...")
-        kill_workers(workers)
+        kill_workers([worker for _, _, worker in workers.values()])
         kill_workers([updater])
         sys.exit()
     except Exception as e:
@@ -0,0 +1,45 @@
+import numpy
+from threading import Lock
+
+
+class BufferPool(object):
+    """
+    Rotating pool of preallocated image arrays for one camera.
+
+    Buffers are handed out round robin, so a buffer is only handed out again after `count` other buffers have been.
+    Captured images are passed down the post-capture pipeline, so `count` should be more than the number of images
+    that can be in the pipeline at once.
+
+    A buffer is only reallocated when the requested shape or dtype changes (like when the resolution changes), so
+    steady state capture doesnt allocate any new large arrays.
+
+    :ivar int allocations: number of arrays allocated so far.
+    """
+
+    def __init__(self, count: int = 4):
+        """
+        :param count: number of buffers to rotate through
+        """
+        self._buffers = [None] * max(int(count), 1)
+        self._index = 0
+        self._lock = Lock()
+        self.allocations = 0
+
+    def get(self, shape: tuple, dtype=numpy.uint8) -> numpy.ndarray:
+        """
+        gets the next buffer in the rotation.
+
+        :param shape: shape of the array
+        :param dtype: numpy dtype of the array
+        :return: preallocated array, with undefined contents.
+        :rtype: numpy.ndarray
+        """
+        shape = tuple(int(x) for x in shape)
+        with self._lock:
+            self._index = (self._index + 1) % len(self._buffers)
+            buffer = self._buffers[self._index]
+            if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+                buffer = numpy.empty(shape, dtype=dtype)
+                self._buffers[self._index] = buffer
+                self.allocations += 1
+            return buffer
@@ -10,6 +10,8 @@ import numpy
 import requests
 import traceback
 import subprocess
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import zoneinfo, parser
 from libs.CryptUtil import SSHManager
 from requests.auth import HTTPBasicAuth, HTTPDigestAuth
@@ -19,7 +21,18 @@ from io import BytesIO
 import threading
 from threading import Thread, Event, Lock
 from libs.SysUtil import SysUtil
-import paho.mqtt.client as client
+from libs.Scheduler import CaptureScheduler
+from libs.Pipeline import Pipeline
+from libs.Encoder import ImageEncoder
+from libs.UploadJournal import UploadJournal
+from libs.Stream import StreamManager
+from libs.DeviceBroker import DeviceBroker
+from libs.BufferPool import BufferPool
+from libs.GPhotoSession import GPhotoSession, GPhotoError
+from libs.DSLRDiscovery import DSLRDiscovery
+from libs.MQTTSession import MQTTSession
+from libs.Telemetry import Telemetry
+from libs.Tracing import Tracer
 from paho.mqtt.publish import single
 from libs.SysUtil import recursive_update
 import json
@@ -48,11 +61,6 @@ except Exception as e:
     logging.error("Couldnt import picamera module, no picamera camera support: {}".format(str(e)))
     pass
 
-try:
-    import telegraf
-except Exception as e:
-    logging.error("Couldnt import pytelegraf module, no telemetry: {}".format(str(e)))
-
 
 class TwentyFourHourTimeParserInfo(parser.parserinfo):
     def validate(self, res):
@@ -108,6 +116,7 @@ class Camera(Thread):
     :cvar int default_height: 720: Default height of resuzed images.
     :cvar list file_types: ["CR2", "RAW", "NEF", "JPG", "JPEG", "PPM", "TIF", "TIFF"]: Supported output image types.
     :cvar list output_types: ["tif", "jpg"]: Output image types, ignored by GPCamera.
+    :cvar tuple restart_keys: Config keys that :func:`reconfigure` cant apply to a running camera.
 
     :ivar collections.deque communication_queue: Reference to a deque, or a deque.
     :ivar logging.Logger logger: Logger for each Camera.
@@ -122,61 +131,109 @@ class Camera(Thread):
     :ivar datetime.time begin_capture: Naive start time for capture.
     :ivar datetime.time end_capture: Naive end time for capture.
     :ivar datetime.datetime current_capture_time: When the capture process began.
+    :ivar libs.Pipeline.Pipeline pipeline: Post-capture pipeline, created when the thread is run.
     """
 
     accuracy = 3
     default_width, default_height = 1080, 720
     file_types = ["CR2", "RAW", "NEF", "JPG", "JPEG", "PPM", "TIF", "TIFF"]
     output_types = ["tif", 'jpg']
+    restart_keys = ("name", "output_dir", "disable_ram_spooling", "pipeline_queue_size")
+
+    # physical device streams are run on, cameras on the same device cant stream at the same time.
+    stream_device = None
+    # live stream frame source, None for cameras that cant be streamed.
+    # cameras that can override this with a classmethod generator that opens the camera and yields
+    # (channel, encoded frame) tuples until it is closed, closing the camera when it is.
+    stream_frames = None
+
+    def stream_source(self):
+        """
+        Gets the frame source for this cameras live stream, :func:`stream_frames` with this cameras device.
+
+        :return: callable returning an iterator of (channel, encoded frame), or None if the camera cant be streamed.
+        """
+        return self.stream_frames
 
-    _frame = None
-    _thread = None
-    _last_access = None
+    @property
+    def stream_channels(self) -> tuple:
+        """
+        channels produced by the frame source.
+        """
+        return None,
+
+    def capture_preempting_stream(self, filename: str = None) -> list:
+        """
+        Captures through the :class:`libs.DeviceBroker.DeviceBroker` for this cameras device, so that a live stream
+        on the same sensor (even in the webinterface process) briefly gives it up instead of the capture being
+        skipped.
+
+        :param filename: filename to pass to :func:`capture`
+        :return: list of files captured
+        :rtype: list
+        """
+        if self.stream_device is None:
+            return self.capture(filename=filename)
+        try:
+            with DeviceBroker.get_broker(self.stream_device).capture():
+                return self.capture(filename=filename)
+        except TimeoutError as e:
+            self.logger.critical("Live stream didnt release the camera, capture skipped: {}".format(str(e)))
+        return []
 
     def init_stream(self):
         """
-        Initialises a video stream class thread.
+        Registers this cameras live stream with the :class:`libs.Stream.StreamManager` and starts it.
+
+        :return: the running stream
+        :rtype: libs.Stream.Stream
+        :raises NotImplementedError: if this camera cant be streamed.
+        """
+        manager = StreamManager.get_manager()
+        if not manager.registered(self.identifier):
+            source = self.stream_source()
+            if source is None:
+                raise NotImplementedError("{} cant be live streamed".format(type(self).__name__))
+            manager.register(self.identifier, source, channels=self.stream_channels, device=self.stream_device)
+        return manager.open(self.identifier)
+
+    @property
+    def streaming(self) -> bool:
+        """
+        whether this cameras live stream is running.
         """
-        if self.__class__._thread is None:
-            # start background frame thread
-            self.__class__._thread = threading.Thread(target=self.stream_thread)
-            self.__class__._thread.start()
-            # wait until frames start to be available
-            while self.__class__._frame is None:
-                time.sleep(0.01)
+        return StreamManager.get_manager().is_streaming(self.identifier)
 
-    def get_frame(self) -> bytes:
+    def get_frame(self, channel=None) -> bytes:
         """
-        Gets a frame from the a running :func:`stream_thread`.
+        Gets the newest frame from this cameras live stream, waiting for the stream to start.
 
+        :param channel: channel to get the frame from.
         :return: encoded image data as bytes.
         """
-        self.__class__._last_access = time.time()
         self.init_stream()
-        return self.__class__._frame
+        return next(StreamManager.get_manager().frames(self.identifier, channel=channel))
 
-    @classmethod
-    def stream_thread(cls):
+    def iter_frames(self, channel=None, timeout: float = 5):
         """
-        Boilerplate stream thread.
-        Override this with the correct method of opening the camera, grabbing image data and closing the camera.
+        Yields each new frame from this cameras live stream once, blocking until it is available.
+        Restarts the stream if it has stopped.
+
+        :param channel: channel to get frames from.
+        :param timeout: seconds to wait for a frame before checking on the stream.
+        :return: generator of encoded frames
         """
-        print("Unimplemented classmethod call: stream_thread")
-        print("You should not create a Camera object directly")
+        self.init_stream()
+        return StreamManager.get_manager().frames(self.identifier, channel=channel, timeout=timeout)
 
-        def get_camera():
-            pass
+    def stream_stats(self) -> dict:
+        """
+        Gets the live stream metrics for this camera, see :func:`libs.Stream.StreamManager.stats`.
 
-        with get_camera() as camera:
-            # let camera warm up
-            while True:
-                # example, you actually need to get the data from somewhere.
-                cls._frame = camera.get_frame().read()
-                # if there hasn't been any clients asking for frames in
-                # the last 10 seconds stop the thread
-                if time.time() - cls._last_access > 10:
-                    break
-        cls._thread = None
+        :rtype: dict
+        """
+        self.init_stream()
+        return StreamManager.get_manager().stats(self.identifier)
 
     def __init__(self, identifier: str, config: dict = None, queue: deque = None,
                  noconf: bool = False,
@@ -200,17 +257,24 @@ class Camera(Thread):
         self.logger.info("init...")
 
         self.stopper = Event()
+        self._wakeup = Event()
+        self.pipeline = None
+        self.encoder = None
+        self.journal = UploadJournal.get_journal()
         self.identifier = identifier
         self.name = identifier
         self.failed = list()
         self._exif = dict()
         self.focus_position = None
         self._frame = None
-        self._image = numpy.empty((Camera.default_width, Camera.default_height, 3), numpy.uint8)
+        self._image = None
         self.config = dict()
         if config is not None:
             self.config = config.copy()
         self.name = self.config.get("name", identifier)
+        # one buffer for each image that can be in the post-capture pipeline, plus the one being captured.
+        self.buffers = BufferPool(int(self.config.get("pipeline_queue_size", 2)) + 3)
+        self.preview_buffers = BufferPool(1)
 
         self.interval = int(self.config.get("interval", 300))
         self.upload_directory = "/home/images/{}".format(str(self.identifier))
@@ -270,6 +334,40 @@ class Camera(Thread):
         global_conf['cameras'][self.identifier] = camera_conf
         SysUtil.write_global_config(global_conf)
 
+    def reconfigure(self, config: dict) -> bool:
+        """
+        applies a changed config section to the running camera, without restarting it.
+        Only the schedule and settings read at capture time can change like this, changes to any of
+        :attr:`restart_keys` need a new camera.
+
+        :param config: the new config section
+        :return: whether the config could be applied in place.
+        :rtype: bool
+        """
+        if any(config.get(k) != self.config.get(k) for k in self.restart_keys):
+            return False
+        if config.get("master_only", False) != self.config.get("master_only", False):
+            # the encoder is made on the first write, so the next write makes one with the new setting.
+            self.encoder = None
+        self.config = config.copy()
+        self.interval = int(self.config.get("interval", 300))
+        try:
+            self.begin_capture = parser.parse(str(self.config["starttime"]),
+                                              parserinfo=TwentyFourHourTimeParserInfo()).time()
+        except Exception as e:
+            self.logger.error("Time conversion error starttime - {}".format(str(e)))
+        try:
+            self.end_capture = parser.parse(str(self.config["stoptime"]),
+                                            parserinfo=TwentyFourHourTimeParserInfo()).time()
+        except Exception as e:
+            self.logger.error("Time conversion error stoptime - {}".format(str(e)))
+        self.logger.info("Reconfigured, capturing from {} to {} every {}s".format(self.begin_capture.strftime("%H:%M"),
+                                                                               self.end_capture.strftime("%H:%M"),
+                                                                               self.interval))
+        # wake the capture loop so that it picks up the new interval/start/stop times.
+        self._wakeup.set()
+        return True
+
     def mqtt_on_message(self, client, userdata, msg):
         """
         handler for mqtt messages on a per camera basis.
@@ -318,49 +416,31 @@ class Camera(Thread):
 
             data['upload'] = uploaddict
             self.set_config(data)
+            # wake the capture loop so that it picks up the new interval/start/stop times.
+            self._wakeup.set()
 
         if msg.topic == "camera/{}/capture".format(self.identifier):
             if payload == "CAPTURE_NOW":
                 self.capture_image(self.timestamped_imagename)
 
-    def mqtt_on_connect(self, client, *args):
-        self.mqtt.subscribe("camera/{}/config".format(self.identifier), qos=1)
-        self.mqtt.subscribe("camera/{}/operation".format(self.identifier), qos=1)
-
     def setupmqtt(self):
-        client_id = str(crc32(bytes(self.identifier, 'utf8')))
-        self.mqtt = client.Client(client_id=client_id,
-                                  clean_session=True,
-                                  protocol=client.MQTTv311,
-                                  transport="tcp")
-
-        self.mqtt.on_message = self.mqtt_on_message
-        self.mqtt.on_connect = self.mqtt_on_connect
-        try:
-            with open("mqttpassword") as f:
-                self.mqtt.username_pw_set(username=self.identifier,
-                                          password=f.read().strip())
-        except FileNotFoundError:
-            auth = SSHManager().sign_message_PSS(datetime.datetime.now().replace(tzinfo=timezone).isoformat())
-            if not auth:
-                raise ValueError
-            self.mqtt.username_pw_set(username=SysUtil.get_machineid(),
-                                      password=auth)
-        except:
-            self.mqtt.username_pw_set(username=self.identifier,
-                                      password="INVALIDPASSWORD")
-        self.mqtt.connect_async("10.9.0.1", port=1883)
-        self.mqtt.loop_start()
+        """
+        subscribes to this cameras topics on the process wide :class:`libs.MQTTSession.MQTTSession`.
+        """
+        self.mqtt = MQTTSession.get_session()
+        self.mqtt.subscribe("camera/{}/config".format(self.identifier), self.mqtt_on_message)
+        self.mqtt.subscribe("camera/{}/operation".format(self.identifier), self.mqtt_on_message)
+
+    def stopmqtt(self):
+        """
+        unsubscribes from this cameras topics, so a replacement camera doesnt get its messages twice.
+        """
+        self.mqtt.unsubscribe("camera/{}/config".format(self.identifier), self.mqtt_on_message)
+        self.mqtt.unsubscribe("camera/{}/operation".format(self.identifier), self.mqtt_on_message)
 
     def updatemqtt(self, msg: bytes):
-        # update mqtt
-        msg = self.mqtt.publish(payload=msg,
-                                topic="camera/{}/capture".format(self.identifier),
-                                qos=1)
-        time.sleep(0.5)
-        if not msg.is_published():
-            self.mqtt.loop_stop()
-            self.mqtt.loop_start()
+        # update mqtt, paho sends it from its own thread so dont wait for it.
+        self.mqtt.publish("camera/{}/capture".format(self.identifier), msg)
 
     def capture_image(self, filename: str = None) -> numpy.array:
         """
@@ -486,6 +566,22 @@ class Camera(Thread):
         return '{camera_name}_{timestamp}'.format(camera_name=self.name,
                                                   timestamp=Camera.timestamp(self.current_capture_time))
 
+    def in_capture_window(self, t: datetime.time) -> bool:
+        """
+        Checks whether a naive time is between the start and stop capture times.
+        Handles capturing across midnight, where the start time is greater than the stop time.
+
+        :param t: naive time to check
+        :return: whether the time is inside the capture window
+        :rtype: bool
+        """
+        if self.begin_capture < self.end_capture:
+            # where the start capture time is less than the end capture time
+            return self.begin_capture <= t <= self.end_capture
+        # where the start capture time is greater than the end capture time
+        # i.e. capturing across midnight.
+        return not (self.end_capture < t < self.begin_capture)
+
     @property
     def time_to_capture(self) -> bool:
         """
@@ -498,23 +594,40 @@ class Camera(Thread):
         :return: whether or not it is time to capture
         :rtype: bool
         """
-        current_naive_time = self.current_capture_time.time()
-
-        if self.begin_capture < self.end_capture:
-            # where the start capture time is less than the end capture time
-            if not self.begin_capture <= current_naive_time <= self.end_capture:
-                return False
-        else:
-            # where the start capture time is greater than the end capture time
-            # i.e. capturing across midnight.
-            if self.end_capture <= current_naive_time <= self.begin_capture:
-                return False
+        if not self.in_capture_window(self.current_capture_time.time()):
+            return False
 
         # capture interval
         if not (self.time2seconds(self.current_capture_time) % self.interval < Camera.accuracy):
             return False
         return True
 
+    def next_capture_time(self, after: datetime.datetime) -> datetime.datetime:
+        """
+        Calculates the next capture deadline strictly after a datetime.
+
+        Deadlines are aligned to multiples of the interval since the epoch (the same points in time that
+        :func:`time_to_capture` matches) and fall inside the start/stop capture window, wrapping around midnight.
+
+        :param after: datetime to find the next capture after
+        :return: the next time a capture should happen
+        :rtype: datetime.datetime
+        """
+        interval = max(int(self.interval), 1)
+        t = (int(after.timestamp()) // interval + 1) * interval
+        # a week of window starts is more than enough to find a capture, unless the window is smaller than the interval
+        for _ in range(8):
+            candidate = datetime.datetime.fromtimestamp(t)
+            if self.in_capture_window(candidate.time()):
+                return candidate
+            # skip forward to the start of the next capture window.
+            window_start = datetime.datetime.combine(candidate.date(), self.begin_capture)
+            if window_start <= candidate:
+                window_start += datetime.timedelta(days=1)
+            t = -(-int(window_start.timestamp()) // interval) * interval
+        self.logger.warning("No interval aligned capture inside the capture window, capturing at window start.")
+        return datetime.datetime.combine(after.date() + datetime.timedelta(days=1), self.begin_capture)
+
     @property
     def time_to_report(self) -> bool:
         """
@@ -551,33 +664,22 @@ class Camera(Thread):
         converts from rgb to bgr for cv2 so that the images save correctly
         also tries to add exif data to the images
 
+        Encoding is done by :class:`libs.Encoder.ImageEncoder`, which writes each format once with its exif data,
+        in parallel. If the config sets `master_only`, only the lossless master is written, and the other formats
+        are derived from it when it is uploaded, see :attr:`libs.Uploader.Uploader.derive_types`.
+
         :param numpy.array np_image_array: 3 dimensional image array, x,y,rgb
         :param str fn: filename
         :return: files successfully written.
         :rtype: list(str)
         """
         # output types must be valid!
-        fnp = os.path.splitext(fn)[0]
-        successes = list()
-        for ext in Camera.output_types:
-            fn = "{}.{}".format(fnp, ext)
-            s = cv2.imwrite(fn, np_image_array)
-            if s:
-                successes.append(fn)
-                try:
-                    # set exif data
-                    import pyexiv2
-                    meta = pyexiv2.ImageMetadata(fn)
-                    meta.read()
-                    for k, v in self.exif.items():
-                        try:
-                            meta[k] = v
-                        except:
-                            pass
-                    meta.write()
-                except Exception as e:
-                    self.logger.debug("Couldnt write the appropriate metadata: {}".format(str(e)))
-        return successes
+        if self.encoder is None:
+            self.encoder = ImageEncoder(Camera.output_types,
+                                        master_only=self.config.get("master_only", False),
+                                        logger=self.logger,
+                                        trace_key=self.identifier)
+        return self.encoder.write(np_image_array, fn, exif=dict(self.exif))
 
     @staticmethod
     def _write_raw_bytes(image_bytesio: BytesIO, fn: str) -> list:
@@ -598,6 +700,8 @@ class Camera(Thread):
         Stops the capture thread, if self is an instance of :class:`threading.Thread`.
         """
         self.stopper.set()
+        self._wakeup.set()
+        self.stopmqtt()
 
     def focus(self):
         """
@@ -628,109 +732,209 @@ class Camera(Thread):
     def run(self):
         """
         Main method. continuously captures and stores images.
+
+        Sleeps on the process wide :class:`libs.Scheduler.CaptureScheduler` until the next capture deadline, rather
+        than waking up every second to check :func:`time_to_capture`.
+
+        Only the capture happens on this thread, the rest is handed to a :class:`libs.Pipeline.Pipeline`
+        (preview render -> persist -> hand-off) so that a slow encode or move doesnt hold up the next capture.
         """
+        scheduler = CaptureScheduler.get_scheduler()
+        tracer = Tracer.get_tracer()
+        self.pipeline = self._make_pipeline()
+        deadline = None
         while True and not self.stopper.is_set():
-            self.current_capture_time = datetime.datetime.now()
+            now = datetime.datetime.now()
+            if deadline is not None and now > self.next_capture_time(self.current_capture_time):
+                self.logger.warning("Missed capture after {}, capture overran the interval".format(
+                    self.current_capture_time.isoformat()))
+            deadline = self.next_capture_time(max(self.current_capture_time, now))
+            jitter = scheduler.wait_until(deadline.timestamp(), self._wakeup)
+            if self.stopper.is_set():
+                break
+            if jitter < 0:
+                # woken early, by a config change, recalculate the deadline.
+                continue
+            self.current_capture_time = deadline
+            self.logger.debug("Scheduling jitter {0:.3f}s".format(jitter))
+            tracer.record(self.identifier, "schedule_wake", jitter)
             # checking if enabled and other stuff
-            if self.__class__._thread is not None:
-                self.logger.critical("Camera live view thread is not closed, camera lock cannot be acquired.")
+            if self.pipeline.saturated:
+                # backpressure, the post-capture stages cant keep up so skip this capture rather than stall.
+                self.logger.warning("Post-capture pipeline is full, skipping capture. {}".format(
+                    str(self.pipeline.stats())))
+                self.failed.append(self.current_capture_time)
                 continue
-            last_captured_b = b''
-            if self.time_to_capture:
-                telemetry = dict()
-                try:
-                    with tempfile.TemporaryDirectory(prefix=self.name) as spool:
-                        self.spool_directory = spool
-                        start_capture_time = time.time()
-                        raw_image = self.timestamped_imagename
-                        files = []
-                        if self.config.get("capture", True):
-                            self.logger.info("Capturing for {}".format(self.identifier))
-                            files = self.capture(filename=os.path.join(spool, raw_image))
-                            # capture. if capture didnt happen dont continue with the rest.
-                            if len(files) == 0:
-                                self.failed.append(self.current_capture_time)
-                                continue
-
-                            telemetry["timing_capture_s"] = float(time.time() - start_capture_time)
-
-                            st = time.time()
-                            resize_t = 0.0
-                            if self.config.get("resize_last", False):
-                                self._image = cv2.resize(self._image, (Camera.default_width, Camera.default_height),
-                                                         interpolation=cv2.INTER_NEAREST)
-                                resize_t = time.time() - st
-
-                            cv2.putText(self._image,
-                                        self.timestamped_imagename,
-                                        org=(20, self._image.shape[0] - 20),
-                                        fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                                        fontScale=1,
-                                        color=(0, 0, 255),
-                                        thickness=2,
-                                        lineType=cv2.LINE_AA)
-
-                            cv2.imwrite(os.path.join("/dev/shm", self.identifier + ".jpg"), self._image)
-                            shutil.copy(os.path.join("/dev/shm", self.identifier + ".jpg"),
-                                        os.path.join(self.upload_directory, "last_image.jpg"))
-                            telemetry["timing_resize_s"] = float(resize_t)
-                            self.logger.info("Resize {0:.3f}s, total: {0:.3f}s".format(resize_t, time.time() - st))
-
-                            # copying/renaming for files
-                            oldfiles = files[:]
-                            files = []
-
-                            for fn in oldfiles:
-                                if type(fn) is list:
-                                    files.extend(fn)
-                                else:
-                                    files.append(fn)
-                        try:
-                            telemetry["num_files_created"] = len(files)
-                        except:
-                            pass
-                        for fn in files:
-                            # move files to the upload directory
-                            try:
-                                if self.config.get("capture_timelapse", False):
-                                    shutil.move(fn, self.upload_directory)
-                                    self.logger.info("Captured & stored for upload - {}".format(os.path.basename(fn)))
-                            except Exception as e:
-                                self.logger.error("Couldn't move for timestamped: {}".format(str(e)))
-
-                            # remove the spooled files that remain
-                            try:
-                                if os.path.isfile(fn):
-                                    self.logger.info("File remaining in spool directory, removing: {}".format(fn))
-                                    os.remove(fn)
-                            except Exception as e:
-                                self.logger.error("Couldn't remove spooled when it still exists: {}".format(str(e)))
-                        # log total capture time
-                        total_capture_time = time.time() - start_capture_time
-                        self.logger.info("Total capture time: {0:.2f}s".format(total_capture_time))
-                        telemetry["timing_total_s"] = float(total_capture_time)
-                        # communicate our success with the updater
-                        try:
-                            telegraf_client = telegraf.TelegrafClient(host="localhost", port=8092)
-                            telegraf_client.metric("camera", telemetry, tags={"camera_name": self.name})
-                            self.logger.debug("Communicated sesor data to telegraf")
-                        except Exception as exc:
-                            self.logger.error("Couldnt communicate with telegraf client. {}".format(str(exc)))
-
-                        last_captured_b = bytes(self.current_capture_time.replace(tzinfo=timezone).isoformat(), 'utf-8')
-                        # self.communicate_with_updater()
-                        # sleep for a little bit so we dont try and capture again so soon.
-                        time.sleep(Camera.accuracy * 2)
-                except Exception as e:
-                    self.logger.critical("Image Capture error - {}".format(str(e)))
-                    self.logger.critical(traceback.format_exc())
-            if self.time_to_report:
+            telemetry = dict(timing_jitter_s=float(jitter))
+            spool = None
+            try:
+                spool = tempfile.mkdtemp(prefix=self.name)
+                self.spool_directory = spool
+                start_capture_time = time.time()
+                raw_image = self.timestamped_imagename
+                files = []
+                image = None
+                if self.config.get("capture", True):
+                    self.logger.info("Capturing for {}".format(self.identifier))
+                    with tracer.span(self.identifier, "capture"):
+                        files = self.capture_preempting_stream(filename=os.path.join(spool, raw_image))
+                    # capture. if capture didnt happen dont continue with the rest.
+                    if len(files) == 0:
+                        self.failed.append(self.current_capture_time)
+                        shutil.rmtree(spool, ignore_errors=True)
+                        continue
+
+                    telemetry["timing_capture_s"] = float(time.time() - start_capture_time)
+                    image = self._image
+
+                    # copying/renaming for files
+                    oldfiles = files[:]
+                    files = []
+
+                    for fn in oldfiles:
+                        if type(fn) is list:
+                            files.extend(fn)
+                        else:
+                            files.append(fn)
                 try:
-                    if last_captured_b:
-                        self.updatemqtt(last_captured_b)
+                    telemetry["num_files_created"] = len(files)
                 except:
                     pass
-            time.sleep(1)
+                job = dict(capture_time=self.current_capture_time,
+                           name=raw_image,
+                           image=image,
+                           files=files,
+                           spool=spool,
+                           start_time=start_capture_time,
+                           telemetry=telemetry)
+                if not self.pipeline.submit(job):
+                    self.logger.warning("Post-capture pipeline filled up during capture, waiting.")
+                    self.pipeline.stages[0].put(job)
+            except Exception as e:
+                self.logger.critical("Image Capture error - {}".format(str(e)))
+                self.logger.critical(traceback.format_exc())
+                if spool:
+                    shutil.rmtree(spool, ignore_errors=True)
+        self.pipeline.stop()
+
+    def _make_pipeline(self) -> Pipeline:
+        """
+        creates the post-capture pipeline (preview render -> persist -> hand-off) that :func:`run` submits
+        capture jobs to.
+
+        :return: started pipeline
+        :rtype: libs.Pipeline.Pipeline
+        """
+        return Pipeline(self.identifier,
+                        [("preview", self._render_preview),
+                         ("persist", self._persist),
+                         ("handoff", self._hand_off)],
+                        maxsize=int(self.config.get("pipeline_queue_size", 2)),
+                        logger=self.logger,
+                        trace_key=self.identifier)
+
+    def _render_preview(self, job: dict) -> dict:
+        """
+        Post-capture pipeline stage.
+        Resizes (if configured) and timestamps the captured image, and writes it out as last_image.jpg
+
+        :param job: capture job from :func:`run`
+        :return: the same job, for the next stage.
+        :rtype: dict
+        """
+        image = job['image']
+        if image is None:
+            return job
+        tracer = Tracer.get_tracer()
+        st = time.time()
+        resize_t = 0.0
+        if self.config.get("resize_last", False):
+            image = cv2.resize(image, (Camera.default_width, Camera.default_height),
+                               dst=self.preview_buffers.get((Camera.default_height, Camera.default_width) +
+                                                            image.shape[2:], image.dtype),
+                               interpolation=cv2.INTER_NEAREST)
+            resize_t = time.time() - st
+
+        cv2.putText(image,
+                    job['name'],
+                    org=(20, image.shape[0] - 20),
+                    fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                    fontScale=1,
+                    color=(0, 0, 255),
+                    thickness=2,
+                    lineType=cv2.LINE_AA)
+        tracer.record(self.identifier, "overlay", time.time() - st)
+
+        with tracer.span(self.identifier, "preview_write"):
+            cv2.imwrite(os.path.join("/dev/shm", self.identifier + ".jpg"), image)
+            shutil.copy(os.path.join("/dev/shm", self.identifier + ".jpg"),
+                        os.path.join(self.upload_directory, "last_image.jpg"))
+        self.journal.add(os.path.join(self.upload_directory, "last_image.jpg"), self.upload_directory)
+        job['telemetry']["timing_resize_s"] = float(resize_t)
+        self.logger.info("Resize {0:.3f}s, total: {1:.3f}s".format(resize_t, time.time() - st))
+        # drop the reference so the image can be freed before the slower stages are done.
+        job['image'] = None
+        return job
+
+    def _persist(self, job: dict) -> dict:
+        """
+        Post-capture pipeline stage.
+        Moves the captured files out of the spool and into the upload directory, recording them in the upload
+        journal, and cleans up the spool.
+
+        :param job: capture job from :func:`run`
+        :return: the same job, for the next stage.
+        :rtype: dict
+        """
+        st = time.time()
+        for fn in job['files']:
+            # move files to the upload directory
+            try:
+                if self.config.get("capture_timelapse", False):
+                    shutil.move(fn, self.upload_directory)
+                    self.journal.add(os.path.join(self.upload_directory, os.path.basename(fn)),
+                                     self.upload_directory)
+                    self.logger.info("Captured & stored for upload - {}".format(os.path.basename(fn)))
+            except Exception as e:
+                self.logger.error("Couldn't move for timestamped: {}".format(str(e)))
+
+            # remove the spooled files that remain
+            try:
+                if os.path.isfile(fn):
+                    self.logger.info("File remaining in spool directory, removing: {}".format(fn))
+                    os.remove(fn)
+            except Exception as e:
+                self.logger.error("Couldn't remove spooled when it still exists: {}".format(str(e)))
+        shutil.rmtree(job['spool'], ignore_errors=True)
+        Tracer.get_tracer().record(self.identifier, "move", time.time() - st)
+        return job
+
+    def _hand_off(self, job: dict):
+        """
+        Post-capture pipeline stage.
+        Reports the capture to telegraf and mqtt, along with the metrics for each pipeline stage and the span
+        latency percentiles from :class:`libs.Tracing.Tracer`.
+
+        :param job: capture job from :func:`run`
+        """
+        telemetry = job['telemetry']
+        # log total capture time
+        total_capture_time = time.time() - job['start_time']
+        self.logger.info("Total capture time: {0:.2f}s".format(total_capture_time))
+        telemetry["timing_total_s"] = float(total_capture_time)
+        for stage_name, stage_stats in self.pipeline.stats().items():
+            telemetry["pipeline_{}_queue_depth".format(stage_name)] = int(stage_stats['queue_depth'])
+            telemetry["pipeline_{}_latency_s".format(stage_name)] = float(stage_stats['latency_s'])
+        # queue it for telegraf, sent from the telemetry thread.
+        Telemetry.get_telemetry().metric("camera", telemetry, tags={"camera_name": self.name})
+
+        try:
+            self.updatemqtt(bytes(job['capture_time'].replace(tzinfo=timezone).isoformat(), 'utf-8'))
+        except:
+            pass
+        # latency percentiles for the web interface and mqtt.
+        spans = Tracer.get_tracer().publish().get(self.identifier, dict())
+        self.mqtt.publish("camera/{}/spans".format(self.identifier), bytes(json.dumps(spans), 'utf-8'))
 
 
 class IPCamera(Camera):
@@ -776,7 +980,7 @@ class IPCamera(Camera):
             self.logger.error("Time conversion error stoptime - {}".format(str(e)))
 
         self.failed = list()
-        self._image = numpy.empty((Camera.default_width, Camera.default_height, 3), numpy.uint8)
+        self._image = numpy.empty((Camera.default_height, Camera.default_width, 3), numpy.uint8)
 
         try:
             if not os.path.exists(self.upload_directory):
@@ -1036,7 +1240,7 @@ class IPCamera(Camera):
             try:
                 # fast method
                 a = self._read_stream_raw(cmd)
-                b = numpy.fromstring(a, numpy.uint8)
+                b = numpy.frombuffer(a, numpy.uint8)
                 self._image = cv2.imdecode(b, cv2.IMREAD_COLOR)
                 if filename:
                     rfiles = self.encode_write_np_array(self._image, filename)
@@ -1291,7 +1495,7 @@ class GPCamera(Camera):
         self.usb_address = [None, None]
         self._serialnumber = identifier
         self.identifier = identifier
-        if type(usb_address) is tuple and len(usb_address) is 2 and self.usb_address[0] is not None:
+        if type(usb_address) is tuple and len(usb_address) == 2 and usb_address[0] is not None:
             self.usb_address = usb_address
         else:
             self.usb_address = self.usb_address_detect()
@@ -1306,62 +1510,16 @@ class GPCamera(Camera):
 
     def usb_address_detect(self):
         """
+        finds the usb port of this camera from the shared :class:`libs.DSLRDiscovery.DSLRDiscovery` map, which only
+        probes ports it hasnt seen before.
 
-        :return:
+        :return: (bus, addr) of the camera, or None if it isnt connected.
+        :rtype: tuple(int, int)
         """
-
-        detect_ret = subprocess.check_output(["/usr/bin/gphoto2",
-                                              "--auto-detect"],
-                                             universal_newlines=True)
-        detected_usb_ports = re.findall(r'usb:(\d+),(\d+)', detect_ret)
-        for bus, addr in detected_usb_ports:
-            try:
-                # findall returns strings...
-                bus, addr = int(bus), int(addr)
-                # this is the format that gphoto2 expects the port to be in.
-                port = "usb:{},{}".format(bus, addr)
-
-
-                # gphoto2 command to get the serial number for the DSLR
-                # WARNING: when the port here needs to be correct, because otherwise gphoto2 will return values from
-                # an arbitrary camera
-                sn_detect_ret = subprocess.check_output(['/usr/bin/gphoto2',
-                                                         '--port={}'.format(port),
-                                                         '--get-config=serialnumber'],
-                                                        universal_newlines=True)
-
-                # Match the serial number.
-                # this regex can also be used to parse the values from --get-config as all results are returned like this:
-                # Label: Serial Number
-                # Type: TEXT
-                # Current: 4fffa81fed8f40d286a63fce62598ef0
-                sn_match = re.search(r'Current: (\w+)', sn_detect_ret)
-
-                if not sn_match:
-                    # we didnt match any output from the command
-                    self.logger.error("Couldnt match serial number from gphoto2 output. {}".format(port))
-                    continue
-                sn = sn_match.group(1)
-
-                if sn.lower() == 'none':
-                    # there is a bug in a specific version of gphoto2 that causes it to return 'None' for the camera serial
-                    # number. If we cant get a unique serial number, we are screwed for multicamera
-                    # todo: allow this if there is only one camera.
-                    self.logger.error("serial number matched with value of 'none' {}".format(port))
-                    continue
-
-                # pad the serialnumber to 32
-                identifier = SysUtil.default_identifier(prefix=sn)
-                if self.identifier == identifier:
-                    return (bus, addr)
-
-            except:
-                traceback.print_exc()
-                self.logger.error("Exception detecting gphoto2 camera")
-                self.logger.error(traceback.format_exc())
-        else:
-            self.logger.error("No identifier from detected cameras ({}) matched desired: {}".format(len(detected_usb_ports),self.identifier))
-            return None
+        address = DSLRDiscovery.get_discovery().find(self.identifier)
+        if address is None:
+            self.logger.error("No identifier from detected cameras matched desired: {}".format(self.identifier))
+        return address
 
     def _self_detect_cffi(self):
         """
@@ -1425,13 +1583,105 @@ class GPCamera(Camera):
     #         self.logger.warning("Couldnt get full exif data. {}".format(str(e)))
     #     return exif
 
+    @property
+    def usb_port(self) -> str:
+        """
+        the gphoto2 port string for this cameras usb address, or None if the address isnt known.
+        """
+        if self.usb_address is None:
+            return None
+        return GPhotoSession.port_for(*self.usb_address)
+
+    @property
+    def session(self) -> GPhotoSession:
+        """
+        the long lived gphoto2 session for this cameras usb port, or None if the address isnt known.
+        """
+        port = self.usb_port
+        if port is None:
+            return None
+        return GPhotoSession.get_session(port)
+
+    def close_session(self):
+        """
+        closes the gphoto2 session for this cameras usb port, releasing the camera.
+        """
+        port = self.usb_port
+        if port is not None:
+            GPhotoSession.close_session(port)
+
+    def run(self):
+        """
+        runs the camera thread, closing the gphoto2 session when it stops.
+        """
+        try:
+            super(GPCamera, self).run()
+        finally:
+            self.close_session()
+
     def capture_image(self, filename=None):
         """
         Gapture method for DSLRs.
         Some contention exists around this method, as its definitely not the easiest thing to have operate robustly.
         :func:`GPCamera._cffi_capture` is how it _should_ be done, however that method is unreliable and causes many
         crashes when in real world timelapse situations.
-        This method calls gphoto2 directly, which makes us dependent on gphoto2 (not just libgphoto2 and gphoto2-cffi),
+        This method drives a long lived `gphoto2 --shell` for the camera (see :class:`libs.GPhotoSession.GPhotoSession`),
+        so the PTP session isnt reopened every capture. If the shell keeps failing this falls back to
+        :func:`GPCamera._cli_capture`.
+
+        :param filename: filename without extension to capture to.
+        :return: list of filenames (of captured images) if filename was specified, otherwise a numpy array of the image.
+        :rtype: numpy.array or list
+        """
+        name = filename or "{}-temp".format(self.name)
+        timeout = self.config.get("capture_timeout", 60)
+        self.logger.debug("Capture start: {}".format(name))
+        for tries in range(3):
+            session = self.session
+            if session is None:
+                self.logger.error("No usb address for the gphoto2 session")
+                break
+            # the shell downloads with the camera filenames, so capture into an empty directory and rename.
+            target_dir = tempfile.mkdtemp(dir=self.spool_directory)
+            try:
+                # capture to sdram, must capture & download in the same command to use sdram target.
+                session.set_config("capturetarget", 0)
+                captured = session.capture(target_dir, timeout=timeout)
+                filenames = []
+                for fp in captured:
+                    fn = os.path.join(self.spool_directory, name + os.path.splitext(fp)[-1])
+                    shutil.move(fp, fn)
+                    filenames.append(fn)
+                if not len(filenames):
+                    self.logger.error("capture resulted in no files.")
+                    continue
+                self.logger.info("GPCamera capture success: {}".format(name))
+                # try and load an image for the last_image.jpg resized doodadery
+                try:
+                    with Tracer.get_tracer().span(self.identifier, "decode"):
+                        self._image = cv2.cvtColor(cv2.imread(filenames[0], cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+                except Exception as e:
+                    self.logger.error("Failed to set current image: {}".format(str(e)))
+                if filename:
+                    return filenames
+                # otherwise remove the temporary files that we created in order to fill self._image
+                for fp in filenames:
+                    os.remove(fp)
+                return self._image
+            except GPhotoError as e:
+                self.logger.error("failed {} times: {}".format(tries, str(e)))
+            finally:
+                shutil.rmtree(target_dir, ignore_errors=True)
+
+        self.logger.error("gphoto2 session failed, capturing with a new gphoto2 process")
+        # the shell still has the camera claimed, the new process cant open it until the shell is gone.
+        self.close_session()
+        return self._cli_capture(filename)
+
+    def _cli_capture(self, filename=None):
+        """
+        capture method spawning a gphoto2 process for each capture.
+        This calls gphoto2 directly, which makes us dependent on gphoto2 (not just libgphoto2 and gphoto2-cffi),
         and there is probably some issue with calling gphoto2 at the same time like 5 times, maybe dont push it.
 
         :param filename: filename without extension to capture to.
@@ -1605,23 +1855,20 @@ class GPCamera(Camera):
         :return: value
         """
 
-        config_detect_ret = subprocess.check_output(['/usr/bin/gphoto2',
-                                                 '--port={}:{}'.format(*self.usb_address),
-                                                 '--get-config={}'.format(field)],
-                                                universal_newlines=True)
-
-        # Match the serial number.
-        # this regex can also be used to parse the values from --get-config as all results are returned like this:
-        # Label: Serial Number
-        # Type: TEXT
-        # Current: 4fffa81fed8f40d286a63fce62598ef0
-        config_match = re.search(r'Current: (.*)$', config_detect_ret)
+        session = self.session
+        if session is None:
+            self.logger.error("Couldnt get config property {}, no usb address".format(field))
+            return None
+        try:
+            value = session.get_config(field)
+        except GPhotoError as e:
+            self.logger.error("Couldnt get config property {}: {}".format(field, str(e)))
+            return None
 
-        if not config_match:
+        if value is None:
             # we didnt match any output from the command
             self.logger.error("Couldnt match config property from gphoto2 output. {}:{}".format(*self.usb_address))
-            return None
-        return config_match.group(1)
+        return value
 
 
 class USBCamera(Camera):
@@ -1630,35 +1877,41 @@ class USBCamera(Camera):
     """
 
     @classmethod
-    def stream_thread(cls):
+    def stream_frames(cls, sys_number: int = 0):
         """
-        usb camera stream thread.
-        TODO: Needs to be aware of multiple cameras.
+        usb camera live stream frame source.
+
+        :param sys_number: system device number of the webcam (the 0 from /dev/video0)
+        :return: generator of (None, encoded jpeg)
         """
-        print("ThreadStartup ...")
         cam = cv2.VideoCapture()
+        try:
+            if not cam.open(int(sys_number)):
+                raise IOError("VideoCapture().open({}) failed.".format(sys_number))
+            # let camera warm up
+            time.sleep(2)
+            cam.set(3, 30000)
+            cam.set(4, 30000)
+            while True:
+                ret, frame = cam.read()
+                if not ret:
+                    raise IOError("Couldnt read a frame from /dev/video{}".format(sys_number))
+                yield None, cv2.imencode(".jpg", frame)[1].tobytes()
+        finally:
+            cam.release()
 
-        # camera setup
-        # let camera warm up
-        time.sleep(2)
-        cam.set(3, 30000)
-        cam.set(4, 30000)
-
-        print("Started up!")
-        # for foo in camera.capture_continuous(stream, 'jpeg',
-        #                                      use_video_port=True):
-        while True:
-            ret, frame = cam.read()
-            frame = cv2.imencode(".jpg", frame)
-            cls._frame = frame[1].tostring()
-            # store frame
-
-            # if there hasn't been any clients asking for frames in
-            # the last 10 seconds stop the thread
-            if time.time() - cls._last_access > 10:
-                print("ThreadShutdown")
-                break
-        cls._thread = None
+    def stream_source(self):
+        """
+        streams from this cameras webcam.
+        """
+        return functools.partial(self.stream_frames, self.sys_number)
+
+    @property
+    def stream_device(self) -> str:
+        """
+        webcams are identified by their video4linux device.
+        """
+        return "video{}".format(self.sys_number)
 
     def __init__(self, identifier: str, sys_number: int, **kwargs):
         """
@@ -1673,6 +1926,7 @@ class USBCamera(Camera):
         # only webcams have a v4l sys_number.
         self.sys_number = int(sys_number)
         self.video_capture = None
+        self._frame_shape = None
         try:
             self.video_capture = cv2.VideoCapture()
         except Exception as e:
@@ -1700,7 +1954,7 @@ class USBCamera(Camera):
             self.video_capture.release()
         except Exception as e:
             self.logger.error("Couldnt release cv2 device {}".format(str(e)))
-        self.stopper.set()
+        super(USBCamera, self).stop()
 
     def _assert_capture_device(self):
         """
@@ -1731,9 +1985,12 @@ class USBCamera(Camera):
         st = time.time()
         for _ in range(50):
             try:
-                ret, im = self.video_capture.read()
+                # read straight into a pooled buffer once the frame size is known.
+                buffer = self.buffers.get(self._frame_shape) if self._frame_shape else None
+                ret, im = self.video_capture.read(buffer)
                 if ret:
                     self._image = im
+                    self._frame_shape = im.shape
                     break
                 time.sleep(0.1)
             except Exception as e:
@@ -1759,49 +2016,127 @@ class PiCamera(Camera):
     Picamera extension to the Camera abstract class.
     """
 
-    @classmethod
-    def stream_thread(cls):
+    stream_device = "picamera"
+
+    _session = None
+    _session_raw = None
+    _session_settings = None
+
+    @property
+    def persistent_session(self) -> bool:
+        """
+        whether to keep the camera open between captures, from camera/persistent_session in the config.
+        defaults to on for intervals of a minute or less, where warming up the camera would take most of each capture.
         """
-        Streaming thread member.
+        if type(self.config) is not dict:
+            return False
+        return bool(self.config.get("persistent_session", self.interval <= 60))
 
-        uses :func:`picamera.PiCamera.capture_continuous` to stream data from the rpi camera video port.
+    def _open_session(self):
+        """
+        opens the camera for a persistent session, letting it settle once.
+        exposure and white balance are then locked (unless camera/lock_exposure is off) so that every frame in the
+        session matches.
+        """
+        camera = picamera.PiCamera()
+        try:
+            with Tracer.get_tracer().span(self.identifier, "warmup"):
+                time.sleep(2)  # Camera warm-up time
+                self.set_camera_settings(camera)
+                time.sleep(0.2)
+            if self.config.get("lock_exposure", True):
+                camera.exposure_mode = 'off'
+                gains = camera.awb_gains
+                camera.awb_mode = 'off'
+                camera.awb_gains = gains
+            w, h = camera.resolution
+            # the gpu pads rgb captures to a multiple of 32 wide and 16 high.
+            self._session_raw = numpy.empty((-(-h // 16) * 16, -(-w // 32) * 32, 3), dtype=numpy.uint8)
+            self._session = camera
+            self._session_settings = self._settings_key()
+            self.logger.info("Opened persistent picamera session")
+        except:
+            camera.close()
+            raise
 
-        :func:`time.sleep` added to rate limit a little bit.
+    def _settings_key(self) -> tuple:
+        """
+        the settings a persistent session was opened with, it is reopened when they change.
+        """
+        return (getattr(self, "width", None), getattr(self, "height", None), getattr(self, "shutter_speed", None),
+                getattr(self, "iso", None), self.config.get("lock_exposure", True))
 
+    def close_session(self):
         """
-        import picamera
-        print("start thread")
+        closes the persistent camera session, if there is one.
+        """
+        if self._session is None:
+            return
         try:
-            with picamera.PiCamera() as camera:
-                # camera setup
-                camera.resolution = (640, 480)
-                # camera.hflip = True
-                # camera.vflip = True
+            self._session.close()
+        except Exception as e:
+            self.logger.error("Couldnt close picamera session: {}".format(str(e)))
+        self._session = None
+        self._session_raw = None
+        self.logger.info("Closed persistent picamera session")
 
-                # let camera warm up
-                camera.start_preview()
-                time.sleep(2)
+    def _capture_session(self):
+        """
+        captures into :attr:`_image` with the persistent session, opening it if needed.
+        the camera captures into a preallocated raw buffer, which is converted into a pooled buffer, so no large arrays
+        are allocated.
+        The session is closed if a live stream wants the camera, and reopened by the next capture.
+        """
+        if self._session is not None and self._session_settings != self._settings_key():
+            # settings changed, from mqtt or the config, they only apply to a new session.
+            self.close_session()
+        try:
+            if self._session is None or self._session.closed:
+                self._open_session()
+            w, h = self._session.resolution
+            self._session.capture(self._session_raw, 'rgb')
+            self._image = cv2.cvtColor(self._session_raw[:h, :w], cv2.COLOR_BGR2RGB,
+                                       dst=self.buffers.get((h, w, 3)))
+        except:
+            # start from a fresh session next time.
+            self.close_session()
+            raise
+        if DeviceBroker.get_broker(self.stream_device).stream_requested:
+            self.close_session()
 
-                stream = BytesIO()
-                for foo in camera.capture_continuous(stream, 'jpeg',
-                                                     use_video_port=True):
-                    # store frame
-                    stream.seek(0)
-                    cls._frame = stream.read()
+    def run(self):
+        """
+        runs the camera thread, closing the persistent camera session when it stops.
+        """
+        try:
+            super(PiCamera, self).run()
+        finally:
+            self.close_session()
 
-                    # reset stream for next frame
-                    stream.seek(0)
-                    stream.truncate()
+    @classmethod
+    def stream_frames(cls):
+        """
+        picamera live stream frame source.
 
-                    # if there hasn't been any clients asking for frames in
-                    # the last 10 seconds stop the thread
-                    time.sleep(0.01)
-                    if time.time() - cls._last_access > 1:
-                        break
-        except Exception as e:
-            print("Couldnt acquire camera")
-        print("Closing Thread")
-        cls._thread = None
+        uses :func:`picamera.PiCamera.capture_continuous` to stream data from the rpi camera video port.
+
+        :return: generator of (None, encoded jpeg)
+        """
+        import picamera
+        with picamera.PiCamera() as camera:
+            # camera setup
+            camera.resolution = (640, 480)
+
+            # let camera warm up
+            camera.start_preview()
+            time.sleep(2)
+
+            stream = BytesIO()
+            for foo in camera.capture_continuous(stream, 'jpeg', use_video_port=True):
+                yield None, stream.getvalue()
+                # reset stream for next frame
+                stream.seek(0)
+                stream.truncate()
 
     def set_camera_settings(self, camera):
         """
@@ -1847,15 +2182,18 @@ class PiCamera(Camera):
         """
         st = time.time()
         try:
-            with picamera.PiCamera() as camera:
-                with picamera.array.PiRGBArray(camera) as output:
-                    time.sleep(2)  # Camera warm-up time
-                    self.set_camera_settings(camera)
-                    time.sleep(0.2)
-                    self._image = numpy.empty((camera.resolution[1], camera.resolution[0], 3), dtype=numpy.uint8)
-                    camera.capture(output, 'rgb')
-                    self._image = output.array
-                    self._image = cv2.cvtColor(self._image, cv2.COLOR_BGR2RGB)
+            if self.persistent_session:
+                self._capture_session()
+            else:
+                with picamera.PiCamera() as camera:
+                    with picamera.array.PiRGBArray(camera) as output:
+                        with Tracer.get_tracer().span(self.identifier, "warmup"):
+                            time.sleep(2)  # Camera warm-up time
+                            self.set_camera_settings(camera)
+                            time.sleep(0.2)
+                        camera.capture(output, 'rgb')
+                        self._image = cv2.cvtColor(output.array, cv2.COLOR_BGR2RGB,
+                                                   dst=self.buffers.get(output.array.shape))
             if filename:
                 filenames = self.encode_write_np_array(self._image, filename)
                 self.logger.debug("Took {0:.2f}s to capture".format(time.time() - st))
@@ -1891,6 +2229,11 @@ class IVPortCamera(PiCamera):
         [True, True, False]
     ]
     gpio_groups = ("B",)
+    # seconds for the multiplexer to settle after switching cameras
+    switch_settle_s = 0.05
+
+    _sensor_buffers = None
+    _write_executor = None
 
     def __init__(self,
                  identifier: str,
@@ -1911,20 +2254,22 @@ class IVPortCamera(PiCamera):
 
         if camera_number is None:
             super(IVPortCamera, self).__init__(identifier, **kwargs)
+            self.switch_settle_s = float(self.config.get("switch_settle_s", IVPortCamera.switch_settle_s))
         else:
             self.__class__.current_camera_index = camera_number
             IVPortCamera.switch(idx=self.__class__.current_camera_index)
 
     @classmethod
-    def switch(cls, idx: int = None):
+    def switch(cls, idx: int = None, settle: float = None):
         """
         switches the IVPort to a new camera
         with no index, switches to the next camera, looping around from the beginning
 
         :param idx: index to switch the camera to (optional)
         :type idx: int
+        :param settle: seconds to wait after switching before the camera can be used, defaults to switch_settle_s.
+        :type settle: float
         """
-        time.sleep(1)
         # import RPi.GPIO as GPIO
         cls.current_camera_index += 1
         if idx is not None:
@@ -1956,11 +2301,46 @@ class IVPortCamera(PiCamera):
         # GPIO.output(IVPortCamera.enable_pins[0], pin_values[1])
         # GPIO.output(IVPortCamera.enable_pins[1], pin_values[2])
         print(pin_values)
+        # only wait as long as the multiplexer needs to settle.
+        time.sleep(cls.switch_settle_s if settle is None else settle)
+
+    @classmethod
+    def stream_frames(cls):
+        """
+        IVPort live stream frame source.
+        switches between each camera on the IVPort in turn, so every camera streams at once on its own channel.
+
+        :return: generator of (camera index, encoded jpeg)
+        """
+        import picamera
+        with picamera.PiCamera() as camera:
+            camera.resolution = (640, 480)
+            camera.start_preview()
+            time.sleep(2)
+            stream = BytesIO()
+            while True:
+                for c in range(len(IVPortCamera.TRUTH_TABLE) * len(cls.gpio_groups)):
+                    cls.switch(idx=c)
+                    camera.capture(stream, 'jpeg', use_video_port=True)
+                    yield c, stream.getvalue()
+                    stream.seek(0)
+                    stream.truncate()
+
+    @property
+    def stream_channels(self) -> tuple:
+        """
+        one channel per camera on the IVPort.
+        """
+        return tuple(range(len(IVPortCamera.TRUTH_TABLE) * len(self.gpio_groups)))
 
     def capture_image(self, filename: str = None) -> list:
         """
         capture method for IVPort
-        iterates over the number of vameras
+        iterates over the number of cameras.
+
+        Each camera is captured in bgr straight into its own preallocated buffer, after switching with only
+        :attr:`switch_settle_s` of settle time. Writing each image out is handed to a background thread, so it
+        overlaps with capturing the next camera, and the composite is assembled once, after the sweep.
 
         :return: :func:`numpy.array` if filename not specified, otherwise list of files.
         :rtype: numpy.array or list
@@ -1968,38 +2348,49 @@ class IVPortCamera(PiCamera):
         filenames = []
         st = time.time()
         import picamera
-        import numpy as np
+        n_cameras = len(IVPortCamera.TRUTH_TABLE) * len(self.gpio_groups)
+        if self._sensor_buffers is None:
+            self._sensor_buffers = [BufferPool(1) for _ in range(n_cameras)]
+        if self._write_executor is None:
+            self._write_executor = ThreadPoolExecutor(max_workers=1)
         try:
+            frames = dict()
+            writes = []
             with picamera.PiCamera() as camera:
-                with picamera.array.PiRGBArray(camera) as _image:
-                    camera.start_preview()
-                    time.sleep(2)  # Camera warm-up time
-                    self.set_camera_settings(camera)
-                    w, h = camera.resolution
-                    self._image = numpy.empty((h, w * len(IVPortCamera.TRUTH_TABLE), 3), dtype=numpy.uint8)
-                    for c in range(0, len(IVPortCamera.TRUTH_TABLE)):
-                        try:
-                            ast = time.time()
-                            IVPortCamera.switch(idx=c)
-                            camera.capture(_image, 'rgb')
-                            # _image = numpy.empty((camera.resolution[1], camera.resolution[0], 3), dtype=numpy.uint8)
-
-                            if filename:
-                                image_numbered = "{}-{}{}".format(os.path.splitext(filename)[0], str(c),
-                                                                  os.path.splitext(filename)[-1])
-                                filenames.append(self.encode_write_np_array(_image.array, image_numbered))
-                                self.logger.debug(
-                                    "Took {0:.2f}s to capture image #{1}".format(time.time() - ast, str(c)))
-
-                            # setup the images
-                            offset = c * w
-                            self._image[0:h, offset: offset + w] = _image.array
-                            self._image = cv2.cvtColor(self._image, cv2.COLOR_BGR2RGB)
-                        except Exception as e:
-                            self.logger.critical("Couldnt capture (IVPORT) with camera {} {}".format(str(c), str(e)))
-                        _image.truncate(0)
-                        time.sleep(0.1)
-            self.logger.debug("Took {0:.2f}s to capture all images".format(time.time() - ast))
+                camera.start_preview()
+                time.sleep(2)  # Camera warm-up time
+                self.set_camera_settings(camera)
+                w, h = camera.resolution
+                # the gpu pads captures to a multiple of 32 wide and 16 high.
+                padded = (-(-h // 16) * 16, -(-w // 32) * 32, 3)
+                for c in range(n_cameras):
+                    try:
+                        ast = time.time()
+                        IVPortCamera.switch(idx=c, settle=self.switch_settle_s)
+                        raw = self._sensor_buffers[c].get(padded)
+                        camera.capture(raw, 'bgr')
+                        frames[c] = raw[:h, :w]
+                        self.logger.debug("Took {0:.2f}s to capture image #{1}".format(time.time() - ast, str(c)))
+                        if filename:
+                            image_numbered = "{}-{}{}".format(os.path.splitext(filename)[0], str(c),
+                                                              os.path.splitext(filename)[-1])
+                            writes.append(self._write_executor.submit(self.encode_write_np_array,
+                                                                      frames[c], image_numbered))
+                    except Exception as e:
+                        self.logger.critical("Couldnt capture (IVPORT) with camera {} {}".format(str(c), str(e)))
+            # build the composite once, after the sweep.
+            self._image = self.buffers.get((h, w * n_cameras, 3))
+            for c in range(n_cameras):
+                if c in frames:
+                    self._image[:, c * w:(c + 1) * w] = frames[c]
+                else:
+                    self._image[:, c * w:(c + 1) * w] = 0
+            for write in writes:
+                try:
+                    filenames.append(write.result())
+                except Exception as e:
+                    self.logger.error("Couldnt write IVPort image: {}".format(str(e)))
+            self.logger.debug("Took {0:.2f}s to capture all images".format(time.time() - st))
             if filename:
                 return filenames
             else:
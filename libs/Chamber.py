@@ -4,6 +4,7 @@ import time
 from telnetlib import Telnet
 from threading import Thread, Event
 from libs.SysUtil import SysUtil
+from libs.Telemetry import Telemetry
 import re
 import os
 from collections import deque
@@ -18,11 +19,6 @@ try:
 except:
     pass
 
-try:
-    import telegraf
-except Exception as e:
-    logging.error("Couldnt import Telegraf, not sending metrics: {}".format(str(e)))
-
 
 def clamp(v: float, minimum: float, maximum: float) -> float:
     """
@@ -383,7 +379,7 @@ class Chamber(Thread):
                 traceback.print_exc()
                 self.logger.error(traceback.format_exc())
             if csv_index == self._current_csv_index:
-                time.sleep(self.accuracy)
+                self.stopper.wait(self.accuracy)
                 continue
             csv_index = self._current_csv_index
 
@@ -449,14 +445,10 @@ class Chamber(Thread):
                 self.logger.info("light metrics {}".format(str(light_metrics)))
                 print("light metrics {}".format(str(light_metrics)))
 
-            try:
-                # send metrics.
-                telegraf_client = telegraf.TelegrafClient(host="localhost", port=8092)
-                if chamber_metric:
-                    telegraf_client.metric("conviron", chamber_metric)
-                for light_name, lm in light_metrics:
-                    telegraf_client.metric("lights", lm, tags={"light_name": light_name})
-                self.logger.debug("Communicated chamber and light metrics to telegraf")
-            except Exception as exc:
-                self.logger.error("Couldn't communicate with telegraf client. {}".format(str(exc)))
-            time.sleep(self.accuracy * 2)
+            # send metrics.
+            telemetry = Telemetry.get_telemetry()
+            if chamber_metric:
+                telemetry.metric("conviron", chamber_metric)
+            for light_name, lm in light_metrics:
+                telemetry.metric("lights", lm, tags={"light_name": light_name})
+            self.stopper.wait(self.accuracy * 2)
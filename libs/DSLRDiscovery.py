@@ -0,0 +1,169 @@
+import logging.config
+import re
+import subprocess
+from threading import Lock
+from libs.SysUtil import SysUtil
+from libs.GPhotoSession import GPhotoSession, GPhotoError
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class DSLRDiscovery(object):
+    """
+    Cached map of DSLR identifiers to usb ports.
+
+    Finding which camera is on which port takes a `gphoto2 --auto-detect` and a serial number read per port, so
+    cameras are only probed the first time their port is seen. After that the map is kept up to date from udev
+    add/remove events with :func:`handle_event`, which only probe or drop the port that changed.
+
+    Serial numbers are read through the :class:`libs.GPhotoSession.GPhotoSession` for the port, so the session
+    opened while probing is the one the camera captures with.
+
+    Use :func:`DSLRDiscovery.get_discovery` to get the shared instance.
+    """
+    gphoto2 = "/usr/bin/gphoto2"
+
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_discovery(cls) -> 'DSLRDiscovery':
+        """
+        gets the process wide discovery instance.
+
+        :return: the discovery instance
+        :rtype: DSLRDiscovery
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.logger = logging.getLogger("DSLRDiscovery")
+        self._lock = Lock()
+        # (bus, addr): identifier, None for ports that arent usable cameras so they arent probed again.
+        self._ports = dict()
+        self._scanned = False
+
+    def _probe(self, bus: int, addr: int) -> str:
+        """
+        reads the serial number of the camera on a port.
+
+        :param bus: usb bus number
+        :param addr: usb device address
+        :return: camera identifier, or None if the port doesnt have a camera with a usable serial number.
+        :rtype: str
+        """
+        port = GPhotoSession.port_for(bus, addr)
+        try:
+            # WARNING: when the port here needs to be correct, because otherwise gphoto2 will return values from
+            # an arbitrary camera
+            sn = GPhotoSession.get_session(port).get_config("serialnumber")
+        except GPhotoError as e:
+            self.logger.error("Couldnt read serial number from {}: {}".format(port, str(e)))
+            return None
+        if not sn:
+            # we didnt match any output from the command
+            self.logger.error("Couldnt match serial number from gphoto2 output. {}".format(port))
+            return None
+        if sn.lower() == 'none':
+            # there is a bug in a specific version of gphoto2 that causes it to return 'None' for the camera serial
+            # number. If we cant get a unique serial number, we are screwed for multicamera
+            self.logger.error("serial number matched with value of 'none' {}".format(port))
+            return None
+        # pad the serialnumber to 32
+        identifier = SysUtil.default_identifier(prefix=sn)
+        self.logger.info("Discovered {} @ {}".format(identifier, port))
+        return identifier
+
+    def _forget(self, bus: int, addr: int):
+        """
+        drops a port from the map and closes its session.
+        """
+        if self._ports.pop((bus, addr), None) is not None:
+            self.logger.info("Camera removed from {}:{}".format(bus, addr))
+        GPhotoSession.close_session(GPhotoSession.port_for(bus, addr))
+
+    def scan(self) -> dict:
+        """
+        enumerates the connected cameras, only probing ports that arent already in the map.
+
+        :return: dict of identifier: (bus, addr) for the connected cameras.
+        :rtype: dict
+        """
+        try:
+            detect_ret = subprocess.check_output([self.gphoto2, "--auto-detect"], universal_newlines=True)
+        except subprocess.CalledProcessError as e:
+            self.logger.error("Subprocess error detecting gphoto2 cameras: {}".format(str(e)))
+            return self.cameras(scan=False)
+        # this regex matches occurrences of "usb:" followed by 2 comma separated digits.
+        detected = set((int(bus), int(addr)) for bus, addr in re.findall(r'usb:(\d+),(\d+)', detect_ret))
+        with self._lock:
+            for port in set(self._ports.keys()) - detected:
+                self._forget(*port)
+            for port in detected - set(self._ports.keys()):
+                self._ports[port] = self._probe(*port)
+            self._scanned = True
+        return self.cameras(scan=False)
+
+    def cameras(self, scan: bool = True) -> dict:
+        """
+        gets the connected cameras from the map, scanning first if there hasnt been a scan yet.
+
+        :param scan: whether to scan if there hasnt been a scan yet.
+        :return: dict of identifier: (bus, addr) for the connected cameras.
+        :rtype: dict
+        """
+        if scan and not self._scanned:
+            return self.scan()
+        with self._lock:
+            return {identifier: port for port, identifier in self._ports.items() if identifier is not None}
+
+    def find(self, identifier: str) -> tuple:
+        """
+        gets the usb port of a camera, rescanning once if it isnt in the map.
+
+        :param identifier: camera identifier
+        :return: (bus, addr) of the camera, or None if it isnt connected.
+        :rtype: tuple(int, int)
+        """
+        port = self.cameras().get(identifier)
+        if port is None:
+            port = self.scan().get(identifier)
+        return port
+
+    def handle_event(self, action: str, device) -> bool:
+        """
+        updates the map from a pyudev usb event, only probing or dropping the device that changed.
+
+        :param action: udev action, like "add" or "remove"
+        :param device: pyudev device of the event
+        :return: whether the map changed.
+        :rtype: bool
+        """
+        if device is None or device.get("DEVTYPE") != "usb_device":
+            return False
+        try:
+            port = int(device.get("BUSNUM")), int(device.get("DEVNUM"))
+        except (TypeError, ValueError):
+            return False
+        with self._lock:
+            if action == "remove":
+                if port not in self._ports:
+                    return False
+                changed = self._ports[port] is not None
+                self._forget(*port)
+                return changed
+            if action == "add" and port not in self._ports:
+                if not device.get("ID_GPHOTO2"):
+                    # the libgphoto2 udev rules tag supported cameras, without the tag leave it to the next scan.
+                    self._scanned = False
+                    return False
+                self._ports[port] = self._probe(*port)
+                return self._ports[port] is not None
+        return False
@@ -0,0 +1,188 @@
+import fcntl
+import glob
+import logging.config
+import os
+import threading
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class DeviceBroker(object):
+    """
+    Arbitrates a camera sensor between the live stream and timelapse captures.
+
+    The live stream (in the webinterface) and the timelapse (in the capture service) run in different processes,
+    so the sensor is owned through an exclusive lock file rather than a shared handle. Captures always win: a
+    capture places a preempt request, the stream sees it between frames, closes the device and releases the lock,
+    the capture runs, and the stream reopens the device once there are no requests left.
+
+    Use :func:`DeviceBroker.get_broker` to get the broker for a device.
+
+    :cvar str lock_dir: directory for the device lock files.
+    :cvar str request_dir: directory for preempt requests, should be a tmpfs.
+    """
+    lock_dir = "/var/lock"
+    request_dir = "/dev/shm"
+
+    _instances = dict()
+    _instances_lock = Lock()
+
+    @classmethod
+    def get_broker(cls, device: str) -> 'DeviceBroker':
+        """
+        gets the broker for a device.
+
+        :param device: device name, like "picamera" or "video0".
+        :return: the broker
+        :rtype: DeviceBroker
+        """
+        with cls._instances_lock:
+            if device not in cls._instances:
+                cls._instances[device] = cls(device)
+            return cls._instances[device]
+
+    def __init__(self, device: str):
+        """
+        :param device: device name, like "picamera" or "video0".
+        """
+        self.device = device
+        self.logger = logging.getLogger("DeviceBroker|{}".format(device))
+        self.lock_path = os.path.join(self.lock_dir, "spc-eyepi-{}.lock".format(device))
+        self._request_prefix = os.path.join(self.request_dir, "spc-eyepi-{}.preempt".format(device))
+        self._stream_prefix = os.path.join(self.request_dir, "spc-eyepi-{}.stream".format(device))
+
+    @contextmanager
+    def _locked(self, timeout: float = None, poll: float = 0.05, stopper: threading.Event = None):
+        """
+        holds the exclusive device lock.
+
+        :param timeout: seconds to wait for the lock, None to wait forever.
+        :param poll: seconds between attempts
+        :param stopper: event that gives up waiting when set
+        """
+        # a separate open file description per holder, so threads in the same process exclude each other too.
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            give_up = None if timeout is None else time.time() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if (give_up is not None and time.time() > give_up) or (stopper and stopper.is_set()):
+                        raise TimeoutError("Couldnt acquire {}".format(self.device))
+                    time.sleep(poll)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _requests(self, prefix: str) -> list:
+        """
+        lists the request files for a prefix that belong to running processes.
+        requests left behind by a process that was killed while holding one are removed.
+
+        :param prefix: request file prefix, requests are named prefix.pid.thread
+        :return: request file paths
+        :rtype: list(str)
+        """
+        requests = []
+        for fn in glob.glob(prefix + ".*"):
+            try:
+                pid = int(fn[len(prefix) + 1:].split(".")[0])
+            except ValueError:
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                self.logger.warning("Removing request left behind by dead process {}: {}".format(pid, fn))
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+                continue
+            except PermissionError:
+                # exists, but belongs to another user.
+                pass
+            requests.append(fn)
+        return requests
+
+    @property
+    def preempt_requested(self) -> bool:
+        """
+        whether a capture is waiting for the device.
+        """
+        return bool(self._requests(self._request_prefix))
+
+    @property
+    def stream_requested(self) -> bool:
+        """
+        whether a live stream wants the device, captures that keep the device open between frames should close it.
+        """
+        return bool(self._requests(self._stream_prefix))
+
+    @contextmanager
+    def capture(self, timeout: float = 30):
+        """
+        holds the device for a still capture, preempting the live stream if it is running.
+
+        :param timeout: seconds to wait for the stream to release the device.
+        """
+        request = "{}.{}.{}".format(self._request_prefix, os.getpid(), threading.get_ident())
+        open(request, 'w').close()
+        try:
+            st = time.time()
+            with self._locked(timeout=timeout):
+                self.logger.debug("Acquired for capture in {0:.2f}s".format(time.time() - st))
+                yield
+        finally:
+            try:
+                os.remove(request)
+            except OSError:
+                pass
+
+    @contextmanager
+    def stream_request(self):
+        """
+        marks that a live stream wants the device, for as long as the context is held.
+        captures that keep the device open between frames see it through :attr:`stream_requested` and close the
+        device, so the stream should hold this for its whole life, including while it retries opening the device.
+        """
+        request = "{}.{}.{}".format(self._stream_prefix, os.getpid(), threading.get_ident())
+        open(request, 'w').close()
+        try:
+            yield
+        finally:
+            try:
+                os.remove(request)
+            except OSError:
+                pass
+
+    @contextmanager
+    def stream(self, stopper: threading.Event = None, timeout: float = 120):
+        """
+        holds the device for the live stream, waiting for any pending captures first.
+        the holder should check :attr:`preempt_requested` between frames and leave the context when it is set, and
+        should be inside :func:`stream_request`.
+
+        :param stopper: event that gives up waiting when set
+        :param timeout: seconds to wait for pending captures to finish.
+        """
+        give_up = time.time() + timeout
+        while self.preempt_requested:
+            if stopper and stopper.is_set():
+                raise TimeoutError("Stopped waiting for {}".format(self.device))
+            if time.time() > give_up:
+                raise TimeoutError("Captures didnt release {} in {}s".format(self.device, timeout))
+            time.sleep(0.05)
+        with self._locked(stopper=stopper):
+            yield
@@ -0,0 +1,190 @@
+import logging.config
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import numpy
+import cv2
+from libs.Tracing import Tracer
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+try:
+    import pyexiv2
+except Exception as e:
+    logging.error("Couldnt import pyexiv2 module, no exif data will be written: {}".format(str(e)))
+
+
+class ImageEncoder(object):
+    """
+    Multi-format image writer.
+
+    Each output format is encoded in memory with :func:`cv2.imencode`, has its exif data applied to the encoded
+    buffer and is then written to disk once, rather than writing the image and then rewriting it to add exif data.
+    Formats are encoded in parallel on a shared thread pool (cv2 releases the GIL while encoding).
+
+    If `master_only` is set, only the lossless master format is written, and other formats are derived from it
+    later with :func:`ImageEncoder.derive`, by the uploader when it uploads the master.
+
+    :cvar str master_type: lossless format used for the master image.
+    """
+    master_type = "tif"
+
+    _executor = None
+    _executor_lock = Lock()
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        """
+        gets the process wide encoder thread pool.
+
+        :return: thread pool to encode on
+        :rtype: concurrent.futures.ThreadPoolExecutor
+        """
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=max(os.cpu_count() or 1, 2))
+            return cls._executor
+
+    def __init__(self, output_types: list, master_only: bool = False, logger: logging.Logger = None,
+                 trace_key: str = None):
+        """
+        :param output_types: list of file extensions to write, like ["tif", "jpg"]
+        :param master_only: only write the lossless master format.
+        :param logger: logger to log failures to
+        :param trace_key: camera identifier to record encode, exif and write spans under,
+                          see :class:`libs.Tracing.Tracer`
+        """
+        self.output_types = list(output_types)
+        self.master_only = master_only
+        self.logger = logger or logging.getLogger("ImageEncoder")
+        self.trace_key = trace_key
+
+    @staticmethod
+    def encode(np_image_array: numpy.array, ext: str) -> bytes:
+        """
+        encodes an image array to bytes in memory.
+
+        :param np_image_array: image array, in the channel order cv2 expects
+        :param ext: file extension of the format to encode to
+        :return: encoded image data
+        :rtype: bytes
+        """
+        success, buf = cv2.imencode(".{}".format(ext), np_image_array)
+        if not success:
+            raise IOError("cv2 couldnt encode image as {}".format(ext))
+        return buf.tobytes()
+
+    def apply_exif(self, data: bytes, exif: dict) -> bytes:
+        """
+        applies exif data to an encoded image in memory.
+
+        :param data: encoded image data
+        :param exif: dict of exif key: values
+        :return: encoded image with exif data, or the original data if the exif couldnt be applied.
+        :rtype: bytes
+        """
+        if not exif:
+            return data
+        try:
+            meta = pyexiv2.ImageMetadata.from_buffer(data)
+            meta.read()
+            for k, v in exif.items():
+                try:
+                    meta[k] = v
+                except:
+                    pass
+            meta.write()
+            return meta.buffer
+        except Exception as e:
+            self.logger.debug("Couldnt write the appropriate metadata: {}".format(str(e)))
+        return data
+
+    def _write_one(self, np_image_array: numpy.array, fn: str, exif: dict) -> str:
+        """
+        encodes, applies exif and writes one image file.
+
+        :return: file name if written, otherwise None
+        :rtype: str
+        """
+        try:
+            tracer = Tracer.get_tracer()
+            ext = os.path.splitext(fn)[-1][1:]
+            with tracer.span(self.trace_key, "encode_{}".format(ext)):
+                data = self.encode(np_image_array, ext)
+            with tracer.span(self.trace_key, "exif"):
+                data = self.apply_exif(data, exif)
+            with tracer.span(self.trace_key, "write_{}".format(ext)):
+                with open(fn, 'wb') as f:
+                    f.write(data)
+            return fn
+        except Exception as e:
+            self.logger.error("Couldnt write {}: {}".format(fn, str(e)))
+        return None
+
+    def write(self, np_image_array: numpy.array, fn: str, exif: dict = None) -> list:
+        """
+        writes an image array to disk in all the output formats, in parallel.
+
+        :param np_image_array: image array, in the channel order cv2 expects
+        :param fn: filename, the extension is replaced for each format.
+        :param exif: dict of exif key: values
+        :return: files successfully written, in the same order as the output types.
+        :rtype: list(str)
+        """
+        fnp = os.path.splitext(fn)[0]
+        output_types = [self.master_type] if self.master_only else self.output_types
+        futures = [self.get_executor().submit(self._write_one, np_image_array, "{}.{}".format(fnp, ext), exif)
+                   for ext in output_types]
+        return [f for f in (future.result() for future in futures) if f]
+
+    def derive(self, master_fn: str, output_types: list = None) -> list:
+        """
+        derives other formats from a master image on disk, keeping its exif data.
+
+        :param master_fn: path to the master image
+        :param output_types: formats to derive, defaults to the output types of this encoder
+        :return: derived files successfully written
+        :rtype: list(str)
+        """
+        fnp, master_ext = os.path.splitext(master_fn)
+        output_types = [ext for ext in (output_types or self.output_types) if ext != master_ext[1:]]
+        np_image_array = cv2.imread(master_fn, cv2.IMREAD_UNCHANGED)
+        if np_image_array is None:
+            self.logger.error("Couldnt read master image {}".format(master_fn))
+            return []
+        exif = dict()
+        try:
+            meta = pyexiv2.ImageMetadata(master_fn)
+            meta.read()
+            exif = {k: meta[k].value for k in meta.exif_keys}
+        except Exception as e:
+            self.logger.debug("Couldnt read master metadata: {}".format(str(e)))
+        futures = [self.get_executor().submit(self._write_one, np_image_array, "{}.{}".format(fnp, ext), exif)
+                   for ext in output_types]
+        return [f for f in (future.result() for future in futures) if f]
+
+    @staticmethod
+    def reduce(fn: str, max_px: int = 1024, quality: int = 70) -> bytes:
+        """
+        makes a reduced size jpeg of an image on disk, in memory.
+
+        :param fn: path to the image
+        :param max_px: maximum width or height of the reduced image
+        :param quality: jpeg quality
+        :return: encoded jpeg, or None if the image couldnt be read (like camera raw files).
+        :rtype: bytes
+        """
+        np_image_array = cv2.imread(fn, cv2.IMREAD_COLOR)
+        if np_image_array is None:
+            return None
+        scale = float(max_px) / max(np_image_array.shape[:2])
+        if scale < 1:
+            np_image_array = cv2.resize(np_image_array, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        success, buf = cv2.imencode(".jpg", np_image_array, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+        if not success:
+            raise IOError("cv2 couldnt encode reduced image of {}".format(fn))
+        return buf.tobytes()
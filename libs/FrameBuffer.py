@@ -0,0 +1,102 @@
+import logging.config
+import time
+from contextlib import contextmanager
+from threading import Condition
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class FrameBuffer(object):
+    """
+    Latest encoded frame of a live stream.
+
+    A stream thread publishes each encoded frame once with :func:`publish`, and every viewer uses :func:`wait` to
+    block until there is a frame newer than the last one it saw. Only the newest frame is kept, viewers always get
+    the newest frame rather than catching up on old ones. Frames are immutable bytes objects, so all viewers share
+    the same buffer without copying.
+
+    Frames a viewer was too slow to see are counted as dropped.
+
+    :ivar int seq: sequence number of the newest frame, 0 before the first frame.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._frame = None
+        self.seq = 0
+        self._clients = 0
+        self._dropped = 0
+        self._fps = 0.0
+        self._last_publish = None
+
+    def publish(self, frame: bytes) -> int:
+        """
+        adds a new encoded frame and wakes all waiting viewers.
+
+        :param frame: encoded frame
+        :return: sequence number of the frame
+        :rtype: int
+        """
+        now = time.time()
+        with self._condition:
+            self.seq += 1
+            self._frame = frame
+            if self._last_publish is not None:
+                fps = 1.0 / max(now - self._last_publish, 1e-6)
+                self._fps = fps if not self._fps else 0.1 * fps + 0.9 * self._fps
+            self._last_publish = now
+            self._condition.notify_all()
+            return self.seq
+
+    def latest(self) -> tuple:
+        """
+        gets the newest frame without waiting.
+
+        :return: (sequence number, frame), or (0, None) if there are no frames yet.
+        :rtype: tuple(int, bytes)
+        """
+        with self._condition:
+            return self.seq, self._frame
+
+    def wait(self, after: int = 0, timeout: float = None) -> tuple:
+        """
+        waits for a frame newer than `after`.
+
+        :param after: sequence number of the last frame seen
+        :param timeout: seconds to wait
+        :return: (sequence number, frame) of the newest frame, or None if the timeout expired.
+        :rtype: tuple(int, bytes)
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.seq > after, timeout):
+                return None
+            if after:
+                self._dropped += self.seq - after - 1
+            return self.seq, self._frame
+
+    @contextmanager
+    def client(self):
+        """
+        context manager counting a connected viewer.
+        """
+        with self._condition:
+            self._clients += 1
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self._clients -= 1
+
+    def stats(self) -> dict:
+        """
+        gets streaming metrics.
+
+        :return: dict of fps, clients, dropped frames and the newest sequence number.
+        :rtype: dict
+        """
+        with self._condition:
+            return dict(fps=self._fps, clients=self._clients, dropped=self._dropped, seq=self.seq)
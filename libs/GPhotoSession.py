@@ -0,0 +1,253 @@
+import logging.config
+import os
+import re
+import select
+import subprocess
+import time
+from threading import Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class GPhotoError(IOError):
+    """
+    gphoto2 reported an error, or the session hung and was restarted.
+    """
+    pass
+
+
+class GPhotoSession(object):
+    """
+    Long lived `gphoto2 --shell` process for one camera.
+
+    Spawning gphoto2 for every capture or config read re-enumerates usb and reopens the PTP session each time, so
+    instead one shell is kept open per usb port and commands are written to its stdin. A command that doesnt come
+    back to the prompt within its timeout is treated as a hang, and the shell is killed and restarted for the next
+    command. The shell is also restarted every `max_commands` commands, to bound any leaks in libgphoto2.
+
+    Use :func:`GPhotoSession.get_session` to get the session for a port.
+
+    :cvar str gphoto2: path to the gphoto2 binary.
+    :cvar float command_timeout: default seconds to wait for a command.
+    :cvar int max_commands: commands before the shell is restarted.
+    """
+    gphoto2 = "/usr/bin/gphoto2"
+    command_timeout = 30
+    max_commands = 1000
+    prompt = re.compile(r"gphoto2: \{[^}]*\}[^\n]*> $")
+
+    _sessions = dict()
+    _sessions_lock = Lock()
+
+    @staticmethod
+    def port_for(bus: int, addr: int) -> str:
+        """
+        formats a usb bus and address the way gphoto2 expects.
+
+        :param bus: usb bus number
+        :param addr: usb device address
+        :return: gphoto2 port string, like usb:001,004
+        :rtype: str
+        """
+        return "usb:{:03d},{:03d}".format(int(bus), int(addr))
+
+    @classmethod
+    def get_session(cls, port: str, init_commands: list = None) -> 'GPhotoSession':
+        """
+        gets the session for a port, creating it if it doesnt exist.
+
+        :param port: gphoto2 port string, see :func:`port_for`
+        :param init_commands: commands to run every time the shell starts, only used when creating the session.
+        :return: the session
+        :rtype: GPhotoSession
+        """
+        with cls._sessions_lock:
+            if port not in cls._sessions:
+                cls._sessions[port] = cls(port, init_commands=init_commands)
+            return cls._sessions[port]
+
+    @classmethod
+    def close_session(cls, port: str):
+        """
+        closes and forgets the session for a port, if there is one.
+
+        :param port: gphoto2 port string, see :func:`port_for`
+        """
+        with cls._sessions_lock:
+            session = cls._sessions.pop(port, None)
+        if session is not None:
+            session.close()
+
+    @classmethod
+    def close_all(cls):
+        """
+        closes every session.
+        """
+        with cls._sessions_lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
+
+    def __init__(self, port: str, init_commands: list = None):
+        """
+        :param port: gphoto2 port string, see :func:`port_for`
+        :param init_commands: commands to run every time the shell starts, like setting the capture target.
+        """
+        self.port = port
+        self.init_commands = list(init_commands or [])
+        self.logger = logging.getLogger("GPhotoSession|{}".format(port))
+        self._lock = Lock()
+        self._process = None
+        self._commands = 0
+        self.restarts = 0
+
+    @property
+    def running(self) -> bool:
+        """
+        whether the shell process is running.
+        """
+        return self._process is not None and self._process.poll() is None
+
+    def _read_until_prompt(self, timeout: float) -> str:
+        """
+        reads the shells output until it prints its prompt again.
+
+        :param timeout: seconds to wait
+        :return: output before the prompt
+        :rtype: str
+        """
+        fd = self._process.stdout.fileno()
+        give_up = time.time() + timeout
+        output = ""
+        while True:
+            remaining = give_up - time.time()
+            if remaining <= 0:
+                raise GPhotoError("gphoto2 on {} hung".format(self.port))
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise GPhotoError("gphoto2 on {} exited".format(self.port))
+            output += chunk.decode("utf-8", "replace")
+            match = self.prompt.search(output)
+            if match:
+                return output[:match.start()]
+
+    def _start(self):
+        """
+        starts the shell and runs the init commands.
+        """
+        self._process = subprocess.Popen([self.gphoto2, "--port={}".format(self.port), "--shell"],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT,
+                                         bufsize=0)
+        self._commands = 0
+        self._read_until_prompt(self.command_timeout)
+        for cmd in self.init_commands:
+            self._command(cmd, self.command_timeout)
+        self.logger.info("Started gphoto2 shell")
+
+    def close(self):
+        """
+        closes the shell, killing it if it doesnt exit.
+        """
+        if self._process is None:
+            return
+        try:
+            if self._process.poll() is None:
+                self._process.stdin.write(b"exit\n")
+                self._process.wait(timeout=2)
+        except Exception:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+    def _command(self, cmd: str, timeout: float) -> str:
+        """
+        runs a command in the shell, without the lock or restart handling.
+        """
+        self._process.stdin.write(bytes(cmd + "\n", "utf-8"))
+        output = self._read_until_prompt(timeout)
+        self._commands += 1
+        if "*** Error" in output:
+            raise GPhotoError("gphoto2 {} failed: {}".format(cmd, " ".join(
+                line.strip() for line in output.splitlines() if line.strip() and "***" not in line)))
+        return output
+
+    def command(self, cmd: str, timeout: float = None) -> str:
+        """
+        runs a command in the shell, starting the shell if it isnt running.
+        If the command hangs or the shell dies, the shell is killed so that the next command restarts it.
+
+        :param cmd: gphoto2 shell command, like "get-config serialnumber"
+        :param timeout: seconds to wait for the command, defaults to :attr:`command_timeout`
+        :return: output of the command
+        :rtype: str
+        """
+        timeout = timeout or self.command_timeout
+        with self._lock:
+            if self.running and self._commands >= self.max_commands:
+                self.close()
+            try:
+                if not self.running:
+                    self._start()
+                return self._command(cmd, timeout)
+            except GPhotoError as e:
+                if self.running and "hung" not in str(e):
+                    # the camera reported an error, the shell is fine.
+                    raise
+                self.logger.error("Restarting gphoto2 shell: {}".format(str(e)))
+                self.restarts += 1
+                self.close()
+                raise
+            except (OSError, ValueError) as e:
+                self.logger.error("Restarting gphoto2 shell: {}".format(str(e)))
+                self.restarts += 1
+                self.close()
+                raise GPhotoError(str(e))
+
+    def get_config(self, field: str) -> str:
+        """
+        reads a config value from the camera.
+
+        :param field: config field name, like "serialnumber"
+        :return: current value, or None if it couldnt be matched.
+        :rtype: str
+        """
+        output = self.command("get-config {}".format(field))
+        # all results are returned like this:
+        # Label: Serial Number
+        # Type: TEXT
+        # Current: 4fffa81fed8f40d286a63fce62598ef0
+        match = re.search(r'Current: (.*)$', output, re.MULTILINE)
+        return match.group(1).strip() if match else None
+
+    def set_config(self, field: str, value):
+        """
+        sets a config value on the camera.
+
+        :param field: config field name
+        :param value: value to set
+        """
+        self.command("set-config {}={}".format(field, value))
+
+    def capture(self, target_dir: str, timeout: float = 60) -> list:
+        """
+        captures and downloads images into a directory.
+        the files keep the names the camera gives them, so the directory should be empty.
+
+        :param target_dir: local directory to download into
+        :param timeout: seconds to wait for the capture and download
+        :return: paths of the downloaded files
+        :rtype: list(str)
+        """
+        self.command("lcd {}".format(target_dir))
+        before = set(os.listdir(target_dir))
+        self.command("capture-image-and-download", timeout=timeout)
+        return sorted(os.path.join(target_dir, fn) for fn in set(os.listdir(target_dir)) - before)
@@ -0,0 +1,155 @@
+import datetime
+import logging.config
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from zlib import crc32
+import paho.mqtt.client as client
+from paho.mqtt.client import topic_matches_sub
+from dateutil import zoneinfo
+from libs.CryptUtil import SSHManager
+from libs.SysUtil import SysUtil
+
+timezone = zoneinfo.get_zonefile_instance().get("Australia/Canberra")
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class MQTTSession(object):
+    """
+    Process wide mqtt connection, shared by every worker.
+
+    Workers subscribe to topics with a callback instead of running their own client, so the process has one broker
+    connection, one network loop thread and one signed auth message no matter how many cameras it has.
+    Subscriptions are remembered and made again whenever the connection is (re)established.
+
+    Callbacks are called with the same (client, userdata, message) arguments as paho's on_message, on a small thread
+    pool so that a slow handler (like a capture) doesnt hold up the network loop.
+
+    Use :func:`MQTTSession.get_session` to get the shared instance.
+
+    :cvar str host: broker hostname
+    :cvar int port: broker port
+    """
+    host = "10.9.0.1"
+    port = 1883
+
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_session(cls) -> 'MQTTSession':
+        """
+        gets the process wide mqtt session, connecting it if this is the first call.
+
+        :return: the mqtt session
+        :rtype: MQTTSession
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.logger = logging.getLogger("MQTTSession")
+        self._lock = Lock()
+        # topic: list of callbacks
+        self._subscriptions = dict()
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        client_id = str(crc32(bytes(SysUtil.get_hostname() + "-spc-eyepi", 'utf8')))
+        self.mqtt = client.Client(client_id=client_id,
+                                  clean_session=True,
+                                  protocol=client.MQTTv311,
+                                  transport="tcp")
+        self.mqtt.on_message = self._on_message
+        self.mqtt.on_connect = self._on_connect
+        try:
+            with open("mqttpassword") as f:
+                self.mqtt.username_pw_set(username=SysUtil.get_hostname(),
+                                          password=f.read().strip())
+        except FileNotFoundError:
+            auth = SSHManager().sign_message_PSS(datetime.datetime.now().replace(tzinfo=timezone).isoformat())
+            if not auth:
+                raise ValueError
+            self.mqtt.username_pw_set(username=SysUtil.get_machineid(),
+                                      password=auth)
+        except:
+            self.mqtt.username_pw_set(username=SysUtil.get_hostname(),
+                                      password="INVALIDPASSWORD")
+        self.mqtt.connect_async(self.host, port=self.port)
+        self.mqtt.loop_start()
+
+    def _on_connect(self, client, *args):
+        """
+        subscribes to every registered topic, the broker forgets them when the connection drops.
+        """
+        with self._lock:
+            topics = list(self._subscriptions.keys())
+        self.logger.debug("Connected, subscribing to {} topics".format(len(topics)))
+        for topic in topics:
+            self.mqtt.subscribe(topic, qos=1)
+
+    def _on_message(self, client, userdata, msg):
+        """
+        hands a message to the callbacks of every subscription that matches its topic.
+        """
+        with self._lock:
+            callbacks = [callback
+                         for topic, topic_callbacks in self._subscriptions.items()
+                         if topic_matches_sub(topic, msg.topic)
+                         for callback in topic_callbacks]
+        for callback in callbacks:
+            self._executor.submit(self._dispatch, callback, client, userdata, msg)
+
+    def _dispatch(self, callback, client, userdata, msg):
+        try:
+            callback(client, userdata, msg)
+        except Exception as e:
+            self.logger.error("Error handling mqtt message on {}: {}".format(msg.topic, str(e)))
+
+    def subscribe(self, topic: str, callback):
+        """
+        registers a callback for a topic, subscribing to the topic if this is the first callback for it.
+
+        :param topic: mqtt topic, can include wildcards
+        :param callback: callable taking (client, userdata, message)
+        """
+        with self._lock:
+            callbacks = self._subscriptions.setdefault(topic, [])
+            first = not callbacks
+            if callback not in callbacks:
+                callbacks.append(callback)
+        if first:
+            self.mqtt.subscribe(topic, qos=1)
+
+    def unsubscribe(self, topic: str, callback):
+        """
+        removes a callback for a topic, unsubscribing from the topic if it was the last one.
+
+        :param topic: mqtt topic the callback was registered with
+        :param callback: the registered callback
+        """
+        with self._lock:
+            callbacks = self._subscriptions.get(topic, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            last = topic in self._subscriptions and not callbacks
+            if last:
+                del self._subscriptions[topic]
+        if last:
+            self.mqtt.unsubscribe(topic)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 1):
+        """
+        queues a message for publishing, without waiting for it to be sent.
+        messages published while the connection is down are sent by paho once it reconnects.
+
+        :param topic: mqtt topic
+        :param payload: message payload
+        :param qos: mqtt quality of service
+        :return: paho message info, to check or wait on delivery.
+        """
+        return self.mqtt.publish(topic, payload=payload, qos=qos)
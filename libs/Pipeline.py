@@ -0,0 +1,209 @@
+import logging.config
+import time
+import queue
+from threading import Thread, Lock
+from libs.Tracing import Tracer
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+# put on a stages queue to stop one of its workers, after everything in front of it has been processed.
+_STOP = object()
+
+
+class Stage(object):
+    """
+    A single stage of a :class:`Pipeline`.
+
+    A bounded queue served by a pool of worker threads, each item taken off the queue is passed to `func` and
+    whatever it returns is put on the next stage. Returning None from `func` drops the item.
+
+    :ivar str name: name of the stage, used for logging and metrics.
+    :ivar queue.Queue queue: bounded queue of items waiting for this stage.
+    :ivar Stage next_stage: stage to pass results on to, or None if this is the last stage.
+    """
+
+    def __init__(self, name: str, func, maxsize: int = 4, workers: int = 1, logger: logging.Logger = None,
+                 trace_key: str = None, trace_name: str = None):
+        """
+        :param name: name of the stage
+        :param func: callable that processes one item, returning the item for the next stage.
+        :param maxsize: maximum number of items waiting in the queue
+        :param workers: number of worker threads serving the queue
+        :param logger: logger to log failures to
+        :param trace_key: key to record queue wait spans under, see :class:`libs.Tracing.Tracer`
+        :param trace_name: name of the stage in the spans, defaults to the stage name.
+        """
+        self.name = name
+        self.trace_key = trace_key
+        self.trace_name = trace_name or name
+        self.func = func
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.next_stage = None
+        self.logger = logger or logging.getLogger(name)
+        self._workers = [Thread(target=self._work, name="{}-{}".format(name, i)) for i in range(max(int(workers), 1))]
+        self._lock = Lock()
+        self._processed = 0
+        self._failed = 0
+        self._latency_total = 0.0
+        self._wait_total = 0.0
+        self._last_latency = 0.0
+
+    def start(self):
+        """
+        starts the worker threads.
+        """
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def put(self, item, block: bool = True, timeout: float = None) -> bool:
+        """
+        Puts an item on this stages queue.
+
+        :param item: item to process
+        :param block: whether to wait for space in the queue
+        :param timeout: how long to wait for space in the queue
+        :return: whether the item was queued.
+        :rtype: bool
+        """
+        try:
+            self.queue.put((time.time(), item), block=block, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+
+    @property
+    def full(self) -> bool:
+        """
+        whether the queue is full, and putting would block.
+        """
+        return self.queue.full()
+
+    def _work(self):
+        """
+        worker thread loop.
+        """
+        while True:
+            queued_at, item = self.queue.get()
+            if item is _STOP:
+                break
+            st = time.time()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                self.logger.error("Pipeline stage {} failed: {}".format(self.name, str(e)))
+                # dont lose the item, later stages are still responsible for cleaning up after it.
+                result = item
+                with self._lock:
+                    self._failed += 1
+            latency = time.time() - st
+            Tracer.get_tracer().record(self.trace_key, "queue_wait_{}".format(self.trace_name), st - queued_at)
+            with self._lock:
+                self._processed += 1
+                self._latency_total += latency
+                self._wait_total += st - queued_at
+                self._last_latency = latency
+            if result is not None and self.next_stage is not None:
+                # blocking here lets backpressure propagate back to the start of the pipeline.
+                self.next_stage.put(result)
+
+    def stats(self) -> dict:
+        """
+        Gets queue depth and latency metrics for this stage.
+
+        :return: dict of metrics
+        :rtype: dict
+        """
+        with self._lock:
+            processed = max(self._processed, 1)
+            return dict(
+                queue_depth=self.queue.qsize(),
+                processed=self._processed,
+                failed=self._failed,
+                latency_s=self._last_latency,
+                latency_avg_s=self._latency_total / processed,
+                wait_avg_s=self._wait_total / processed
+            )
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the workers once everything already in the queue has been processed.
+
+        :param timeout: seconds to wait for each worker to finish.
+        """
+        for _ in self._workers:
+            self.queue.put((time.time(), _STOP))
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join(timeout)
+
+
+class Pipeline(object):
+    """
+    A chain of :class:`Stage` objects connected by bounded queues.
+
+    Items submitted to the pipeline go through each stage in order. When the first stage is full the pipeline is
+    saturated, and :func:`submit` returns False instead of blocking so that the producer can skip work rather
+    than stall.
+    """
+
+    def __init__(self, name: str, stages: list, maxsize: int = 4, workers: int = 1, logger: logging.Logger = None,
+                 trace_key: str = None):
+        """
+        :param name: name of the pipeline, stage threads are named after it.
+        :param stages: list of (name, func) tuples, in order.
+        :param maxsize: maximum queue length for each stage
+        :param workers: number of worker threads for each stage
+        :param logger: logger to log failures to
+        :param trace_key: key to record queue wait spans under, see :class:`libs.Tracing.Tracer`
+        """
+        self.name = name
+        self.logger = logger or logging.getLogger(name)
+        self.stages = [Stage("{}|{}".format(name, stage_name), func,
+                             maxsize=maxsize, workers=workers, logger=self.logger,
+                             trace_key=trace_key, trace_name=stage_name)
+                       for stage_name, func in stages]
+        self._names = [stage_name for stage_name, _ in stages]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+        for stage in self.stages:
+            stage.start()
+
+    @property
+    def saturated(self) -> bool:
+        """
+        whether the first stage is full.
+        """
+        return self.stages[0].full
+
+    def submit(self, item) -> bool:
+        """
+        submits an item to the start of the pipeline without blocking.
+
+        :param item: item to process
+        :return: whether the item was accepted, False if the pipeline is saturated.
+        :rtype: bool
+        """
+        return self.stages[0].put(item, block=False)
+
+    def stats(self) -> dict:
+        """
+        Gets the metrics for each stage, keyed by stage name.
+
+        :return: dict of stage name: dict of metrics
+        :rtype: dict
+        """
+        return {name: stage.stats() for name, stage in zip(self._names, self.stages)}
+
+    def stop(self, timeout: float = None):
+        """
+        Drains the pipeline, each stage finishes what it has queued before the next stage is stopped.
+
+        :param timeout: seconds to wait for each stage.
+        """
+        for stage in self.stages:
+            stage.stop(timeout)
@@ -0,0 +1,161 @@
+import datetime
+import logging.config
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from threading import Thread, Event, Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class SamplingProfiler(object):
+    """
+    Sampling profiler for every thread in the process, that can be switched on at runtime.
+
+    While running, a background thread takes the stack of every other thread from :func:`sys._current_frames`
+    every `interval` seconds and counts identical stacks. Nothing is traced between samples, so the overhead is a few
+    percent of one core at the default interval and nothing at all when the profiler is off.
+
+    When the window ends the counts are written in collapsed stack format (one "thread;outer;...;inner count" line
+    per stack, as read by flamegraph.pl and speedscope) to `output_dir`, next to the logs, where
+    :func:`libs.SysUtil.SysUtil.get_log_files` picks them up for uploading.
+
+    Use :func:`SamplingProfiler.get_profiler` to get the shared instance.
+
+    :cvar str output_dir: directory profiles are written to.
+    :cvar str request_path: file another process writes the requested duration to before signalling this one.
+    :cvar float default_duration: seconds to profile for if no duration is given.
+    :cvar float max_duration: longest window allowed.
+    :cvar float interval: seconds between samples.
+    """
+    output_dir = "/home/spc-eyepi"
+    request_path = "/dev/shm/spc-eyepi-profile"
+    default_duration = 60
+    max_duration = 600
+    interval = 0.02
+
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_profiler(cls) -> 'SamplingProfiler':
+        """
+        gets the process wide profiler.
+
+        :return: the profiler
+        :rtype: SamplingProfiler
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @classmethod
+    def requested_duration(cls) -> float:
+        """
+        reads and removes the duration requested through :attr:`request_path`.
+
+        :return: requested duration, or :attr:`default_duration` if there isnt a valid request.
+        :rtype: float
+        """
+        try:
+            with open(cls.request_path) as f:
+                duration = float(f.read().strip())
+            os.remove(cls.request_path)
+            return duration
+        except (OSError, ValueError):
+            return cls.default_duration
+
+    def __init__(self):
+        self.logger = logging.getLogger("SamplingProfiler")
+        self._lock = Lock()
+        self._thread = None
+        self._stopper = Event()
+        self.last_output = None
+
+    @property
+    def running(self) -> bool:
+        """
+        whether a profile is being taken.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float = None, interval: float = None) -> bool:
+        """
+        starts profiling for a bounded window.
+
+        :param duration: seconds to profile for, clamped to :attr:`max_duration`
+        :param interval: seconds between samples
+        :return: whether profiling was started, False if a profile is already being taken.
+        :rtype: bool
+        """
+        duration = min(max(float(duration or self.default_duration), 1), self.max_duration)
+        interval = float(interval or self.interval)
+        with self._lock:
+            if self.running:
+                self.logger.warning("Profiler already running")
+                return False
+            self._stopper.clear()
+            self._thread = Thread(target=self._run, args=(duration, interval), name="SamplingProfiler")
+            self._thread.daemon = True
+            self._thread.start()
+        self.logger.info("Profiling all threads for {0:.0f}s every {1:.3f}s".format(duration, interval))
+        return True
+
+    def stop(self):
+        """
+        ends the profile early, it is still written out.
+        """
+        self._stopper.set()
+
+    @staticmethod
+    def _collapse(frame) -> list:
+        """
+        gets a stack as a list of "file:function" strings, outermost first.
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def _run(self, duration: float, interval: float):
+        """
+        samples every thread until the window ends, then writes the profile.
+        """
+        counts = Counter()
+        samples = 0
+        own = threading.get_ident()
+        st = time.time()
+        while time.time() - st < duration and not self._stopper.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                counts[";".join([names.get(ident, str(ident))] + self._collapse(frame))] += 1
+            samples += 1
+            self._stopper.wait(interval)
+        self._write(counts, samples, time.time() - st)
+
+    def _write(self, counts: Counter, samples: int, elapsed: float):
+        """
+        writes collapsed stacks to :attr:`output_dir`.
+        """
+        fn = os.path.join(self.output_dir, "spc-eyepi.profile.{}.folded".format(
+            datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")))
+        try:
+            with open(fn, 'w') as f:
+                for stack, count in counts.most_common():
+                    f.write("{} {}\n".format(stack, count))
+            self.last_output = fn
+            self.logger.info("Wrote profile of {0} samples over {1:.1f}s to {2}".format(samples, elapsed, fn))
+        except OSError as e:
+            self.logger.error("Couldnt write profile: {}".format(str(e)))
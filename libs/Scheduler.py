@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import logging.config
+import time
+from threading import Thread, Event, Condition, Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class CaptureScheduler(Thread):
+    """
+    Process wide capture scheduler.
+
+    Keeps a heap of wakeup deadlines and sleeps until the earliest one is due, then sets the
+    :class:`threading.Event` that was registered with it.
+    Workers block on their own event instead of waking up every second to check whether it is time to capture.
+
+    Use :func:`CaptureScheduler.get_scheduler` rather than creating one of these directly, there should only be one
+    per process.
+    """
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_scheduler(cls) -> 'CaptureScheduler':
+        """
+        Gets the process wide scheduler, starting it if it isnt running yet.
+
+        :return: the running scheduler
+        :rtype: CaptureScheduler
+        """
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.is_alive():
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        super().__init__(name="CaptureScheduler")
+        self.daemon = True
+        self.logger = logging.getLogger(self.getName())
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = Condition()
+
+    def schedule(self, deadline: float, event: Event) -> list:
+        """
+        Schedules an event to be set at a deadline.
+
+        :param deadline: time (seconds since epoch) to set the event at.
+        :param event: event to set.
+        :return: heap entry, can be passed to :func:`cancel`
+        :rtype: list
+        """
+        entry = [deadline, next(self._counter), event]
+        with self._condition:
+            heapq.heappush(self._heap, entry)
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry: list):
+        """
+        Cancels a scheduled wakeup. Cancelling an entry that has already fired does nothing.
+
+        :param entry: entry returned from :func:`schedule`
+        """
+        with self._condition:
+            entry[-1] = None
+
+    def wait_until(self, deadline: float, event: Event) -> float:
+        """
+        Blocks until the deadline, or until something else sets the event (like a stop or config change).
+
+        :param deadline: time (seconds since epoch) to wake up at.
+        :param event: event to wait on, cleared before returning.
+        :return: scheduling jitter in seconds, how late the wakeup was compared to the deadline. Negative if woken early.
+        :rtype: float
+        """
+        entry = self.schedule(deadline, event)
+        event.wait()
+        woke = time.time()
+        self.cancel(entry)
+        event.clear()
+        return woke - deadline
+
+    def run(self):
+        """
+        main loop, sleeps until the next deadline is due and sets its event.
+        """
+        while True:
+            with self._condition:
+                while self._heap and self._heap[0][-1] is None:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    # woken early if something new is scheduled before the current head.
+                    self._condition.wait(delay)
+                    continue
+                event = heapq.heappop(self._heap)[-1]
+            try:
+                event.set()
+            except Exception as e:
+                self.logger.error("Couldnt wake scheduled worker: {}".format(str(e)))
@@ -3,10 +3,11 @@ import logging.config
 import os
 import time
 from collections import deque
-import shutil
 from threading import Thread, Event
 from libs.SysUtil import SysUtil
-import csv, json
+from libs.UploadJournal import UploadJournal
+from libs.Telemetry import Telemetry
+from libs.SensorStore import SensorStore
 import traceback
 
 try:
@@ -25,11 +26,6 @@ try:
 except Exception as e:
     logging.warning("Couldnt import Adafruit_DHT: {}".format(str(e)))
 
-try:
-    import telegraf
-except Exception as e:
-    logging.error("Couldnt import Telegraf, not sending metrics: {}".format(str(e)))
-
 
 def round_to_1dp(n):
     return round(n, 1)
@@ -38,14 +34,19 @@ def round_to_1dp(n):
 class Sensor(Thread):
     """
     Sensor base.
-    To use this class you need to override 'get_measurement()' so that it returns a tuple of the measurements that match
+    To use this class you need to override 'get_measurement()' so that it returns a dict of the measurements that match
     the headers defined in the data_headers classvar.
-    by default it will write 5 files, rolling 24 hour files (csv, tsv & json) and all time files that are appended to
-    (csv & tsv only)
+
+    Measurements are appended to a :class:`libs.SensorStore.SensorStore` in the hidden .store directory of the output
+    directory, which is the source of truth. Text files are rendered from it rather than written every sample:
+    when a day is finished its csv, tsv & json files are written and its rows are appended to the all time files
+    (csv & tsv only), and rolling 24 hour files (csv, tsv & json) are rewritten every `export_interval` seconds
+    (0 to only write them when a day is finished).
     """
     accuracy = 1
     data_headers = tuple()
     timestamp_format = "%Y-%m-%dT%H:%M:%S"
+    export_interval = 3600
 
     def __init__(self, identifier: str,
                  config: dict = None,
@@ -63,24 +64,26 @@ class Sensor(Thread):
         self.logger = logging.getLogger(identifier)
         self.stopper = Event()
         self.identifier = identifier
-        if config:
-            interval = config.get("interval", interval)
+        config = config or dict()
+        interval = config.get("interval", interval)
         # interval in seconds
         self.interval = interval
-        # chunking interval in number of datapoints
-        dlen = int(86400 / interval)
-
-        # setup a deque of measurements
-        self.measurements = deque(maxlen=dlen)
+        self.export_interval = int(config.get("export_interval", Sensor.export_interval))
         self.write_out = write_out
 
         out_dir = os.path.join(os.getcwd(), "sensors", self.identifier)
         self.output_dir = config.get("output_dir", out_dir)
+        self.store = None
         if write_out:
             if not os.path.exists(self.output_dir):
                 os.makedirs(self.output_dir)
+            # hidden, so the uploaders scan of the output directory doesnt pick up the segments.
+            self.store = SensorStore(os.path.join(self.output_dir, ".store"), self.identifier, self.data_headers,
+                                     capacity=int(86400 / interval))
         self.current_capture_time = datetime.datetime.now()
+        self.last_export = 0
         self.failed = list()
+        self.journal = UploadJournal.get_journal()
 
     @staticmethod
     def timestamp(tn: datetime.datetime) -> str:
@@ -149,103 +152,81 @@ class Sensor(Thread):
         except Exception as e:
             self.logger.error("thread communication error: {}".format(str(e)))
 
+    def export_file(self, name: str, fmt: str) -> str:
+        """
+        path of an export file in the output directory.
+
+        :param name: what the file is of, like "daily" or a date.
+        :param fmt: file extension
+        :return: file path
+        :rtype: str
+        """
+        return os.path.join(self.output_dir, "{}-{}.{}".format(self.identifier, name, fmt))
+
     def write_daily_rolling(self):
         """
-        writes full rolling daily daita files.
-        :param rows:
-        :return:
+        renders the rolling 24 hour files from the store, and adds them to the upload journal.
         """
         try:
-            fn = os.path.join(self.output_dir, "{}-daily".format(self.identifier))
-            csvf, tsvf, jsonf = fn + ".csv", fn + ".tsv", fn + ".json"
-
-            with open(csvf, 'w', newline='') as csvfile, open(tsvf, 'w', newline='') as tsvfile, open(jsonf, 'w',
-                                                                                                      newline='') as jsonfile:
-                writer = csv.writer(csvfile, dialect=csv.excel)
-                writer.writerow(("datetime", *self.data_headers))
-                writer.writerows(self.measurements)
-                writer = csv.writer(tsvfile, dialect=csv.excel_tab)
-                writer.writerow(("datetime", *self.data_headers))
-                writer.writerows(self.measurements)
-                d = dict()
-                for k in self.data_headers:
-                    d[k] = list()
-                d['datetime'] = []
-                for measurement in self.measurements:
-                    for idx, m in enumerate(measurement[:len(d.keys())]):
-                        header = "datetime"
-                        if idx != 0:
-                            header = self.data_headers[idx - 1]
-                        d[header].append(m)
-                jsonfile.write(json.dumps(d))
+            end = datetime.datetime.now()
+            for fmt in ("csv", "tsv", "json"):
+                f = self.store.export(self.export_file("daily", fmt), fmt,
+                                      start=end - datetime.timedelta(days=1), end=end)
+                self.journal.add(f, self.output_dir)
+            self.last_export = time.time()
         except Exception as e:
             self.logger.error("Error writing daily rolling data {}".format(str(e)))
 
-    def append_to_alltime(self, measurement: tuple):
+    def finish_day(self, day: datetime.date):
         """
-        appends the measurement to the csv and tsv files.
+        renders the files for a finished day from the store, appends its rows to the all time files and adds them
+        all to the upload journal.
 
-        :param measurement:
-        :return:
+        :param day: date of the finished day
         """
         try:
-            fn = os.path.join(self.output_dir, "{}-lastday".format(self.identifier))
-            fn2 = os.path.join(self.output_dir, "{}-alltime".format(self.identifier))
-            csvf, tsvf = fn + ".csv", fn + ".tsv"
-            csvf2, tsvf2 = fn2 + ".csv", fn2 + ".tsv"
-            self.rotate(csvf, tsvf)
-
-            def create_with_headers(path, delimiter=","):
-                # write the headers if the files are new.
-                if not os.path.exists(path):
-                    with open(path, 'w') as f:
-                        f.write(delimiter.join(("datetime", *self.data_headers)) + "\n")
-
-            create_with_headers(csvf)
-            create_with_headers(csvf2)
-            create_with_headers(tsvf, delimiter='\t')
-            create_with_headers(tsvf2, delimiter='\t')
-
-            def append_measurement(fn, delimiter=","):
-                with open(fn, 'a') as f:
-                    f.write(delimiter.join(str(x) for x in measurement) + "\n")
-
-            append_measurement(csvf)
-            append_measurement(csvf2)
-            append_measurement(tsvf, delimiter='\t')
-            append_measurement(tsvf2, delimiter='\t')
-
+            start = datetime.datetime.combine(day, datetime.time.min)
+            end = datetime.datetime.combine(day, datetime.time.max)
+            records = self.store.records(start, end)
+            name = day.strftime("%Y_%m_%d")
+            for fmt in ("csv", "tsv", "json"):
+                f = self.store.export(self.export_file(name, fmt), fmt, start=start, end=end)
+                self.journal.add(f, self.output_dir)
+            for fmt in ("csv", "tsv"):
+                f = self.export_file("alltime", fmt)
+                text = SensorStore.render(self.data_headers, records, fmt)
+                if os.path.exists(f):
+                    # only a new file gets the header row.
+                    text = text.split("\n", 1)[1]
+                with open(f, 'a', newline='') as alltime:
+                    alltime.write(text)
+                self.journal.add(f, self.output_dir)
+            self.logger.info("Wrote {} measurements for {}".format(len(records), day.isoformat()))
         except Exception as e:
-            self.logger.error("Error appending measurement to the all time data: {}".format(str(e)))
-
-    def rotate(self, csvf, tsvf):
-        def last_line(f):
-            f.seek(-1024, 2)
-            return f.readlines()[-1].decode()
+            self.logger.error("Error writing data for {}: {}".format(day.isoformat(), str(e)))
 
-        rotatecsv, rotatetsv = False, False
-        try:
-            with open(csvf, 'rb') as f:
-                lastd = datetime.datetime.strptime(last_line(f).split(",")[0])
-                if lastd.day != datetime.date.today().day:
-                    rotatecsv = True
+    def finish_missed_days(self):
+        """
+        finishes any days that were stored while the sensor was running, but never finished because it stopped before
+        the day was over.
+        """
+        for day in self.store.days():
+            if day < datetime.date.today() and not os.path.exists(self.export_file(day.strftime("%Y_%m_%d"), "csv")):
+                self.finish_day(day)
 
-            if rotatecsv:
-                shutil.move(csvf, csvf.replace("lastday", lastd.strftime(self.timestamp_format)))
-        except:
-            # cannot parse datetime because the last line is the header or file doesnt exist
-            pass
+    def record(self, measurement: dict):
+        """
+        appends a measurement to the store, writing out the text files if a day was finished or the rolling
+        files are due.
 
-        try:
-            with open(tsvf, 'rb') as f:
-                lastd = datetime.datetime.strptime(last_line(f).split("\t")[0])
-                if lastd.day != datetime.date.today().day:
-                    rotatetsv = True
-            if rotatetsv:
-                shutil.move(tsvf, tsvf.replace("lastday", lastd.strftime(self.timestamp_format)))
-        except:
-            # cannot parse datetime because the last line is the header or file doesnt exist
-            pass
+        :param measurement: dict of measurements and their names
+        """
+        finished = self.store.append(self.current_capture_time, measurement)
+        if finished is not None:
+            self.finish_day(finished)
+            self.write_daily_rolling()
+        elif self.export_interval and time.time() - self.last_export >= self.export_interval:
+            self.write_daily_rolling()
 
     def run(self):
         """
@@ -253,29 +234,26 @@ class Sensor(Thread):
         used for threaded sensors
         :return:
         """
+        if self.store is not None:
+            self.finish_missed_days()
         while True and not self.stopper.is_set():
             self.current_capture_time = datetime.datetime.now()
             # checking if enabled and other stuff
             if self.time_to_measure:
                 try:
                     measurement = self.get_measurement()
-                    try:
-                        telegraf_client = telegraf.TelegrafClient(host="localhost", port=8092)
-                        telegraf_client.metric("env_sensors", measurement)
-                        self.logger.info("Sensors: {}".format(str(measurement)))
-                    except Exception as exc:
-                        self.logger.error("Couldnt communicate with telegraf client. {}".format(str(exc)))
-                    # make ordered list of the data for writing. to disk.
-                    m = [measurement[k] for k in self.data_headers]
-                    self.measurements.append([self.current_capture_time.strftime(self.timestamp_format), *measurement])
-                    self.append_to_alltime(self.measurements[-1])
-                    self.write_daily_rolling()
+                    Telemetry.get_telemetry().metric("env_sensors", measurement)
+                    self.logger.info("Sensors: {}".format(str(measurement)))
+                    if self.store is not None:
+                        self.record(measurement)
                 except Exception as e:
                     self.logger.critical("Sensor data error - {}".format(str(e)))
                 # make sure we cannot record twice.
-                time.sleep(Sensor.accuracy * 2)
+                self.stopper.wait(Sensor.accuracy * 2)
 
-            time.sleep(0.1)
+            self.stopper.wait(0.1)
+        if self.store is not None:
+            self.store.close()
 
     def get_measurement(self) -> dict:
         """
@@ -0,0 +1,362 @@
+import csv
+import datetime
+import io
+import json
+import logging.config
+import math
+import mmap
+import os
+import struct
+from glob import glob
+from threading import Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class SensorStore(object):
+    """
+    Append-only store of sensor measurements, the source of truth that text exports are rendered from.
+
+    Measurements are fixed width binary records (a float64 timestamp and a float64 for each field, NaN for missing
+    values) in one memory-mapped segment file per day. Appending a measurement only writes its record into the map,
+    so the kernel writes back a page every so often instead of opening and rewriting files every sample.
+
+    Space for a segment is reserved on the card with :func:`os.posix_fallocate` when it is created or grown, before
+    it is mapped. Writing to a mapped page that has no space behind it kills the process with SIGBUS when the card
+    is full, reserving first turns that into an OSError, and the measurement is logged and skipped instead.
+
+    Each segment starts with a header holding the field names, so that segments can be read by other processes
+    (like the web interface) with :func:`SensorStore.read_segment`. Records are appended in order and unused
+    records are zero, so the number of records is recovered by finding the first zero timestamp.
+
+    CSV, TSV and JSON are rendered from the records with :func:`render`, on request or once a segment is finished.
+
+    :cvar bytes magic: segment file signature.
+    :cvar int header_size: bytes reserved for the segment header.
+    :cvar str extension: segment file extension.
+    :cvar str timestamp_format: format of the datetime column in the exports.
+    """
+    magic = b"SPCS"
+    version = 1
+    header_size = 4096
+    extension = ".dat"
+    timestamp_format = "%Y-%m-%dT%H:%M:%S"
+    _header = struct.Struct("<4sHHI")
+
+    def __init__(self, directory: str, identifier: str, fields: tuple, capacity: int = 1440):
+        """
+        :param directory: directory to keep segments in, created if it doesnt exist.
+        :param identifier: sensor identifier, segments are named after it.
+        :param fields: names of the measured fields, in record order.
+        :param capacity: records a new segment has room for, segments grow if they fill up.
+        """
+        self.directory = directory
+        self.identifier = identifier
+        self.fields = tuple(fields)
+        self.capacity = max(int(capacity), 1)
+        self.logger = logging.getLogger("SensorStore|{}".format(identifier))
+        self._record = struct.Struct("<{}d".format(len(self.fields) + 1))
+        self._lock = Lock()
+        self._file = None
+        self._mmap = None
+        self._day = None
+        self._count = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def record_size(self) -> int:
+        """
+        bytes per record.
+        """
+        return self._record.size
+
+    def segment_path(self, day: datetime.date) -> str:
+        """
+        path of the segment for a day.
+
+        :param day: date of the segment
+        :return: segment file path
+        :rtype: str
+        """
+        return os.path.join(self.directory, "{}-{}{}".format(self.identifier, day.strftime("%Y_%m_%d"), self.extension))
+
+    def days(self) -> list:
+        """
+        dates that there are segments for, oldest first.
+
+        :rtype: list(datetime.date)
+        """
+        days = []
+        prefix = len(self.identifier) + 1
+        for fn in glob(os.path.join(self.directory, "{}-*{}".format(self.identifier, self.extension))):
+            try:
+                days.append(datetime.datetime.strptime(
+                    os.path.basename(fn)[prefix:-len(self.extension)], "%Y_%m_%d").date())
+            except ValueError:
+                pass
+        return sorted(days)
+
+    def _header_bytes(self) -> bytes:
+        names = bytes(json.dumps(self.fields), "utf-8")
+        header = self._header.pack(self.magic, self.version, len(self.fields), self.record_size) + names
+        if len(header) > self.header_size:
+            raise ValueError("Too many fields for a segment header")
+        return header.ljust(self.header_size, b"\0")
+
+    @classmethod
+    def _read_header(cls, data: bytes) -> tuple:
+        """
+        parses a segment header.
+
+        :return: field names and record size
+        :rtype: tuple(tuple, int)
+        :raises ValueError: if the header isnt a valid segment header.
+        """
+        magic, version, nfields, record_size = cls._header.unpack_from(data)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError("Not a sensor store segment")
+        fields = tuple(json.loads(data[cls._header.size:cls.header_size].rstrip(b"\0").decode("utf-8")))
+        if len(fields) != nfields or record_size != (nfields + 1) * 8:
+            raise ValueError("Corrupt sensor store segment header")
+        return fields, record_size
+
+    def _reserve(self, size: int):
+        """
+        reserves space on the card for the first `size` bytes of the open segment, growing it if needed.
+
+        :raises OSError: if there isnt enough space.
+        """
+        os.posix_fallocate(self._file.fileno(), 0, size)
+
+    def _open(self, day: datetime.date):
+        """
+        maps the segment for a day, creating it if it doesnt exist.
+        a segment written with different fields is moved aside.
+
+        :raises OSError: if there isnt space on the card for the segment.
+        """
+        self.close()
+        path = self.segment_path(day)
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    fields, _ = self._read_header(f.read(self.header_size))
+                if fields != self.fields:
+                    raise ValueError("Segment has fields {}".format(fields))
+            except (ValueError, struct.error) as e:
+                self.logger.warning("Moving aside unusable segment {}: {}".format(path, str(e)))
+                os.replace(path, path + ".old")
+        created = not os.path.exists(path)
+        if created:
+            with open(path, 'wb') as f:
+                f.write(self._header_bytes())
+        self._file = open(path, 'r+b')
+        try:
+            # existing segments too, they may have been made sparse by an older version.
+            self._reserve(max(os.fstat(self._file.fileno()).st_size,
+                              self.header_size + self.capacity * self.record_size))
+        except OSError:
+            self._file.close()
+            self._file = None
+            if created:
+                os.remove(path)
+            raise
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._day = day
+        self._count = self._recover_count()
+
+    def _slots(self) -> int:
+        return (len(self._mmap) - self.header_size) // self.record_size
+
+    def _timestamp_at(self, idx: int) -> float:
+        return struct.unpack_from("<d", self._mmap, self.header_size + idx * self.record_size)[0]
+
+    def _recover_count(self) -> int:
+        """
+        finds the number of records in the mapped segment, by binary search for the first empty record.
+        """
+        lo, hi = 0, self._slots()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp_at(mid) != 0:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _grow(self):
+        """
+        doubles the room in the mapped segment.
+
+        :raises OSError: if there isnt space on the card, the segment is left as it was.
+        """
+        size = len(self._mmap)
+        try:
+            self._reserve(self.header_size + self._slots() * 2 * self.record_size)
+        except OSError:
+            # dont leave a partly reserved tail for the next map of this segment.
+            self._file.truncate(size)
+            raise
+        self._mmap.close()
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+    def append(self, t: datetime.datetime, values: dict) -> datetime.date:
+        """
+        appends a measurement, starting a new segment if it is for a different day to the last one.
+        values that are missing or arent numbers are stored as missing.
+        if there isnt space on the card for the measurement it is logged and skipped.
+
+        :param t: time of the measurement
+        :param values: dict of field name: value
+        :return: the day whose segment was finished by this measurement, or None.
+        :rtype: datetime.date
+        """
+        record = []
+        for k in self.fields:
+            try:
+                record.append(float(values.get(k)))
+            except (TypeError, ValueError):
+                record.append(math.nan)
+        with self._lock:
+            finished = None
+            day = t.date()
+            try:
+                if day != self._day:
+                    finished = self._day
+                    self._open(day)
+                if self._count >= self._slots():
+                    self._grow()
+            except OSError as e:
+                self.logger.error("No space for measurement at {}, skipped: {}".format(t.isoformat(), str(e)))
+                return finished
+            offset = self.header_size + self._count * self.record_size
+            # values before the timestamp, so a reader never sees a timestamp with half a record.
+            self._mmap[offset + 8:offset + self.record_size] = struct.pack("<{}d".format(len(record)), *record)
+            struct.pack_into("<d", self._mmap, offset, t.timestamp())
+            self._count += 1
+            return finished
+
+    def flush(self):
+        """
+        writes the mapped segment back to the card now, rather than whenever the kernel gets to it.
+        """
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.flush()
+
+    def close(self):
+        """
+        flushes and unmaps the current segment.
+        """
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._day = None
+
+    @classmethod
+    def read_segment(cls, path: str) -> tuple:
+        """
+        reads the records of a segment file, without mapping it.
+
+        :param path: segment file path
+        :return: field names, and list of records as (timestamp, value, ...) tuples with NaN for missing values.
+        :rtype: tuple(tuple, list)
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        fields, record_size = cls._read_header(data)
+        body = memoryview(data)[cls.header_size:]
+        body = body[:len(body) - len(body) % record_size]
+        records = []
+        for record in struct.iter_unpack("<{}d".format(len(fields) + 1), body):
+            if record[0] == 0:
+                break
+            records.append(record)
+        return fields, records
+
+    def records(self, start: datetime.datetime = None, end: datetime.datetime = None) -> list:
+        """
+        reads the records between two times from every segment that covers them.
+
+        :param start: earliest time, or None for the start of the oldest segment.
+        :param end: latest time, or None for now.
+        :return: list of (timestamp, value, ...) tuples
+        :rtype: list(tuple)
+        """
+        lo = start.timestamp() if start else 0
+        hi = end.timestamp() if end else math.inf
+        records = []
+        for day in self.days():
+            if (start and day < start.date()) or (end and day > end.date()):
+                continue
+            try:
+                fields, segment = self.read_segment(self.segment_path(day))
+            except (OSError, ValueError, struct.error) as e:
+                self.logger.error("Couldnt read segment for {}: {}".format(day.isoformat(), str(e)))
+                continue
+            if fields != self.fields:
+                continue
+            records.extend(r for r in segment if lo <= r[0] <= hi)
+        return records
+
+    @classmethod
+    def render(cls, fields: tuple, records: list, fmt: str) -> str:
+        """
+        renders records as text, in the same layout the sensors have always written.
+
+        csv and tsv have a header row of datetime and the field names, json is a dict of column name: list of values.
+        missing values are empty in csv and tsv, and null in json.
+
+        :param fields: field names
+        :param records: list of (timestamp, value, ...) tuples
+        :param fmt: one of "csv", "tsv" or "json"
+        :return: rendered text
+        :rtype: str
+        """
+        def fmt_time(ts):
+            return datetime.datetime.fromtimestamp(ts).strftime(cls.timestamp_format)
+
+        def fmt_value(v):
+            return None if math.isnan(v) else v
+
+        if fmt == "json":
+            columns = {k: [] for k in fields}
+            columns['datetime'] = []
+            for record in records:
+                columns['datetime'].append(fmt_time(record[0]))
+                for k, v in zip(fields, record[1:]):
+                    columns[k].append(fmt_value(v))
+            return json.dumps(columns)
+        if fmt not in ("csv", "tsv"):
+            raise ValueError("Unknown export format {}".format(fmt))
+        out = io.StringIO()
+        writer = csv.writer(out, dialect=csv.excel if fmt == "csv" else csv.excel_tab)
+        writer.writerow(("datetime", *fields))
+        writer.writerows((fmt_time(r[0]), *(fmt_value(v) for v in r[1:])) for r in records)
+        return out.getvalue()
+
+    def export(self, path: str, fmt: str, start: datetime.datetime = None, end: datetime.datetime = None) -> str:
+        """
+        renders the records between two times to a file, replacing it atomically.
+
+        :param path: file to write
+        :param fmt: one of "csv", "tsv" or "json"
+        :param start: earliest time, or None for the start of the oldest segment.
+        :param end: latest time, or None for now.
+        :return: the path written
+        :rtype: str
+        """
+        text = self.render(self.fields, self.records(start, end), fmt)
+        tmp = path + ".tmp"
+        with open(tmp, 'w', newline='') as f:
+            f.write(text)
+        os.replace(tmp, path)
+        return path
@@ -0,0 +1,282 @@
+import logging.config
+import time
+from threading import Thread, Event, Lock
+from libs.FrameBuffer import FrameBuffer
+from libs.DeviceBroker import DeviceBroker
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class Stream(Thread):
+    """
+    Live stream capture loop for one physical device.
+
+    Runs a frame source, a callable returning an iterator of (channel, encoded frame) tuples, and publishes each
+    frame into the :class:`libs.FrameBuffer.FrameBuffer` for its channel. Most devices only have the channel None,
+    multiplexed devices like the IVPort have one channel per sensor.
+
+    The stream stops by itself when nobody has asked for frames for `idle_timeout` seconds, closing the source so
+    that the device is released.
+
+    The device is held through a :class:`libs.DeviceBroker.DeviceBroker`, when a timelapse capture needs the
+    sensor the source is closed, and reopened once the capture is done. Viewers just see a short pause.
+
+    If the source cant be opened, because a camera that keeps the device open between captures still has it, the
+    stream keeps its request up and retries with backoff (from `retry_min` up to `retry_max` seconds) until the
+    camera sees the request and closes the device.
+
+    :cvar float retry_min: seconds before the first retry of a source that failed.
+    :cvar float retry_max: longest wait between retries.
+    """
+    retry_min = 0.5
+    retry_max = 10
+
+    def __init__(self, key: str, source, buffers: dict, device: str = None, idle_timeout: float = 10):
+        """
+        :param key: identifier of the stream
+        :param source: callable returning an iterator of (channel, frame) tuples.
+        :param buffers: dict of channel: FrameBuffer to publish into
+        :param device: physical device the source uses, defaults to the key.
+        :param idle_timeout: seconds without viewers before the stream stops
+        """
+        super().__init__(name="STREAM|{}".format(key))
+        self.daemon = True
+        self.key = key
+        self.source = source
+        self.buffers = buffers
+        self.idle_timeout = idle_timeout
+        self.broker = DeviceBroker.get_broker(device or key)
+        self.preemptions = 0
+        self.logger = logging.getLogger(self.getName())
+        self.stopper = Event()
+        self.last_access = time.time()
+
+    def touch(self):
+        """
+        records that a viewer wants frames, keeping the stream alive.
+        """
+        self.last_access = time.time()
+
+    @property
+    def idle(self) -> bool:
+        """
+        whether nobody has asked for frames in the last `idle_timeout` seconds.
+        """
+        return time.time() - self.last_access > self.idle_timeout
+
+    def _publish_until_preempted(self) -> bool:
+        """
+        opens the source and publishes frames until stopped, idle or a capture wants the device.
+
+        :return: whether the stream was preempted, and should reopen the source.
+        :rtype: bool
+        """
+        frames = None
+        try:
+            frames = iter(self.source())
+            for channel, frame in frames:
+                buffer = self.buffers.get(channel)
+                if buffer is not None:
+                    buffer.publish(frame)
+                if self.stopper.is_set() or self.idle:
+                    return False
+                if self.broker.preempt_requested:
+                    return True
+        finally:
+            # closing a generator source runs its cleanup, releasing the device.
+            if hasattr(frames, "close"):
+                frames.close()
+        return False
+
+    def run(self):
+        """
+        publishes frames from the source until stopped or idle, handing the device over to captures.
+        """
+        self.logger.info("Stream started")
+        retry = self.retry_min
+        try:
+            with self.broker.stream_request():
+                while not self.stopper.is_set() and not self.idle:
+                    try:
+                        with self.broker.stream(stopper=self.stopper):
+                            preempted = self._publish_until_preempted()
+                    except TimeoutError:
+                        raise
+                    except Exception as e:
+                        # most likely a capture session still has the device, it closes it when it sees our request.
+                        self.logger.warning("Stream source failed, retrying in {0:.1f}s: {1}".format(retry, str(e)))
+                        self.stopper.wait(retry)
+                        retry = min(retry * 2, self.retry_max)
+                        continue
+                    retry = self.retry_min
+                    if not preempted:
+                        break
+                    self.preemptions += 1
+                    self.logger.debug("Preempted by a capture")
+        except Exception as e:
+            self.logger.error("Stream failed: {}".format(str(e)))
+        self.logger.info("Stream stopped")
+
+    def stop(self):
+        """
+        stops the stream after the next frame.
+        """
+        self.stopper.set()
+
+
+class StreamManager(object):
+    """
+    Process wide registry of live streams, keyed by camera identifier.
+
+    Frame sources are registered once, and a :class:`Stream` is only started when someone asks for frames. Each
+    physical device runs one stream at a time, sources registered with the same `device` (like a picamera and an
+    IVPort on the same camera port) stop each other.
+
+    Frame buffers outlive their streams, so viewers keep waiting on the same buffer while a stream restarts.
+
+    Use :func:`StreamManager.get_manager` to get the shared instance.
+    """
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_manager(cls) -> 'StreamManager':
+        """
+        gets the process wide stream manager.
+
+        :return: the stream manager
+        :rtype: StreamManager
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.logger = logging.getLogger("StreamManager")
+        self._lock = Lock()
+        self._sources = dict()
+        self._buffers = dict()
+        self._streams = dict()
+
+    def register(self, key: str, source, channels: tuple = (None,), device: str = None, idle_timeout: float = 10):
+        """
+        registers a frame source for a camera, replacing any source already registered for it.
+
+        :param key: camera identifier
+        :param source: callable returning an iterator of (channel, encoded frame) tuples
+        :param channels: channels the source produces
+        :param device: physical device the source uses, defaults to the key.
+        :param idle_timeout: seconds without viewers before the stream stops
+        """
+        with self._lock:
+            self._sources[key] = (source, tuple(channels), device or key, idle_timeout)
+            buffers = self._buffers.setdefault(key, dict())
+            for channel in channels:
+                buffers.setdefault(channel, FrameBuffer())
+
+    def registered(self, key: str) -> bool:
+        """
+        whether a source is registered for a camera.
+        """
+        return key in self._sources
+
+    def is_streaming(self, key: str) -> bool:
+        """
+        whether the stream for a camera is running.
+        """
+        with self._lock:
+            stream = self._streams.get(key)
+            return stream is not None and stream.is_alive()
+
+    def keys(self) -> list:
+        """
+        lists the registered streams.
+
+        :return: list of (camera identifier, channels)
+        :rtype: list(tuple)
+        """
+        with self._lock:
+            return [(key, channels) for key, (_, channels, _, _) in self._sources.items()]
+
+    def open(self, key: str) -> Stream:
+        """
+        gets the running stream for a camera, starting it if it isnt running.
+
+        :param key: camera identifier
+        :return: the running stream
+        :rtype: Stream
+        """
+        with self._lock:
+            if key not in self._sources:
+                raise KeyError("No stream registered for {}".format(key))
+            stream = self._streams.get(key)
+            if stream is not None and stream.is_alive() and not stream.stopper.is_set():
+                stream.touch()
+                return stream
+            source, channels, device, idle_timeout = self._sources[key]
+            for other_key, other in list(self._streams.items()):
+                if other_key != key and self._sources[other_key][2] == device and other.is_alive():
+                    self.logger.info("Stopping stream {} to free {} for {}".format(other_key, device, key))
+                    other.stop()
+                    other.join(idle_timeout)
+            stream = Stream(key, source, self._buffers[key], device=device, idle_timeout=idle_timeout)
+            self._streams[key] = stream
+            stream.start()
+            return stream
+
+    def latest(self, key: str, channel=None) -> bytes:
+        """
+        gets the newest frame from a camera, starting its stream if needed.
+
+        :param key: camera identifier
+        :param channel: channel of the camera
+        :return: encoded frame, or None if there isnt one yet.
+        :rtype: bytes
+        """
+        self.open(key)
+        return self._buffers[key][channel].latest()[1]
+
+    def frames(self, key: str, channel=None, timeout: float = 5):
+        """
+        yields each new frame from a camera once, blocking until it is available.
+        keeps the stream running for as long as the generator is being consumed.
+
+        :param key: camera identifier
+        :param channel: channel of the camera
+        :param timeout: seconds to wait for a frame before checking on the stream.
+        :return: generator of encoded frames
+        """
+        buffer = self._buffers[key][channel]
+        with buffer.client():
+            seq = 0
+            while True:
+                self.open(key)
+                got = buffer.wait(seq, timeout)
+                if got is None:
+                    continue
+                seq, frame = got
+                yield frame
+
+    def stats(self, key: str = None) -> dict:
+        """
+        gets live stream metrics, see :func:`libs.FrameBuffer.FrameBuffer.stats`.
+
+        :param key: camera identifier, or None for all cameras.
+        :return: dict of channel: metrics for one camera, or dict of camera identifier: that for all of them.
+        :rtype: dict
+        """
+        with self._lock:
+            keys = [key] if key is not None else list(self._buffers.keys())
+            result = dict()
+            for k in keys:
+                stream = self._streams.get(k)
+                result[k] = {str(channel): dict(running=bool(stream and stream.is_alive()),
+                                                preemptions=stream.preemptions if stream else 0,
+                                                **buffer.stats())
+                             for channel, buffer in self._buffers[k].items()}
+        return result[key] if key is not None else result
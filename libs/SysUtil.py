@@ -13,6 +13,7 @@ import collections
 from dateutil import parser
 import traceback
 from zlib import crc32
+import hashlib
 
 USBDEVFS_RESET = 21780
 try:
@@ -329,6 +330,22 @@ class SysUtil(object):
             checksum = "{:X}".format(crc32(f.read()))
         return checksum
 
+    @staticmethod
+    def get_file_digest(fp: str, chunk_size: int = 1024 * 1024) -> str:
+        """
+        gets the sha1 digest of a file, reading it in chunks so big files dont have to fit in memory.
+        strong enough to decide two files have the same content, unlike :func:`get_checksum`.
+
+        :param fp: file path of the file.
+        :param chunk_size: bytes to read at a time
+        :return: hex sha1 digest of the file
+        """
+        digest = hashlib.sha1()
+        with open(fp, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
     @staticmethod
     def get_checksum_from_str(input_data) -> str:
         """
@@ -563,12 +580,13 @@ class SysUtil(object):
     @classmethod
     def get_log_files(cls) -> list:
         """
-        returns the spc-eyepi log files that have been rotated.
+        returns the spc-eyepi log files that have been rotated, and any profiles from
+        :class:`libs.Profiler.SamplingProfiler`.
 
         :return: list of filenames
         :rtype: list(str)
         """
-        return list(glob("/home/spc-eyepi/spc-eyepi.log.*"))
+        return list(glob("/home/spc-eyepi/spc-eyepi.log.*")) + list(glob("/home/spc-eyepi/spc-eyepi.profile.*"))
 
     @classmethod
     def clear_files(cls, filenames: list):
@@ -0,0 +1,264 @@
+import logging.config
+import os
+import socket
+import time
+from collections import deque
+from threading import Thread, Event, Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+def _escape(value: str, chars: str) -> str:
+    """
+    backslash escapes characters for influx line protocol.
+    """
+    value = str(value)
+    for c in chars:
+        value = value.replace(c, "\\" + c)
+    return value
+
+
+def _field_value(value) -> str:
+    """
+    formats a field value for influx line protocol.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "{}i".format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(_escape(value, '\\"'))
+
+
+def to_line(measurement: str, fields: dict, tags: dict = None, timestamp: int = None) -> str:
+    """
+    formats a point as influx line protocol.
+
+    :param measurement: measurement name
+    :param fields: dict of field values, None values are left out.
+    :param tags: dict of tags
+    :param timestamp: timestamp in nanoseconds
+    :return: line protocol line, or None if there are no fields.
+    :rtype: str
+    """
+    fields = ",".join("{}={}".format(_escape(k, ", ="), _field_value(v))
+                      for k, v in sorted(fields.items()) if v is not None)
+    if not fields:
+        return None
+    line = _escape(measurement, ", ")
+    if tags:
+        line += "".join(",{}={}".format(_escape(k, ", ="), _escape(v, ", ="))
+                        for k, v in sorted(tags.items()) if v is not None and v != "")
+    line += " " + fields
+    if timestamp is not None:
+        line += " {}".format(int(timestamp))
+    return line
+
+
+class Telemetry(Thread):
+    """
+    Process wide telemetry emitter, sending metrics to the local telegraf udp listener.
+
+    :func:`metric` only appends to a deque, so it is cheap enough to call from the capture path. A background thread
+    formats the queued points as line protocol and sends them in datagrams of up to `max_datagram` bytes over one
+    socket, every `flush_interval` seconds.
+
+    If telegraf isnt listening, lines are appended to a spool file instead (up to `spool_max_bytes`, newer lines are
+    dropped after that) and resent once sending works again. Points carry the time they were recorded, so late
+    points land in the right place.
+
+    A connected udp socket only finds out that nobody is listening from an icmp error that arrives after the send,
+    so each flush is only trusted once the socket reports no error at the next flush. Until then the lines are kept,
+    and the spool file isnt removed, so that they can be spooled if they were refused.
+
+    Use :func:`Telemetry.get_telemetry` to get the shared instance.
+
+    :cvar str host: telegraf host
+    :cvar int port: telegraf udp listener port
+    :cvar int max_datagram: maximum bytes per datagram
+    :cvar float flush_interval: seconds between flushes
+    :cvar int max_queued: points kept in memory, the oldest are dropped after that.
+    :cvar str spool_path: file lines are spooled to when telegraf is down.
+    :cvar int spool_max_bytes: maximum size of the spool file.
+    :cvar float retry_interval: seconds to spool for before trying telegraf again, after it refused lines.
+    """
+    host = "localhost"
+    port = 8092
+    max_datagram = 1400
+    flush_interval = 1.0
+    max_queued = 10000
+    spool_path = "/home/spc-eyepi/telemetry.spool"
+    spool_max_bytes = 4 * 1024 * 1024
+    retry_interval = 30
+
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_telemetry(cls) -> 'Telemetry':
+        """
+        gets the process wide telemetry emitter, starting it if this is the first call.
+
+        :return: the telemetry emitter
+        :rtype: Telemetry
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        super().__init__(name="Telemetry")
+        self.daemon = True
+        self.logger = logging.getLogger("Telemetry")
+        self.stopper = Event()
+        self._queue = deque(maxlen=self.max_queued)
+        self._socket = None
+        # (lines, whether the spool was resent with them) of the last flush, until the socket confirms them.
+        self._in_flight = None
+        self._retry_at = 0
+        self.sent = 0
+        self.spooled = 0
+        self.dropped = 0
+
+    def metric(self, measurement: str, fields: dict, tags: dict = None):
+        """
+        queues a point to be sent, this never blocks or raises.
+
+        :param measurement: measurement name
+        :param fields: dict of field values
+        :param tags: dict of tags
+        """
+        self._queue.append((measurement, dict(fields), dict(tags or {}), int(time.time() * 1e9)))
+
+    def _send(self, lines: list):
+        """
+        sends lines to telegraf, packed into as few datagrams as possible.
+
+        :param lines: line protocol lines
+        :raises OSError: if telegraf isnt listening
+        """
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # connected, so that a closed port is reported back to us instead of being silently dropped.
+            self._socket.connect((self.host, self.port))
+        batch = b""
+        for line in lines:
+            data = bytes(line + "\n", "utf-8")
+            if batch and len(batch) + len(data) > self.max_datagram:
+                self._socket.send(batch)
+                batch = b""
+            batch += data
+        if batch:
+            self._socket.send(batch)
+        self.sent += len(lines)
+
+    def _spool(self, lines: list):
+        """
+        appends lines to the spool file, dropping them if the spool is full.
+        """
+        if not lines:
+            return
+        try:
+            size = os.path.getsize(self.spool_path) if os.path.exists(self.spool_path) else 0
+            data = "".join(line + "\n" for line in lines)
+            if size + len(data) > self.spool_max_bytes:
+                self.dropped += len(lines)
+                return
+            with open(self.spool_path, 'a') as f:
+                f.write(data)
+            self.spooled += len(lines)
+        except OSError as e:
+            self.dropped += len(lines)
+            self.logger.error("Couldnt spool telemetry: {}".format(str(e)))
+
+    def _read_spool(self) -> list:
+        """
+        reads the spooled lines.
+        """
+        if not os.path.exists(self.spool_path):
+            return []
+        with open(self.spool_path) as f:
+            return [line.rstrip("\n") for line in f if line.strip()]
+
+    def _refused(self) -> bool:
+        """
+        checks whether telegraf refused anything sent on the socket since it was last checked.
+        the error from an icmp port unreachable is held by the socket until it is read, here or by the next send.
+        """
+        if self._socket is None:
+            return False
+        return self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0
+
+    def _settle(self):
+        """
+        confirms or spools the lines sent by the last flush, removing the spool if it was resent and got through.
+        """
+        if self._in_flight is None:
+            return
+        lines, resent_spool = self._in_flight
+        self._in_flight = None
+        if self._refused():
+            self.logger.debug("Telegraf refused telemetry, spooling {} lines".format(len(lines)))
+            self.sent -= len(lines)
+            # the spool, if it was resent, is still there to send again.
+            self._spool(lines)
+            self._retry_at = time.time() + self.retry_interval
+        elif resent_spool:
+            os.remove(self.spool_path)
+            self.logger.info("Resent spooled telemetry")
+
+    def flush(self):
+        """
+        sends everything that is queued, spooling it if telegraf isnt listening.
+        """
+        self._settle()
+        lines = []
+        while True:
+            try:
+                point = self._queue.popleft()
+            except IndexError:
+                break
+            line = to_line(*point)
+            if line:
+                lines.append(line)
+        if time.time() < self._retry_at:
+            self._spool(lines)
+            return
+        try:
+            spooled = self._read_spool()
+            if not lines and not spooled:
+                return
+            self._send(spooled + lines)
+            self._in_flight = (lines, bool(spooled))
+        except OSError as e:
+            self.logger.debug("Couldnt send telemetry, spooling: {}".format(str(e)))
+            self._spool(lines)
+            self._retry_at = time.time() + self.retry_interval
+
+    def run(self):
+        """
+        flushes the queue every `flush_interval` seconds until stopped.
+        """
+        while not self.stopper.is_set():
+            self.stopper.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error("Telemetry flush failed: {}".format(str(e)))
+        self.flush()
+        # give a refusal time to come back, so the last lines are spooled rather than lost.
+        time.sleep(0.1)
+        self._settle()
+
+    def stop(self):
+        """
+        stops the emitter after a last flush.
+        """
+        self.stopper.set()
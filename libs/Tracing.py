@@ -0,0 +1,210 @@
+import json
+import logging.config
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock, get_ident
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+
+class Histogram(object):
+    """
+    Log-linear latency histogram, in the style of HdrHistogram.
+
+    Values are recorded in microseconds into buckets that double in width every 16 buckets, so any value is stored
+    to within about 6% using a fixed number of counters, and recording is O(1) no matter how many values there are.
+    Values over about an hour are clamped into the last bucket.
+    """
+    sub_buckets = 16
+    buckets = 512
+
+    def __init__(self):
+        self._counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, us: int) -> int:
+        """
+        bucket index of a value in microseconds.
+        """
+        if us < cls.sub_buckets * 2:
+            return us
+        shift = us.bit_length() - 5
+        return min(shift * cls.sub_buckets + (us >> shift), cls.buckets - 1)
+
+    @classmethod
+    def _value(cls, idx: int) -> float:
+        """
+        middle of a bucket, in microseconds.
+        """
+        if idx < cls.sub_buckets * 2:
+            return float(idx)
+        shift = idx // cls.sub_buckets - 1
+        sub = idx % cls.sub_buckets + cls.sub_buckets
+        return ((sub << shift) + ((sub + 1) << shift)) / 2.0
+
+    def record(self, seconds: float):
+        """
+        records a value.
+
+        :param seconds: value in seconds
+        """
+        seconds = max(float(seconds), 0.0)
+        self._counts[self._index(int(seconds * 1e6))] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float) -> float:
+        """
+        gets a percentile of the recorded values.
+
+        :param p: percentile, 0-100
+        :return: value in seconds, 0 if nothing has been recorded.
+        :rtype: float
+        """
+        if not self.count:
+            return 0.0
+        target = max(int(round(p / 100.0 * self.count)), 1)
+        seen = 0
+        for idx, c in enumerate(self._counts):
+            seen += c
+            if seen >= target:
+                return min(self._value(idx) / 1e6, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        gets the count, mean, max and p50/p95/p99 of the recorded values, in seconds.
+
+        :rtype: dict
+        """
+        return dict(count=self.count,
+                    mean=self.total / max(self.count, 1),
+                    max=self.max,
+                    p50=self.percentile(50),
+                    p95=self.percentile(95),
+                    p99=self.percentile(99))
+
+
+class Tracer(object):
+    """
+    Process wide span recorder for the capture and upload paths.
+
+    Each span (like "capture", "encode_jpg" or "upload") is timed and recorded into a :class:`Histogram` per camera
+    identifier and span name. Recording only takes a lock and increments a counter, so it is fine on the capture path.
+
+    :func:`publish` writes a summary of every histogram to `snapshot_path`, so that other processes (the web
+    interface) can read it with :func:`Tracer.load_snapshot`.
+
+    Use :func:`Tracer.get_tracer` to get the shared instance.
+
+    :cvar str snapshot_path: file the summaries are published to, should be on a tmpfs.
+    """
+    snapshot_path = "/dev/shm/spc-eyepi-spans.json"
+
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_tracer(cls) -> 'Tracer':
+        """
+        gets the process wide tracer.
+
+        :return: the tracer
+        :rtype: Tracer
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.logger = logging.getLogger("Tracer")
+        self._lock = Lock()
+        # key: {span name: Histogram}
+        self._histograms = dict()
+
+    def record(self, key: str, name: str, seconds: float):
+        """
+        records a span that was timed elsewhere.
+
+        :param key: camera identifier
+        :param name: span name
+        :param seconds: duration of the span
+        """
+        if key is None:
+            return
+        with self._lock:
+            histogram = self._histograms.setdefault(key, dict()).get(name)
+            if histogram is None:
+                histogram = self._histograms[key][name] = Histogram()
+            histogram.record(seconds)
+
+    @contextmanager
+    def span(self, key: str, name: str):
+        """
+        times the body of a with statement as a span, it is recorded even if the body raises.
+
+        :param key: camera identifier
+        :param name: span name
+        """
+        st = time.time()
+        try:
+            yield
+        finally:
+            self.record(key, name, time.time() - st)
+
+    def snapshot(self, key: str = None) -> dict:
+        """
+        gets the histogram summaries, see :func:`Histogram.summary`.
+
+        :param key: camera identifier, or None for all cameras.
+        :return: dict of span name: summary for one camera, or dict of camera identifier: that for all of them.
+        :rtype: dict
+        """
+        with self._lock:
+            result = {k: {name: histogram.summary() for name, histogram in spans.items()}
+                      for k, spans in self._histograms.items() if key is None or k == key}
+        return result.get(key, dict()) if key is not None else result
+
+    def publish(self) -> dict:
+        """
+        writes the summaries for every camera to :attr:`snapshot_path`, replacing the last snapshot atomically.
+
+        :return: the summaries that were written
+        :rtype: dict
+        """
+        snapshot = self.snapshot()
+        try:
+            # every cameras hand-off publishes, so each thread needs its own temp file.
+            tmp = "{}.{}.{}".format(self.snapshot_path, os.getpid(), get_ident())
+            with open(tmp, 'w') as f:
+                json.dump(dict(time=time.time(), pid=os.getpid(), spans=snapshot), f)
+            os.replace(tmp, self.snapshot_path)
+        except OSError as e:
+            self.logger.error("Couldnt write span snapshot: {}".format(str(e)))
+        return snapshot
+
+    @classmethod
+    def load_snapshot(cls, key: str = None) -> dict:
+        """
+        reads the summaries published by the capture process.
+
+        :param key: camera identifier, or None for all cameras.
+        :return: dict of span name: summary for one camera, or dict of camera identifier: that for all of them.
+        :rtype: dict
+        """
+        try:
+            with open(cls.snapshot_path) as f:
+                spans = json.load(f).get("spans", dict())
+        except (OSError, ValueError):
+            spans = dict()
+        return spans.get(key, dict()) if key is not None else spans
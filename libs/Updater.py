@@ -10,7 +10,8 @@ import requests
 from schedule import Scheduler
 from .CryptUtil import SSHManager
 from .SysUtil import SysUtil
-import paho.mqtt.client as client
+from .MQTTSession import MQTTSession
+from .Profiler import SamplingProfiler
 from zlib import crc32
 import datetime
 
@@ -27,9 +28,6 @@ remote_server = "traitcapture.org"
 
 api_endpoint = "https://traitcapture.org/api/v3/remote/by-machine/{}"
 
-client_id = str(crc32(bytes(SysUtil.get_hostname() + "-Updater", 'utf8')))
-
-
 class Updater(Thread):
     def __init__(self):
         Thread.__init__(self, name="Updater")
@@ -54,50 +52,23 @@ class Updater(Thread):
                 self.go()
             if payload == "REBOOT":
                 SysUtil.reboot()
-
-    def mqtt_on_connect(self, client, *args):
-        self.logger.debug("Subscribing to rpi/{}/operation".format(SysUtil.get_machineid()))
-        self.mqtt.subscribe("rpi/{}/operation".format(SysUtil.get_machineid()), qos=1)
+            if payload.split(" ")[0] == "PROFILE":
+                # PROFILE or PROFILE <seconds>, sample every thread for a while and write a profile next to the logs.
+                duration = payload.split(" ")[1] if " " in payload else None
+                SamplingProfiler.get_profiler().start(duration=float(duration) if duration else None)
 
     def setupmqtt(self):
-        self.mqtt = client.Client(client_id=client_id,
-                                  clean_session=True,
-                                  protocol=client.MQTTv311,
-                                  transport="tcp")
-
-        self.mqtt.on_message = self.mqtt_on_message
-        self.mqtt.on_connect = self.mqtt_on_connect
-
-        try:
-            with open("mqttpassword") as f:
-                self.mqtt.username_pw_set(username=SysUtil.get_hostname()+"-Updater",
-                                          password=f.read().strip())
-        except FileNotFoundError:
-            auth = SSHManager().sign_message_PSS(datetime.datetime.now().replace(tzinfo=timezone).isoformat())
-            if not auth:
-                raise ValueError
-            self.mqtt.username_pw_set(username=SysUtil.get_machineid(),
-                                      password=auth)
-        except:
-            self.mqtt.username_pw_set(username=SysUtil.get_hostname()+"-Updater",
-                                      password="INVALIDPASSWORD")
-
-        self.mqtt.connect_async("10.9.0.1", port=1883)
-
-        self.mqtt.loop_start()
+        """
+        subscribes to the device operation topic on the process wide :class:`libs.MQTTSession.MQTTSession`.
+        """
+        self.mqtt = MQTTSession.get_session()
+        self.logger.debug("Subscribing to rpi/{}/operation".format(SysUtil.get_machineid()))
+        self.mqtt.subscribe("rpi/{}/operation".format(SysUtil.get_machineid()), self.mqtt_on_message)
 
     def updatemqtt(self, parameter: str, message: bytes):
-        # update mqtt
+        # update mqtt, paho sends it from its own thread so dont wait for it.
         self.logger.debug("Updating mqtt")
-        message = self.mqtt.publish(payload=message,
-                                    topic="rpi/{}/status/{}".format(
-                                        SysUtil.get_machineid(),
-                                        parameter),
-                                    qos=1)
-        time.sleep(0.5)
-        if not message.is_published():
-            self.mqtt.loop_stop()
-            self.mqtt.loop_start()
+        self.mqtt.publish("rpi/{}/status/{}".format(SysUtil.get_machineid(), parameter), message)
 
     def upload_logs(self):
         """
@@ -243,4 +214,4 @@ class Updater(Thread):
     def run(self):
         while True and not self.stopper.is_set():
             self.scheduler.run_pending()
-            time.sleep(1)
+            self.stopper.wait(1)
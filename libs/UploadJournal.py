@@ -0,0 +1,315 @@
+import logging.config
+import os
+import sqlite3
+import time
+from threading import Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+PENDING = "pending"
+IN_FLIGHT = "in-flight"
+DONE = "done"
+FAILED = "failed"
+# only a reduced copy has been uploaded so far, see Uploader.adaptive
+DEFERRED = "deferred"
+
+
+class UploadJournal(object):
+    """
+    Durable journal of files waiting to be uploaded.
+
+    Workers that produce files (cameras, sensors) :func:`add` them to the journal as they are moved into an upload
+    directory, and :class:`libs.Uploader.Uploader` threads :func:`claim` batches of them, marking each one done or
+    failed. The journal is a sqlite database so that a restart resumes where it left off without rescanning the
+    filesystem.
+
+    Each file has a state, one of pending, in-flight, done, failed or deferred, and a retry count.
+    Deferred files have had a reduced copy uploaded over a slow link, and wait to be backfilled.
+
+    The journal also keeps the content digest of files that reached the server, keyed by remote path, so that
+    uploaders can skip unchanged files and send references for duplicates. Digests cover whole files, exif data
+    included, so captures only match if they are the same file.
+
+    :cvar str default_path: path of the journal database used by :func:`get_journal`
+    :cvar int max_retries: failed files are only claimed again every `retry_given_up_s` after this many attempts.
+    :cvar int retry_given_up_s: seconds before a file that ran out of retries gets another attempt.
+    :cvar int keep_done_s: done entries older than this are pruned.
+    :cvar int max_digests: number of remote file digests kept for deduplication, least recently seen are pruned.
+    """
+    default_path = "/home/spc-eyepi/upload_journal.sqlite"
+    max_retries = 10
+    retry_given_up_s = 24 * 60 * 60
+    keep_done_s = 7 * 24 * 60 * 60
+    max_digests = 100000
+
+    _instances = dict()
+    _instances_lock = Lock()
+
+    @classmethod
+    def get_journal(cls, path: str = None) -> 'UploadJournal':
+        """
+        gets the shared journal for a database path, defaults to :attr:`default_path`.
+
+        :param path: path to the journal database
+        :return: the journal
+        :rtype: UploadJournal
+        """
+        path = os.path.abspath(path or cls.default_path)
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def __init__(self, path: str):
+        """
+        :param path: path to the journal database, created if it doesnt exist.
+        """
+        self.path = path
+        self.logger = logging.getLogger("UploadJournal")
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            # WAL keeps the number of writes to the sd card down.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                                path TEXT PRIMARY KEY,
+                                source_dir TEXT NOT NULL,
+                                state TEXT NOT NULL,
+                                retries INTEGER NOT NULL DEFAULT 0,
+                                added REAL NOT NULL,
+                                updated REAL NOT NULL,
+                                error TEXT)""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS uploads_by_state ON uploads (source_dir, state, added)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS seeded (source_dir TEXT PRIMARY KEY, at REAL NOT NULL)")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS remote (
+                                remote_path TEXT PRIMARY KEY,
+                                digest TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                seen REAL NOT NULL)""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS remote_by_digest ON remote (digest)")
+
+    @staticmethod
+    def _dir(source_dir: str) -> str:
+        return os.path.abspath(source_dir)
+
+    def add(self, path: str, source_dir: str = None):
+        """
+        adds a file to the journal as pending, or sets it back to pending if it was already in the journal
+        (like last_image.jpg, that is overwritten every capture).
+
+        :param path: path to the file
+        :param source_dir: upload directory the file is in, defaults to the directory containing the file.
+        """
+        path = os.path.abspath(path)
+        source_dir = self._dir(source_dir or os.path.dirname(path))
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO uploads (path, source_dir, state, retries, added, updated) "
+                             "VALUES (?, ?, ?, 0, ?, ?)", (path, source_dir, PENDING, now, now))
+
+    def seed(self, source_dir: str, paths: list):
+        """
+        adds files that were already in an upload directory before it was journaled. only does anything the first
+        time it is called for a directory.
+
+        :param source_dir: upload directory
+        :param paths: files in the directory.
+        """
+        source_dir = self._dir(source_dir)
+        now = time.time()
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM seeded WHERE source_dir=?", (source_dir,)).fetchone():
+                return
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR IGNORE INTO uploads (path, source_dir, state, retries, added, updated) "
+                                 "VALUES (?, ?, ?, 0, ?, ?)",
+                                 ((os.path.abspath(p), source_dir, PENDING, now, now) for p in paths))
+            self._db.execute("INSERT INTO seeded (source_dir, at) VALUES (?, ?)", (source_dir, now))
+            self._db.execute("COMMIT")
+        self.logger.info("Seeded upload journal for {} with {} files".format(source_dir, len(paths)))
+
+    def is_seeded(self, source_dir: str) -> bool:
+        """
+        whether :func:`seed` has been called for a directory.
+        """
+        with self._lock:
+            return bool(self._db.execute("SELECT 1 FROM seeded WHERE source_dir=?",
+                                         (self._dir(source_dir),)).fetchone())
+
+    def claim(self, source_dir: str, limit: int = 500, deferred: bool = False) -> list:
+        """
+        claims a batch of pending (or failed, with retries left) files for upload, oldest first, marking them
+        in-flight. files that ran out of retries are claimed again once they havent been tried for
+        `retry_given_up_s`, so a file that failed through a long outage isnt stuck forever.
+
+        :param source_dir: upload directory to claim files from
+        :param limit: maximum number of files to claim
+        :param deferred: claim deferred files instead, to backfill them.
+        :return: list of file paths
+        :rtype: list(str)
+        """
+        source_dir = self._dir(source_dir)
+        now = time.time()
+        if deferred:
+            query = "SELECT path FROM uploads WHERE source_dir=? AND state=? ORDER BY added LIMIT ?"
+            params = (source_dir, DEFERRED, limit)
+        else:
+            query = ("SELECT path FROM uploads WHERE source_dir=? AND "
+                     "(state=? OR (state=? AND (retries<? OR updated<?))) ORDER BY added LIMIT ?")
+            params = (source_dir, PENDING, FAILED, self.max_retries, now - self.retry_given_up_s, limit)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            rows = self._db.execute(query, params).fetchall()
+            paths = [r[0] for r in rows]
+            self._db.executemany("UPDATE uploads SET state=?, updated=? WHERE path=?",
+                                 ((IN_FLIGHT, now, p) for p in paths))
+            self._db.execute("COMMIT")
+        return paths
+
+    def mark_done(self, path: str):
+        """
+        marks a file as uploaded.
+        does nothing if the file was added again while it was in-flight, so the new version still gets uploaded.
+        """
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state=?, updated=?, error=NULL WHERE path=? AND state=?",
+                             (DONE, time.time(), os.path.abspath(path), IN_FLIGHT))
+
+    def mark_failed(self, path: str, error: str = None):
+        """
+        marks a file as failed, incrementing its retry count.
+        """
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state=?, retries=retries+1, updated=?, error=? "
+                             "WHERE path=? AND state=?",
+                             (FAILED, time.time(), error, os.path.abspath(path), IN_FLIGHT))
+
+    def defer(self, path: str):
+        """
+        marks a file as deferred, its reduced copy was uploaded and the original should be backfilled later.
+        """
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state=?, updated=?, error=NULL WHERE path=? AND state=?",
+                             (DEFERRED, time.time(), os.path.abspath(path), IN_FLIGHT))
+
+    def deferred(self, source_dir: str) -> list:
+        """
+        lists the deferred files in an upload directory, oldest first.
+
+        :param source_dir: upload directory
+        :return: list of file paths
+        :rtype: list(str)
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT path FROM uploads WHERE source_dir=? AND state=? ORDER BY added",
+                                    (self._dir(source_dir), DEFERRED)).fetchall()
+        return [r[0] for r in rows]
+
+    def release(self, paths: list):
+        """
+        puts claimed files that are still in-flight back to pending, without counting a retry.
+        used when a whole upload cycle fails, like when the connection cant be made.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany("UPDATE uploads SET state=?, updated=? WHERE path=? AND state=?",
+                                 ((PENDING, now, os.path.abspath(p), IN_FLIGHT) for p in paths))
+
+    def remove(self, path: str):
+        """
+        removes a file from the journal.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM uploads WHERE path=?", (os.path.abspath(path),))
+
+    def recover(self, source_dir: str):
+        """
+        puts files that were in-flight when the process stopped back to pending.
+
+        :param source_dir: upload directory to recover
+        """
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state=? WHERE source_dir=? AND state=?",
+                             (PENDING, self._dir(source_dir), IN_FLIGHT))
+
+    def remote_digest(self, remote_path: str) -> str:
+        """
+        gets the digest of the content last uploaded to a remote path.
+
+        :param remote_path: absolute remote path
+        :return: hex digest, or None if nothing is known to have been uploaded there.
+        :rtype: str
+        """
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM remote WHERE remote_path=?", (remote_path,)).fetchone()
+        return row[0] if row else None
+
+    def find_digest(self, digest: str) -> str:
+        """
+        finds a remote path that already has some content.
+        a hit counts as seeing that remote path, so :func:`prune` keeps digests that are still being referenced.
+
+        :param digest: hex digest of the content
+        :return: remote path, or None if the content hasnt been uploaded.
+        :rtype: str
+        """
+        with self._lock:
+            row = self._db.execute("SELECT remote_path FROM remote WHERE digest=? ORDER BY seen DESC LIMIT 1",
+                                   (digest,)).fetchone()
+            if row:
+                self._db.execute("UPDATE remote SET seen=? WHERE remote_path=?", (time.time(), row[0]))
+        return row[0] if row else None
+
+    def record_digest(self, remote_path: str, digest: str, size: int):
+        """
+        records the content uploaded to a remote path.
+
+        :param remote_path: absolute remote path
+        :param digest: hex digest of the content
+        :param size: size of the content in bytes
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO remote (remote_path, digest, size, seen) VALUES (?, ?, ?, ?)",
+                             (remote_path, digest, size, time.time()))
+
+    def prune(self):
+        """
+        removes old done entries and least recently seen digests so the journal doesnt grow forever.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM uploads WHERE state=? AND updated<?",
+                             (DONE, time.time() - self.keep_done_s))
+            self._db.execute("DELETE FROM remote WHERE remote_path IN "
+                             "(SELECT remote_path FROM remote ORDER BY seen DESC LIMIT -1 OFFSET ?)",
+                             (self.max_digests,))
+
+    def stats(self, source_dir: str) -> dict:
+        """
+        counts the files in each state for an upload directory.
+
+        :param source_dir: upload directory
+        :return: dict of state: count
+        :rtype: dict
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT state, COUNT(*) FROM uploads WHERE source_dir=? GROUP BY state",
+                                    (self._dir(source_dir),)).fetchall()
+        return dict(rows)
+
+    def given_up(self, source_dir: str) -> int:
+        """
+        counts the files in an upload directory that have run out of retries.
+
+        :param source_dir: upload directory
+        :return: number of files
+        :rtype: int
+        """
+        with self._lock:
+            row = self._db.execute("SELECT COUNT(*) FROM uploads WHERE source_dir=? AND state=? AND retries>=?",
+                                   (self._dir(source_dir), FAILED, self.max_retries)).fetchone()
+        return row[0]
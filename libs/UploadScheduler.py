@@ -0,0 +1,203 @@
+import heapq
+import itertools
+import logging.config
+import os
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+try:
+    logging.config.fileConfig("logging.ini")
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+except:
+    pass
+
+# lanes, lower goes first.
+HIGH = 0
+BULK = 1
+
+# files that should go ahead of bulk timelapse images.
+high_priority_names = ("last_image.jpg",)
+high_priority_exts = (".csv", ".tsv", ".json")
+
+
+def lane_for(file_path: str) -> int:
+    """
+    picks the upload lane for a file.
+    last_image.jpg and sensor data go in the high priority lane, everything else is bulk.
+
+    :param file_path: path of the file to upload
+    :return: lane, either HIGH or BULK
+    :rtype: int
+    """
+    name = os.path.basename(file_path)
+    if name in high_priority_names or os.path.splitext(name)[-1].lower() in high_priority_exts:
+        return HIGH
+    return BULK
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter, shared by every transfer on the device.
+    """
+
+    def __init__(self, rate: float = 0, burst: float = None):
+        """
+        :param rate: bytes per second, 0 to disable.
+        :param burst: maximum number of bytes that can go out at once, defaults to one seconds worth.
+        """
+        self._lock = Lock()
+        self.rate = 0
+        self.burst = 0
+        self._tokens = 0
+        self._last = time.time()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: float, burst: float = None):
+        """
+        changes the rate limit.
+
+        :param rate: bytes per second, 0 to disable.
+        :param burst: maximum number of bytes that can go out at once, defaults to one seconds worth.
+        """
+        with self._lock:
+            self.rate = float(rate or 0)
+            self.burst = float(burst or self.rate)
+            self._tokens = min(self._tokens, self.burst)
+
+    def consume(self, n: int):
+        """
+        takes n bytes worth of tokens, sleeping until they are available.
+
+        :param n: number of bytes
+        """
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            deficit = -self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+
+class UploadScheduler(object):
+    """
+    Device wide upload scheduler that owns the uplink.
+
+    Every :class:`libs.Uploader.Uploader` on the device asks the scheduler for a transfer slot before sending a
+    file. There are a fixed number of slots for the whole device, handed out:
+
+        - high priority lane first (last_image.jpg and sensor data), then the bulk lane.
+        - within a lane, by start-time fair queueing, so each uploader gets a share of the link proportional to its
+          weight no matter how big its backlog is.
+
+    All transfers also share a :class:`TokenBucket` bandwidth cap, so that ssh and mqtt stay responsive.
+
+    Use :func:`UploadScheduler.get_scheduler` to get the shared instance.
+    """
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def get_scheduler(cls) -> 'UploadScheduler':
+        """
+        gets the process wide upload scheduler.
+
+        :return: the scheduler
+        :rtype: UploadScheduler
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, slots: int = 2, bandwidth_kbps: float = 0):
+        """
+        :param slots: number of concurrent transfers for the whole device
+        :param bandwidth_kbps: bandwidth cap in kilobytes/s, 0 for no cap.
+        """
+        self.logger = logging.getLogger("UploadScheduler")
+        self.slots = max(int(slots), 1)
+        self.bucket = TokenBucket(float(bandwidth_kbps) * 1024)
+        self._condition = Condition()
+        self._waiting = []
+        self._counter = itertools.count()
+        self._active = 0
+        self._virtual_time = 0.0
+        self._finish_tags = dict()
+
+    def configure(self, slots: int = None, bandwidth_kbps: float = None, **kwargs):
+        """
+        reconfigures the scheduler, from the "upload_scheduler" section of the global config.
+
+        :param slots: number of concurrent transfers for the whole device
+        :param bandwidth_kbps: bandwidth cap in kilobytes/s, 0 for no cap.
+        """
+        with self._condition:
+            if slots is not None:
+                self.slots = max(int(slots), 1)
+            self._condition.notify_all()
+        if bandwidth_kbps is not None:
+            self.bucket.set_rate(float(bandwidth_kbps) * 1024)
+        self.logger.info("Upload slots: {}, bandwidth cap: {}KB/s".format(self.slots, self.bucket.rate / 1024))
+
+    def acquire(self, uploader_id: str, size: int, lane: int = BULK, weight: float = 1.0):
+        """
+        blocks until a transfer slot is available for this uploader.
+
+        :param uploader_id: identifier of the uploader, each one gets its own fair share.
+        :param size: size of the file in bytes
+        :param lane: HIGH or BULK
+        :param weight: relative share of the link for this uploader
+        """
+        with self._condition:
+            start = max(self._virtual_time, self._finish_tags.get(uploader_id, 0.0))
+            self._finish_tags[uploader_id] = start + max(size, 1) / max(float(weight), 1e-3)
+            entry = (lane, start, next(self._counter))
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] is not entry or self._active >= self.slots:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._active += 1
+            self._virtual_time = max(self._virtual_time, start)
+            # the next waiter may be able to go too.
+            self._condition.notify_all()
+
+    def release(self):
+        """
+        gives back a transfer slot.
+        """
+        with self._condition:
+            self._active -= 1
+            if not self._active and not self._waiting:
+                # idle, uploaders that were away shouldnt get credit for it.
+                self._finish_tags.clear()
+            self._condition.notify_all()
+
+    @contextmanager
+    def transfer(self, uploader_id: str, size: int, lane: int = BULK, weight: float = 1.0):
+        """
+        context manager holding a transfer slot, see :func:`acquire`.
+        """
+        self.acquire(uploader_id, size, lane=lane, weight=weight)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def throttle_callback(self):
+        """
+        makes a progress callback for :func:`pysftp.Connection.put` that applies the bandwidth cap.
+
+        :return: callback taking (bytes transferred so far, total bytes)
+        """
+        sent = [0]
+
+        def callback(transferred, total):
+            self.bucket.consume(transferred - sent[0])
+            sent[0] = transferred
+
+        return callback
@@ -2,15 +2,24 @@ import datetime
 import ftplib
 import logging
 import os
+import posixpath
+from io import BytesIO
 import time
 from glob import glob
 from collections import deque
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Thread, Event, Lock, Condition
 import pysftp
 from dateutil import zoneinfo
 from .CryptUtil import SSHManager
 from .SysUtil import SysUtil
-import paho.mqtt.client as client
+from .UploadJournal import UploadJournal
+from .UploadScheduler import UploadScheduler, lane_for, BULK
+from .Encoder import ImageEncoder
+from .MQTTSession import MQTTSession
+from .Telemetry import Telemetry
+from .Tracing import Tracer
 import json
 from zlib import crc32
 try:
@@ -21,6 +30,184 @@ except:
 
 timezone = zoneinfo.get_zonefile_instance().get("Australia/Canberra")
 
+
+class SFTPConnectionPool(object):
+    """
+    Pool of long lived sftp connections to one host.
+
+    Connections are health checked when they are taken from the pool and replaced if they have gone stale.
+    The pool also caches which remote directories are known to exist, so that they dont need to be checked for
+    every file.
+
+    Use :func:`SFTPConnectionPool.get_pool` to get the shared pool for a set of connection parameters.
+    """
+    _pools = dict()
+    _pools_lock = Lock()
+
+    @classmethod
+    def get_pool(cls, params: dict, size: int = 2) -> 'SFTPConnectionPool':
+        """
+        gets the shared pool for a host and set of credentials, creating it if it doesnt exist.
+
+        :param params: keyword arguments for :class:`pysftp.Connection`
+        :param size: maximum number of connections in the pool
+        :return: connection pool
+        :rtype: SFTPConnectionPool
+        """
+        key = tuple(params.get(k) for k in ("host", "port", "username", "password", "private_key"))
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                pool = cls._pools[key] = cls(params, size=size)
+            pool.size = max(int(size), 1)
+            return pool
+
+    def __init__(self, params: dict, size: int = 2):
+        """
+        :param params: keyword arguments for :class:`pysftp.Connection`
+        :param size: maximum number of connections in the pool
+        """
+        self.params = params
+        self.size = max(int(size), 1)
+        self.logger = logging.getLogger("SFTPPool|{}".format(params.get("host")))
+        self.known_dirs = set()
+        self._idle = deque()
+        self._open = 0
+        self._condition = Condition()
+
+    @staticmethod
+    def _healthy(link: pysftp.Connection) -> bool:
+        """
+        checks that a connection is still usable with a single round trip.
+        """
+        try:
+            link.pwd
+            return True
+        except Exception:
+            return False
+
+    def acquire(self) -> pysftp.Connection:
+        """
+        Takes a connection from the pool, opening a new one if there are no idle connections and the pool isnt
+        full. Blocks until a connection is available.
+
+        :return: sftp connection
+        :rtype: pysftp.Connection
+        """
+        while True:
+            with self._condition:
+                while not self._idle and self._open >= self.size:
+                    self._condition.wait()
+                link = self._idle.pop() if self._idle else None
+                if link is None:
+                    self._open += 1
+            if link is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+            if self._healthy(link):
+                return link
+            self.logger.info("Dropping stale sftp connection")
+            self.discard(link)
+            with self._condition:
+                self._open += 1
+            try:
+                return self._connect()
+            except Exception:
+                self._forget()
+                raise
+
+    def _connect(self) -> pysftp.Connection:
+        """
+        opens a new connection with the pools parameters.
+
+        :return: sftp connection
+        :rtype: pysftp.Connection
+        """
+        return pysftp.Connection(**self.params)
+
+    def _forget(self):
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def release(self, link: pysftp.Connection):
+        """
+        returns a connection to the pool.
+
+        :param link: connection taken with :func:`acquire`
+        """
+        with self._condition:
+            self._idle.append(link)
+            self._condition.notify()
+
+    def discard(self, link: pysftp.Connection):
+        """
+        closes a connection taken with :func:`acquire` instead of returning it to the pool.
+
+        :param link: connection to close
+        """
+        try:
+            link.close()
+        except Exception:
+            pass
+        self._forget()
+
+    @contextmanager
+    def connection(self):
+        """
+        context manager for a pooled connection.
+        connections are discarded rather than returned to the pool if an exception is raised.
+        """
+        link = self.acquire()
+        try:
+            yield link
+        except Exception:
+            self.discard(link)
+            raise
+        else:
+            self.release(link)
+
+    def ensure_dir(self, link: pysftp.Connection, remote_directory: str):
+        """
+        makes sure a remote directory exists, using the cache of known directories to avoid round trips.
+
+        :param link: connection from this pool
+        :param remote_directory: remote path of the directory
+        """
+        if remote_directory in ('', '/') or remote_directory in self.known_dirs:
+            return
+        if not link.isdir(remote_directory):
+            self.logger.info("Sorry, just have to make some new directories, eh. ")
+            link.makedirs(remote_directory)
+        # parents must exist too.
+        while remote_directory not in ('', '/'):
+            self.known_dirs.add(remote_directory)
+            remote_directory = posixpath.dirname(remote_directory)
+
+    def forget_dir(self, remote_directory: str):
+        """
+        removes a directory from the cache, for when it might have been removed on the server.
+        """
+        self.known_dirs.discard(remote_directory)
+
+    def close_all(self):
+        """
+        closes all the idle connections.
+        """
+        with self._condition:
+            while self._idle:
+                link = self._idle.pop()
+                try:
+                    link.close()
+                except Exception:
+                    pass
+                self._open -= 1
+            self._condition.notify_all()
+
+
 class Uploader(Thread):
     """ Uploader class,
         used to upload,
@@ -28,6 +215,33 @@ class Uploader(Thread):
     # upload interval
     upload_interval = 120
     remove_source_files = True
+    # number of concurrent sftp connections used for transfers
+    upload_channels = 2
+    # maximum number of files claimed from the upload journal at once
+    batch_size = 500
+    # share of the device uplink relative to other uploaders, see UploadScheduler
+    upload_weight = 1.0
+    # partial uploads of files at least this big are resumed rather than restarted
+    resume_min_bytes = 1024 * 1024
+    # bytes before the resume offset compared with the local file before resuming
+    resume_check_bytes = 64 * 1024
+    # chunk size for resumed writes
+    resume_chunk_bytes = 32 * 1024
+    # upload reduced jpegs first and backfill originals later when the link cant keep up
+    adaptive = False
+    reduced_max_px = 1024
+    reduced_quality = 70
+    # remote directory, under the uploaders directory, that reduced copies go in
+    reduced_dir = "reduced"
+    # oldest deferred originals are deleted when they take up more than this
+    max_backlog_bytes = 2 * 1024 * 1024 * 1024
+    # skip files whose remote path already has the same content (like an unchanged last_image.jpg)
+    dedup = True
+    # send .ref records instead of duplicates at least dedup_min_bytes big, off by default, see _put_ref
+    dedup_refs = False
+    dedup_min_bytes = 16 * 1024
+    # formats derived from lossless masters before they are uploaded, for cameras that only write masters
+    derive_types = ()
 
     def __init__(self, identifier: str, config: dict = None, queue: deque = None):
         """
@@ -78,10 +292,28 @@ class Uploader(Thread):
             self.name = self.config.get("name", self.identifier)
             self.source_dir = self.config.get("output_dir", "/home/images/{}".format(str(identifier)))
             self.upload_enabled = bool(len(upload_conf))
+            self.upload_channels = int(upload_conf.get("channels", Uploader.upload_channels))
+            self.upload_weight = float(upload_conf.get("weight", Uploader.upload_weight))
+            self.adaptive = bool(upload_conf.get("adaptive", Uploader.adaptive))
+            self.reduced_max_px = int(upload_conf.get("reduced_max_px", Uploader.reduced_max_px))
+            self.reduced_quality = int(upload_conf.get("reduced_quality", Uploader.reduced_quality))
+            self.dedup = bool(upload_conf.get("dedup", Uploader.dedup))
+            self.dedup_refs = bool(upload_conf.get("dedup_refs", Uploader.dedup_refs))
+            if "max_backlog_mb" in upload_conf:
+                self.max_backlog_bytes = int(float(upload_conf["max_backlog_mb"]) * 1024 * 1024)
+            if self.config.get("master_only", False):
+                self.derive_types = tuple(upload_conf.get("derive", ("jpg",)))
 
         self.machine_id = SysUtil.get_machineid()
 
         self.last_upload_list = []
+        self._executor = None
+        self.encoder = ImageEncoder(self.derive_types, logger=self.logger, trace_key=self.identifier)
+        self.journal = UploadJournal.get_journal()
+        self.scheduler = UploadScheduler.get_scheduler()
+        # achieved throughput in bytes/s, averaged over upload cycles.
+        self.throughput_bps = None
+        self.degraded = False
         self.setupmqtt()
 
     def mqtt_on_message(self, client, userdata, msg):
@@ -107,122 +339,428 @@ class Uploader(Thread):
                 if hasattr(self, k) and not callable(getattr(self, k)):
                     setattr(self, k, v)
 
-    def mqtt_on_connect(self, client, *args):
-        self.mqtt.subscribe("camera/{}/config".format(self.identifier), qos=1)
-
     def setupmqtt(self):
-        client_id = str(crc32(bytes(self.identifier+"-Uploader", 'utf8')))
-        self.mqtt = client.Client(client_id=client_id,
-                                  clean_session=True,
-                                  protocol=client.MQTTv311,
-                                  transport="tcp")
-
-        self.mqtt.on_message = self.mqtt_on_message
-        self.mqtt.on_connect = self.mqtt_on_connect
-        try:
-            with open("mqttpassword") as f:
-                self.mqtt.username_pw_set(username=self.getName(),
-                                          password=f.read().strip())
-        except FileNotFoundError:
-            auth = self.ssh_manager.sign_message_PSS(datetime.datetime.now().replace(tzinfo=timezone).isoformat())
-            if not auth:
-                raise ValueError
-            self.mqtt.username_pw_set(username=SysUtil.get_machineid(),
-                                      password=auth)
-        except:
-            self.mqtt.username_pw_set(username=self.getName(),
-                                      password="INVALIDPASSWORD")
-
-        self.mqtt.connect_async("10.9.0.1", port=1883)
-        self.mqtt.loop_start()
+        """
+        subscribes to the camera config topic on the process wide :class:`libs.MQTTSession.MQTTSession`.
+        """
+        self.mqtt = MQTTSession.get_session()
+        self.mqtt.subscribe("camera/{}/config".format(self.identifier), self.mqtt_on_message)
 
     def updatemqtt(self, msg: bytes):
         self.logger.debug("Updating mqtt")
-        # update mqtt
-        msg = self.mqtt.publish(payload=msg,
-                                topic="camera/{}/upload".format(self.identifier),
-                                qos=1)
-        time.sleep(0.5)
-        if not msg.is_published():
-            self.mqtt.loop_stop()
-            self.mqtt.loop_start()
+        # update mqtt, paho sends it from its own thread so dont wait for it.
+        self.mqtt.publish("camera/{}/upload".format(self.identifier), msg)
+
+    def connection_params(self) -> dict:
+        """
+        builds the keyword arguments for :class:`pysftp.Connection` from the current config.
+
+        :return: connection parameters
+        :rtype: dict
+        """
+        params = dict(host=self.host, username=self.username)
+        params['cnopts'] = pysftp.CnOpts(knownhosts=self.ssh_manager.known_hosts_path)
+        params['cnopts'].hostkeys = None
+
+        if os.path.exists(self.ssh_manager.priv_path) and os.path.exists(self.ssh_manager.known_hosts_path):
+            params['private_key'] = self.ssh_manager.priv_path
+            params['cnopts'] = pysftp.CnOpts(knownhosts=self.ssh_manager.known_hosts_path)
+        elif self.password is not None:
+            params['password'] = self.password
+        return params
+
+    def connection_pool(self) -> SFTPConnectionPool:
+        """
+        gets the shared connection pool for the current config.
+
+        :return: connection pool
+        :rtype: SFTPConnectionPool
+        """
+        return SFTPConnectionPool.get_pool(self.connection_params(), size=self.upload_channels)
+
+    def _resume_offset(self, link: pysftp.Connection, f: str, remote_tmp: str, size: int) -> int:
+        """
+        works out where a previous, broken upload of a file got to.
+
+        The remote .tmp is only trusted if it is shorter than the local file and the chunk just before its end
+        matches the local file at the same offset, otherwise the upload starts from the beginning.
+
+        :param link: sftp connection
+        :param f: local file path
+        :param remote_tmp: remote path of the partial file
+        :param size: size of the local file
+        :return: offset to resume from, 0 to start again.
+        :rtype: int
+        """
+        if size < self.resume_min_bytes:
+            return 0
+        try:
+            offset = link.stat(remote_tmp).st_size or 0
+        except IOError:
+            return 0
+        if not 0 < offset < size:
+            return 0
+        check_start = max(offset - self.resume_check_bytes, 0)
+        try:
+            with open(f, 'rb') as local_file:
+                local_file.seek(check_start)
+                local_chunk = local_file.read(offset - check_start)
+            with link.sftp_client.open(remote_tmp, 'rb') as remote_file:
+                remote_file.seek(check_start)
+                remote_chunk = remote_file.read(offset - check_start)
+        except IOError as e:
+            self.logger.debug("Couldnt check partial upload {}: {}".format(remote_tmp, str(e)))
+            return 0
+        if crc32(local_chunk) != crc32(remote_chunk):
+            self.logger.debug("Partial upload {} doesnt match the local file, restarting".format(remote_tmp))
+            return 0
+        return offset
+
+    def _resume_put(self, link: pysftp.Connection, f: str, remote_tmp: str, offset: int, callback=None):
+        """
+        appends the rest of a local file to a partial remote file, from offset.
+
+        :param link: sftp connection
+        :param f: local file path
+        :param remote_tmp: remote path of the partial file
+        :param offset: offset to continue from
+        :param callback: progress callback, called with (bytes transferred, total bytes to transfer)
+        """
+        total = os.path.getsize(f) - offset
+        transferred = 0
+        with open(f, 'rb') as local_file, link.sftp_client.open(remote_tmp, 'r+b') as remote_file:
+            remote_file.set_pipelined(True)
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            while True:
+                chunk = local_file.read(self.resume_chunk_bytes)
+                if not chunk:
+                    break
+                remote_file.write(chunk)
+                transferred += len(chunk)
+                if callback is not None:
+                    callback(transferred, total)
+        # truncate anything left past the end, in case the remote file was longer than this one.
+        link.sftp_client.truncate(remote_tmp, offset + transferred)
+
+    def _put_file(self, pool: SFTPConnectionPool, root: str, f: str) -> tuple:
+        """
+        uploads a single file on a pooled connection.
+        The file is uploaded as .tmp, and renamed over the target so that partial files are never visible.
+        If a previous upload of the file broke partway through, it is resumed from where it stopped.
+
+        Duplicates are found by the sha1 of the whole file, metadata included. Every image the cameras write
+        carries its capture time in its exif data, so separate captures never match even if their pixels do, and
+        in practice only files uploaded again unchanged (like last_image.jpg) are skipped.
+
+        :param pool: connection pool to take a connection from
+        :param root: absolute remote directory to upload into
+        :param f: local file path
+        :return: bytes sent and time taken in seconds
+        :rtype: tuple(int, float)
+        """
+        remote_path = posixpath.join(root, self._relative_path(f))
+        with pool.connection() as link:
+            if os.path.isdir(f):
+                pool.ensure_dir(link, remote_path.rstrip("/"))
+                return 0, 0.0
+            remote_dir = posixpath.dirname(remote_path)
+            pool.ensure_dir(link, remote_dir)
+            size = os.path.getsize(f)
+            digest = None
+            if self.dedup:
+                digest = SysUtil.get_file_digest(f)
+                if self.journal.remote_digest(remote_path) == digest:
+                    self.logger.debug("{} is unchanged on the server, skipping".format(f))
+                    return 0, 0.0
+                original = None
+                if self.dedup_refs and size >= self.dedup_min_bytes:
+                    original = self.journal.find_digest(digest)
+                if original is not None:
+                    return self._put_ref(link, f, remote_path, original, digest, size)
+            offset = self._resume_offset(link, f, remote_path + ".tmp", size)
+            # wait for a slot on the device uplink, high priority files jump the bulk timelapse backlog.
+            with self.scheduler.transfer(self.identifier, size - offset, lane=lane_for(f), weight=self.upload_weight):
+                onefile_time = time.time()
+                try:
+                    if offset:
+                        self.logger.info("Resuming upload of {} from {} of {} bytes".format(f, offset, size))
+                        self._resume_put(link, f, remote_path + ".tmp", offset,
+                                         callback=self.scheduler.throttle_callback())
+                    else:
+                        link.put(f, remote_path + ".tmp", callback=self.scheduler.throttle_callback())
+                except IOError:
+                    # directory may have been removed from under us.
+                    pool.forget_dir(remote_dir)
+                    raise
+            self._commit_tmp(link, remote_path)
+            if digest is not None:
+                self.journal.record_digest(remote_path, digest, size)
+            return size - offset, time.time() - onefile_time
+
+    def _put_ref(self, link: pysftp.Connection, f: str, remote_path: str, original: str, digest: str,
+                 size: int) -> tuple:
+        """
+        uploads a small json reference record, remote_path + ".ref", instead of a file whose content is already
+        on the server at `original`.
+
+        `original` is where the content was uploaded to, the journal doesnt know if ingestion on the server has
+        moved it since, in which case the reference is left dangling. so references are only sent when
+        :attr:`dedup_refs` is set, for servers that leave uploads where they are.
+
+        :param link: sftp connection
+        :param f: local file path
+        :param remote_path: absolute remote path the file would have been uploaded to
+        :param original: absolute remote path of the identical file already on the server
+        :param digest: hex sha1 digest of the content
+        :param size: size of the file in bytes
+        :return: bytes sent and time taken in seconds
+        :rtype: tuple(int, float)
+        """
+        ref = bytes(json.dumps(dict(ref=original, sha1=digest, size=size)), 'utf-8')
+        onefile_time = time.time()
+        link.sftp_client.putfo(BytesIO(ref), remote_path + ".ref.tmp", file_size=len(ref))
+        self._commit_tmp(link, remote_path + ".ref")
+        self.logger.debug("{} is a duplicate of {}, sent a reference".format(f, original))
+        return len(ref), time.time() - onefile_time
+
+    def _put_reduced(self, pool: SFTPConnectionPool, root: str, f: str) -> tuple:
+        """
+        uploads a reduced jpeg of an image into :attr:`reduced_dir`, instead of the original.
+        Files that cant be reduced (like camera raw files) arent uploaded at all, their originals are just deferred.
+
+        :param pool: connection pool to take a connection from
+        :param root: absolute remote directory to upload into
+        :param f: local file path
+        :return: bytes sent and time taken in seconds
+        :rtype: tuple(int, float)
+        """
+        data = ImageEncoder.reduce(f, max_px=self.reduced_max_px, quality=self.reduced_quality)
+        if data is None:
+            return 0, 0.0
+        remote_path = posixpath.join(root, self.reduced_dir, os.path.splitext(self._relative_path(f))[0] + ".jpg")
+        with pool.connection() as link:
+            remote_dir = posixpath.dirname(remote_path)
+            pool.ensure_dir(link, remote_dir)
+            with self.scheduler.transfer(self.identifier, len(data), lane=BULK, weight=self.upload_weight):
+                onefile_time = time.time()
+                try:
+                    link.sftp_client.putfo(BytesIO(data), remote_path + ".tmp", file_size=len(data),
+                                           callback=self.scheduler.throttle_callback())
+                except IOError:
+                    pool.forget_dir(remote_dir)
+                    raise
+            self._commit_tmp(link, remote_path)
+            return len(data), time.time() - onefile_time
+
+    def _relative_path(self, f: str) -> str:
+        """
+        path of a local file relative to the upload directory, which is where it goes on the server.
+        """
+        target_file = f.replace(self.source_dir, "")
+        return target_file[1:] if target_file.startswith("/") else target_file
+
+    @staticmethod
+    def _commit_tmp(link: pysftp.Connection, remote_path: str):
+        """
+        moves a finished .tmp upload over its target.
+        """
+        link.chmod(remote_path + ".tmp", mode=755)
+        try:
+            # overwrites in one round trip, instead of exists, remove, rename.
+            link.sftp_client.posix_rename(remote_path + ".tmp", remote_path)
+        except IOError:
+            if link.exists(remote_path):
+                link.remove(remote_path)
+            link.rename(remote_path + ".tmp", remote_path)
+
+    def _update_degraded(self, file_names: list):
+        """
+        decides whether the link is keeping up, from how long the files waiting would take at the measured
+        throughput. Goes into degraded mode when they would take longer than the upload interval, and back out
+        when they would take less than half of it.
+
+        :param file_names: files about to be uploaded
+        """
+        if not self.adaptive or not self.throughput_bps:
+            return
+        backlog = sum(os.path.getsize(f) for f in file_names if os.path.isfile(f) and lane_for(f) == BULK)
+        backlog_s = backlog / self.throughput_bps
+        if not self.degraded and backlog_s > self.upload_interval:
+            self.degraded = True
+            self.logger.warning("Link cant keep up ({0:.0f}s backlog at {1:.2f}Mb/s), uploading reduced images".format(
+                backlog_s, self.throughput_bps / 1024 / 1024))
+        elif self.degraded and backlog_s < self.upload_interval / 2:
+            self.degraded = False
+            self.logger.info("Link recovered, backfilling original images")
+
+    def _claim_backfill(self, file_names: list) -> list:
+        """
+        claims deferred originals to backfill, no more than the link can send in an upload interval at the measured
+        throughput alongside the files already claimed. a link that has only just recovered isnt tied up for hours,
+        and the backfill cant push the cycle past what :func:`_update_degraded` allows. until the link has been
+        measured, one original is backfilled at a time.
+
+        :param file_names: files already claimed for this cycle
+        :return: deferred originals to upload
+        :rtype: list(str)
+        """
+        budget = (self.throughput_bps or 0) * self.upload_interval
+        budget -= sum(os.path.getsize(f) for f in file_names if os.path.isfile(f) and lane_for(f) == BULK)
+        if self.throughput_bps and budget <= 0:
+            return []
+        backfill = []
+        size = 0
+        for f in self.journal.claim(self.source_dir, limit=self.batch_size - len(file_names), deferred=True):
+            if not os.path.isfile(f):
+                self.journal.remove(f)
+                continue
+            f_size = os.path.getsize(f)
+            if (backfill or self.throughput_bps) and size + f_size > budget:
+                # back to deferred for a later cycle.
+                self.journal.defer(f)
+                continue
+            backfill.append(f)
+            size += f_size
+        return backfill
+
+    def _derive(self, file_names: list) -> list:
+        """
+        derives :attr:`derive_types` from the lossless masters about to be uploaded in full, with
+        :func:`libs.Encoder.ImageEncoder.derive`, and adds them to the upload journal. cameras with `master_only`
+        set only write masters to keep capture fast, so the other formats are made here instead.
+
+        :param file_names: files about to be uploaded
+        :return: derived files
+        :rtype: list(str)
+        """
+        derived = []
+        if not self.derive_types or self.degraded:
+            # degraded uploads send reduced copies, derived formats are made once the master is backfilled.
+            return derived
+        for f in file_names:
+            if os.path.splitext(f)[-1][1:] != ImageEncoder.master_type or not os.path.isfile(f):
+                continue
+            for d in self.encoder.derive(f):
+                self.journal.add(d, self.source_dir)
+                derived.append(d)
+        return derived
+
+    def _trim_backlog(self):
+        """
+        deletes the oldest deferred originals while they take up more than :attr:`max_backlog_bytes`, so that the
+        backlog on a poorly connected site cant grow without bound. their reduced copies have already been uploaded.
+        """
+        deferred = [f for f in self.journal.deferred(self.source_dir) if os.path.isfile(f)]
+        sizes = [os.path.getsize(f) for f in deferred]
+        total = sum(sizes)
+        for f, size in zip(deferred, sizes):
+            if total <= self.max_backlog_bytes:
+                break
+            self.logger.warning("Upload backlog over {}MB, dropping original {}".format(
+                self.max_backlog_bytes // 1024 // 1024, f))
+            try:
+                os.remove(f)
+            except OSError as e:
+                self.logger.error("Couldnt remove {}: {}".format(f, str(e)))
+                continue
+            self.journal.remove(f)
+            total -= size
+
+    def send_metrics(self, measurement: str, fields: dict, **tags):
+        """
+        sends upload metrics to telegraf.
+
+        :param measurement: measurement name
+        :param fields: dict of field values
+        :param tags: extra tags
+        """
+        Telemetry.get_telemetry().metric(measurement, fields, tags=dict(uploader_name=self.name, **tags))
 
     def upload(self, file_names):
         """
         uploads files via sftp.
         deletes the files as they are uploaded, creates new directories if needed.
 
+        Connections come from a :class:`SFTPConnectionPool` that is kept open between cycles, and files are
+        uploaded concurrently over `upload_channels` connections.
+
+        Each file is marked done or failed in the upload journal as it finishes.
+        In degraded mode, bulk images are uploaded as reduced jpegs and their originals are deferred.
+
         :param file_names: filenames to upload
+        :return: files that failed to upload
+        :rtype: list(str)
         """
+        failed = []
         try:
-            # open link and create directory if for some reason it doesnt exist
-            params = dict(host=self.host, username=self.username)
-            params['cnopts'] = pysftp.CnOpts(knownhosts=self.ssh_manager.known_hosts_path)
-            params['cnopts'].hostkeys = None
-
-
-            if os.path.exists(self.ssh_manager.priv_path) and os.path.exists(self.ssh_manager.known_hosts_path):
-                params['private_key'] = self.ssh_manager.priv_path
-                params['cnopts'] = pysftp.CnOpts(knownhosts=self.ssh_manager.known_hosts_path)
-            elif self.password is not None:
-                params['password'] = self.password
-
-            with pysftp.Connection(**params) as link:
-                root = os.path.join(link.getcwd() or "", self.server_dir, self.name)
+            pool = self.connection_pool()
+            with pool.connection() as link:
+                root = os.path.join(self.server_dir, self.name)
                 root = root[1:] if root.startswith("/") else root
                 # make the root dir in case it doesnt exist.
-                if not link.isdir(root):
-                    self.logger.debug("Making root directory")
-                    self.mkdir_recursive(link, root)
-                link.chdir(root)
-                root = os.path.join(link.getcwd())
-                # dump ze files.
-                total_time = time.time()
-                total_size = 0
-                failed = []
-                for idx, f in enumerate(file_names):
-                    try:
-                        onefile_time = time.time()
-                        target_file = f.replace(self.source_dir, "")
-                        target_file = target_file[1:] if target_file.startswith("/") else target_file
-                        dirname = os.path.dirname(target_file)
-                        if os.path.isdir(f):
-                            self.mkdir_recursive(link, target_file)
-                            continue
-
-                        if not link.isdir(dirname):
-                            self.mkdir_recursive(link, dirname)
-                        link.chdir(os.path.join(root, dirname))
-
-                        link.put(f, os.path.basename(target_file) + ".tmp")
-                        if link.exists(os.path.basename(target_file)):
-                            link.remove(os.path.basename(target_file))
-                        link.rename(os.path.basename(target_file) + ".tmp", os.path.basename(target_file))
-                        link.chmod(os.path.basename(target_file), mode=755)
-                        self.total_data_uploaded_b += os.path.getsize(f)
-                        if self.remove_source_files:
-                            size = os.path.getsize(f)
-                            total_size += size
-                            mbps = (size/(time.time() - onefile_time))/1024/1024
-                            if not os.path.basename(f) == "last_image.jpg":
-                                os.remove(f)
-                            self.logger.debug(
-                                "Uploaded file {0}/{1} through sftp and removed from local filesystem, {2:.2f}Mb/s".format(idx, len(file_names), mbps))
-
-                        self.last_upload_time = datetime.datetime.now()
-                    except Exception as e:
-                        self.logger.error("sftp:{}".format(str(e)))
-                        failed.append(f)
-                    finally:
-                        link.chdir(root)
-                if not self.remove_source_files:
-                    if not len(failed):
-                        self.logger.debug("Uploaded {} files through sftp".format(len(file_names)))
-                    else:
-                        self.logger.debug("Failed uploading {} files through sftp - {}".format(len(failed), str(failed)))
+                pool.ensure_dir(link, root)
+                root = link.normalize(root)
+            # dump ze files.
+            total_time = time.time()
+            total_size = 0
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.upload_channels)
+            reduced = set(f for f in file_names if self.degraded and lane_for(f) == BULK and os.path.isfile(f))
+            futures = [(f, self._executor.submit(self._put_reduced if f in reduced else self._put_file, pool, root, f))
+                       for f in file_names]
+            for idx, (f, future) in enumerate(futures):
+                if self.stopper.is_set() and future.cancel():
+                    # draining, files that havent started are released back to the journal for the next run.
+                    continue
+                try:
+                    size, elapsed = future.result()
+                    Tracer.get_tracer().record(self.identifier, "upload_reduced" if f in reduced else "upload", elapsed)
+                    if f in reduced:
+                        self.journal.defer(f)
+                        self.total_data_uploaded_b += size
+                        total_size += size
+                        continue
+                    self.journal.mark_done(f)
+                    if os.path.isdir(f):
+                        continue
+                    self.total_data_uploaded_b += size
+                    total_size += size
+                    mbps = (size / max(elapsed, 1e-6)) / 1024 / 1024
+                    self.send_metrics("upload_file", dict(bytes=size, seconds=elapsed, mbps=mbps))
+                    if self.remove_source_files:
+                        if not os.path.basename(f) == "last_image.jpg":
+                            os.remove(f)
+                        self.logger.debug(
+                            "Uploaded file {0}/{1} through sftp and removed from local filesystem, {2:.2f}Mb/s".format(
+                                idx, len(file_names), mbps))
 
-                mbps = (total_size/(time.time() - total_time))/1024/1024
-                self.logger.debug("Finished uploading, {0:.2f}Mb/s".format(mbps))
+                    self.last_upload_time = datetime.datetime.now()
+                except Exception as e:
+                    self.logger.error("sftp:{}".format(str(e)))
+                    self.journal.mark_failed(f, str(e))
+                    failed.append(f)
+            if not self.remove_source_files:
+                if not len(failed):
+                    self.logger.debug("Uploaded {} files through sftp".format(len(file_names)))
+                else:
+                    self.logger.debug("Failed uploading {} files through sftp - {}".format(len(failed), str(failed)))
+
+            elapsed = time.time() - total_time
+            mbps = (total_size / max(elapsed, 1e-6)) / 1024 / 1024
+            if total_size >= 1024 * 1024:
+                # small cycles are dominated by latency, and say little about the link.
+                bps = total_size / max(elapsed, 1e-6)
+                self.throughput_bps = bps if self.throughput_bps is None else 0.3 * bps + 0.7 * self.throughput_bps
+            self.logger.debug("Finished uploading, {0:.2f}Mb/s".format(mbps))
+            self.send_metrics("upload_cycle", dict(bytes=total_size,
+                                                   seconds=elapsed,
+                                                   mbps=mbps,
+                                                   files=len(file_names) - len(failed),
+                                                   failed=len(failed),
+                                                   given_up=self.journal.given_up(self.source_dir),
+                                                   reduced=len(reduced),
+                                                   degraded=int(self.degraded)))
             if self.total_data_uploaded_b > 1000000000000:
                 curr = (((self.total_data_uploaded_b / 1024) / 1024) / 1024) / 1024
                 self.total_data_uploaded_b = 0
@@ -240,13 +778,17 @@ class Uploader(Thread):
                 # dump ze files.
                 for f in file_names:
                     ftp.storbinary('stor ' + os.path.basename(f), open(f, 'rb'), 1024)
+                    self.journal.mark_done(f)
                     if not os.path.basename(f) == "last_image.jpg":
                         os.remove(f)
                     self.logger.debug("Successfuly uploaded {} through ftp and removed from local filesystem".format(f))
                     self.last_upload_time = datetime.datetime.now()
+                failed = []
             except Exception as e:
                 # log error if cant upload using FTP. FTP is last resort.
                 self.logger.error(str(e))
+                failed = list(file_names)
+        return failed
 
     def mkdir_recursive(self, link, remote_directory, mkdir=None, chdir=None):
         """
@@ -300,23 +842,53 @@ class Uploader(Thread):
         run method.
         main loop for Uploaders.
 
+        Files to upload are claimed from the :class:`libs.UploadJournal.UploadJournal` in batches, rather than
+        globbing the whole upload directory. The directory is only scanned the first time it is seen, to pick up
+        files that were there before the journal.
         """
+        self.journal.recover(self.source_dir)
+        if not self.journal.is_seeded(self.source_dir):
+            existing = [f for f in glob(os.path.join(self.source_dir, '**'), recursive=True) if os.path.isfile(f)]
+            self.journal.seed(self.source_dir, existing)
         while True and not self.stopper.is_set():
+            drained = True
             try:
-                upload_list = glob(os.path.join(self.source_dir, '**'), recursive=True)
+                upload_list = []
+                if self.upload_enabled:
+                    upload_list = self.journal.claim(self.source_dir, limit=self.batch_size)
+                    drained = len(upload_list) < self.batch_size
+                for f in upload_list[:]:
+                    if not os.path.isfile(f):
+                        self.logger.warning("File in upload journal is gone: {}".format(f))
+                        self.journal.remove(f)
+                        upload_list.remove(f)
+                if self.adaptive:
+                    if not self.degraded and drained:
+                        # spare capacity, backfill originals that only had a reduced copy uploaded.
+                        upload_list.extend(self._claim_backfill(upload_list))
+                    # after the backfill, so that it counts toward whether the link is keeping up.
+                    self._update_degraded(upload_list)
+                if self._derive(upload_list):
+                    # derived files are claimed next cycle, dont wait for them.
+                    drained = False
                 if len(upload_list) == 0:
                     self.logger.info("No files in upload directory")
-                if (len(upload_list) > 0) and self.upload_enabled:
+                if len(upload_list) > 0:
                     start_upload_time = time.time()
                     self.logger.info("Preparing to upload %d files" % len(upload_list))
                     try:
-                        l_im = os.path.join(self.source_dir, "last_image.jpg")
+                        l_im = os.path.join(os.path.abspath(self.source_dir), "last_image.jpg")
                         if l_im in upload_list:
                             upload_list.insert(0, upload_list.pop(upload_list.index(l_im)))
                     except Exception as e:
                         self.logger.info(
                             "Something went wrong sorting the last image to the front of the list: {}".format(str(e)))
-                    self.upload(upload_list)
+                    try:
+                        if self.upload(upload_list):
+                            # dont go straight back for more if things are failing.
+                            drained = True
+                    finally:
+                        self.journal.release(upload_list)
                     self.communicate_with_updater()
                     try:
                         self.updatemqtt(bytes(self.last_upload_time.replace(tzinfo=timezone).isoformat(), 'utf-8'))
@@ -325,15 +897,32 @@ class Uploader(Thread):
                     self.logger.info(
                         "Average upload time: {0:.2f}s".format((time.time() - start_upload_time) / len(upload_list)))
                     self.logger.info("Total upload time: {0:.2f}s".format(time.time() - start_upload_time))
+                    self.logger.debug("Upload journal: {}".format(str(self.journal.stats(self.source_dir))))
+                if self.adaptive:
+                    self._trim_backlog()
+                self.journal.prune()
             except Exception as e:
                 self.logger.error("Unhandled exception in uploader run method: {}".format(str(e)))
-            time.sleep(Uploader.upload_interval)
+            if drained:
+                self.stopper.wait(Uploader.upload_interval)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        try:
+            # only idle connections are closed, other uploaders sharing the pool open new ones when they need them.
+            self.connection_pool().close_all()
+        except Exception as e:
+            self.logger.error("Couldnt close upload connections: {}".format(str(e)))
 
     def stop(self):
         """
         stopper method
+        uploads already in progress are finished, the rest of the batch is left for the next run.
+        the upload threads and idle pooled connections are closed when :func:`run` returns.
         """
         self.stopper.set()
+        if hasattr(self, "mqtt"):
+            self.mqtt.unsubscribe("camera/{}/config".format(self.identifier), self.mqtt_on_message)
 
 
 class GenericUploader(Uploader):
@@ -382,6 +971,12 @@ class GenericUploader(Uploader):
         self.username = "picam"
         self.password = None
         self.server_dir = "/picam"
+        self._executor = None
+        self.journal = UploadJournal.get_journal()
+        self.scheduler = UploadScheduler.get_scheduler()
+        # achieved throughput in bytes/s, averaged over upload cycles.
+        self.throughput_bps = None
+        self.degraded = False
 
         if config and type(config) is dict:
             self.name = config.get("name", self.name)
@@ -11,7 +11,7 @@ from jinja2 import Environment, FileSystemLoader
 from markupsafe import Markup
 from configparser import ConfigParser
 from datetime import datetime
-from functools import wraps
+from functools import wraps, partial
 from glob import glob
 
 from werkzeug.wsgi import DispatcherMiddleware
@@ -21,6 +21,8 @@ from flask import Flask, redirect, url_for, send_file, abort, Response, render_t
 from flask_bcrypt import Bcrypt
 
 from libs.Camera import *
+from libs.Stream import StreamManager
+from libs.Tracing import Tracer
 from flask import g
 
 import browsepy
@@ -1188,43 +1190,152 @@ def stream(lt, lc):
     return Response(generate(), mimetype='text/plain')
 
 
-def gen(camera) -> bytes:
+def register_streams() -> StreamManager:
+    """
+    Registers a live stream for every camera that can be detected, keyed by the same identifiers the capture
+    process uses: the picamera, each camera on an IVPort (as channels of one stream) and each usb webcam.
+    Camera types without a frame source are skipped.
+
+    :return: the stream manager
+    :rtype: StreamManager
+    """
+    manager = StreamManager.get_manager()
+    picam = SysUtil.default_identifier(prefix="picam")
+    if not manager.registered(picam) and PiCamera.stream_frames is not None:
+        manager.register(picam, PiCamera.stream_frames, device=PiCamera.stream_device)
+    ivport = SysUtil.default_identifier(prefix="ivport")
+    if not manager.registered(ivport) and IVPortCamera.stream_frames is not None:
+        manager.register(ivport, IVPortCamera.stream_frames,
+                         channels=tuple(range(len(IVPortCamera.TRUTH_TABLE) * len(IVPortCamera.gpio_groups))),
+                         device=IVPortCamera.stream_device)
+    try:
+        import pyudev
+        for device in pyudev.Context().list_devices(subsystem="video4linux"):
+            serial = device.get("ID_SERIAL_SHORT", None) or (device.get("ID_SERIAL", None) or "")[:6]
+            identifier = SysUtil.default_identifier(prefix="USB-{}".format(serial))
+            if not manager.registered(identifier) and USBCamera.stream_frames is not None:
+                manager.register(identifier, partial(USBCamera.stream_frames, device.sys_number),
+                                 device="video{}".format(device.sys_number))
+    except Exception as e:
+        app.logger.error("Couldnt detect usb cameras for streaming: {}".format(str(e)))
+    return manager
+
+
+def gen(frames, max_fps: float = 10) -> bytes:
     """
     Video streaming generator function.
 
     Intentionally limited to 10fps to account for bad quality connection and slow hardware.
+    Blocks until the camera has a new frame, so the same frame is never sent twice. The frame is yielded as is,
+    between the multipart headers, so every viewer shares the one encoded buffer.
 
     this should be used as the argument for a :class:`Response` along with the mimetype
     `multipart/x-mixed-replace; boundary=frame` to ensure that the browser correctly replaces the previous frame,
     and knows to continue to stream.
 
-    :return: image frame as encoded bytes, almost a complete response.
+    :param frames: iterator of encoded frames, like :func:`StreamManager.frames`
+    :param max_fps: maximum frame rate to send
+    :return: image frame as encoded bytes, and the multipart parts around it.
     :rtype: bytes
     """
-    while True:
-        time.sleep(0.1)
-        frame = camera.get_frame()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+    last = 0
+    for frame in frames:
+        yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+        yield frame
+        yield b'\r\n'
+        # frames that arrive while sleeping are skipped, and counted as dropped.
+        time.sleep(max(last + 1.0 / max_fps - time.time(), 0))
+        last = time.time()
 
 
-@app.route('/pi_feed')
-def pi_feed():
+@app.route('/feeds')
+def feeds() -> str:
     """
-    Video streaming route for the raspberry pi camera.
+    lists the cameras that can be streamed from, and their channels.
+
+    :return: json list of {"identifier": identifier, "channels": [channels]}
+    :rtype: str
+    """
+    manager = register_streams()
+    return str(json.dumps([dict(identifier=key, channels=list(channels)) for key, channels in manager.keys()]))
+
+
+@app.route('/feed/<identifier>')
+@app.route('/feed/<identifier>/<int:channel>')
+def feed(identifier: str, channel: int = None):
+    """
+    Video streaming route for any detected camera, see :func:`feeds`.
 
     Put this in the src attribute of an img tag.
 
+    :param identifier: camera identifier
+    :param channel: channel of the camera, for cameras with more than one (like the IVPort).
     :return: streamed image Response or emptystring
     :rtype: Response or str
     """
+    manager = register_streams()
+    if not manager.registered(identifier):
+        abort(404)
     try:
-        cam = PiCamera("asdfhjgasdkf", noconf=True)
-        return Response(gen(cam), mimetype='multipart/x-mixed-replace; boundary=frame')
+        manager.open(identifier)
+        return Response(gen(manager.frames(identifier, channel=channel)),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
     except Exception as e:
         return "exception:" + str(e)
 
 
+@app.route('/feed/<identifier>/stats')
+def feed_stats(identifier: str) -> str:
+    """
+    Live stream metrics for a camera, frame rate, connected viewers and dropped frames for each channel.
+
+    :return: json stats
+    :rtype: str
+    """
+    manager = register_streams()
+    if not manager.registered(identifier):
+        abort(404)
+    return str(json.dumps(manager.stats(identifier)))
+
+
+@app.route('/spans')
+@app.route('/spans/<identifier>')
+def spans(identifier: str = None) -> str:
+    """
+    Capture and upload latency percentiles (p50/p95/p99, in seconds) for each span, as published by the capture
+    process, see :class:`libs.Tracing.Tracer`.
+
+    :param identifier: camera identifier, or none for all cameras.
+    :return: json dict of span name: summary, or camera identifier: that for all cameras.
+    :rtype: str
+    """
+    return str(json.dumps(Tracer.load_snapshot(identifier)))
+
+
+@app.route('/pi_feed')
+def pi_feed():
+    """
+    Video streaming route for the raspberry pi camera.
+
+    Put this in the src attribute of an img tag.
+
+    :return: streamed image Response or emptystring
+    :rtype: Response or str
+    """
+    return feed(SysUtil.default_identifier(prefix="picam"))
+
+
+@app.route('/pi_feed/stats')
+def pi_feed_stats():
+    """
+    Live stream metrics for the raspberry pi camera, frame rate, connected viewers and dropped frames.
+
+    :return: json stats
+    :rtype: str
+    """
+    return feed_stats(SysUtil.default_identifier(prefix="picam"))
+
+
 @app.route('/ivport_switch/<int:cam_num>')
 def ivport_switch(cam_num) -> str:
     """
@@ -1243,13 +1354,12 @@ def ivport_feed(cam_num):
     """
     Streaming from a specific picamera with the IVPort multiplexer
 
-    Actually calls :func:`pi_feed`, because the IVPOrt multiplexer works on the picamera.
+    Every camera on the IVPort is streamed at once, as channels of one stream, so this doesnt switch the IVPort.
 
     :return: streamed image Response or emptystring (as per pi_feed)
     :rtype: Response or str
     """
-    IVPortCamera.switch(idx=cam_num)
-    return pi_feed()
+    return feed(SysUtil.default_identifier(prefix="ivport"), cam_num)
 
 
 @app.route("/logfile")